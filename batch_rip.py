@@ -0,0 +1,225 @@
+import os
+import argparse
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from tqdm import tqdm
+from frame_decoders import DECODE_BACKENDS
+from frame_encoders import add_encoder_args
+from frame_shards import add_shard_args, get_video_shard_paths, remove_shard
+from frame_catalog import FrameCatalog, add_catalog_args
+from vlc_frame_ripper import SAMPLING_MODES, DEFAULT_SCENE_THRESHOLD, Ripper, check_backend_options, sanitize_inputs, get_video_duration, get_frame_times, save_frames_at, save_sampled_frames, save_metadata
+
+""" rip frames from every video in an ingest directory (videos/<id>/<id>.<ext>, as written by the download scripts) on a process pool
+    long videos are split into time segments that are decoded concurrently, so throughput scales with the number of cores rather than the number of videos
+"""
+
+VIDEO_EXTS = ["mp4", "mkv", "webm", "avi", "mov", "wmv"]
+# reasons plan_jobs can skip a video
+SKIP_FRAMES_EXIST = "frames_exist"
+SKIP_INVALID = "invalid"
+
+
+@dataclass
+class SegmentJob:
+    """ dataclass for one unit of work: a contiguous run of frame times from one video (or the whole video for non-uniform sampling) """
+    video_id: str
+    segment_idx: int
+    ripper: Ripper
+    # None for the keyframe-only and scene-change modes, which decide the frames while decoding
+    frame_times: list = None
+    attempts: int = 0
+
+
+@dataclass
+class VideoPlan:
+    """ dataclass for the segment jobs of one video - or, for a skipped video, why it was skipped (and the error, for an unreadable one) """
+    video_id: str
+    jobs: list
+    skip_reason: str = None
+    error: str = None
+
+
+def add_rip_options(parser: argparse.ArgumentParser):
+    """ options for how each video is ripped - shared with the ingest daemon """
+    parser.add_argument('--num_frames', type=int, default=None, help='total number of frames to extract per video')
+    parser.add_argument('--start_time', type=float, default=0, help='start time in milliseconds')
+    parser.add_argument('--end_time', type=float, default=None, help='end time in milliseconds')
+    parser.add_argument('--time_step', type=float, default=1000, help='time step between extracted frames in milliseconds')
+    parser.add_argument('--backend', type=str, default='opencv', choices=DECODE_BACKENDS, help='decode backend')
+    parser.add_argument('--sampling', type=str, default='uniform', choices=SAMPLING_MODES, help='frame sampling mode (see vlc_frame_ripper.py); only uniform sampling is split into segments')
+    parser.add_argument('--scene_threshold', type=float, default=DEFAULT_SCENE_THRESHOLD, help='scene change threshold for scene sampling')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--segment_ms', type=int, default=120000, help='split videos into segments of this many milliseconds that are decoded concurrently')
+    parser.add_argument('--retries', type=int, default=2, help='number of times to retry a failed segment')
+    parser.add_argument('--force', action='store_true', help="rip videos whose 'frames' directory already has files (or that already have shards in --shard_dir, which are replaced) instead of skipping them")
+    # each worker process already decodes on its own core, so one background encode thread per process is enough to overlap decoding and encoding
+    add_encoder_args(parser, encode_workers=1)
+    # segments claim their own shard files, so every worker can write into the same shard directory
+    add_shard_args(parser)
+    add_catalog_args(parser)
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Extract frames from every video in a directory tree in parallel.")
+    parser.add_argument('videos_dir', type=str, help='directory containing <video_id>/<video_id>.<ext> video files')
+    add_rip_options(parser)
+    return parser.parse_args()
+
+
+def discover_videos(videos_dir: str) -> list:
+    """ get (video_id, vid_path) for each videos_dir/<id>/<id>.<ext> """
+    videos = []
+    with os.scandir(videos_dir) as entries:
+        video_ids = sorted(entry.name for entry in entries if entry.is_dir())
+    for video_id in video_ids:
+        for ext in VIDEO_EXTS:
+            vid_path = os.path.join(videos_dir, video_id, f"{video_id}.{ext}")
+            if os.path.isfile(vid_path):
+                videos.append((video_id, vid_path))
+                break
+    return videos
+
+def plan_video(vid_path: str, args: argparse.Namespace) -> Ripper:
+    """ build a Ripper for the video with the same sanitization as the single-video ripper """
+    rip_args = argparse.Namespace(vid_path=vid_path, frames_path=os.path.join(os.path.dirname(vid_path), "frames"), num_frames=args.num_frames,
+                                  start_time=args.start_time, end_time=args.end_time, time_step=args.time_step,
+                                  sampling=args.sampling, scene_threshold=args.scene_threshold,
+                                  output_format=args.output_format, png_level=args.png_level, jpeg_quality=args.jpeg_quality,
+                                  shard_dir=args.shard_dir, shard_format=args.shard_format, frames_per_shard=args.frames_per_shard)
+    return sanitize_inputs(rip_args, get_video_duration(vid_path, args.backend))
+
+def split_segments(video_id: str, ripper: Ripper, segment_ms: int) -> list:
+    """ split the video's frame times into jobs covering at most segment_ms each """
+    if ripper.sampling != "uniform":
+        return [SegmentJob(video_id, 0, ripper)]
+    frame_times = get_frame_times(ripper)
+    segment_ids = (frame_times - ripper.start_time)//max(segment_ms, 1)
+    boundaries = np.flatnonzero(np.diff(segment_ids)) + 1
+    return [SegmentJob(video_id, idx, ripper, times.tolist())
+            for idx, times in enumerate(np.split(frame_times, boundaries)) if len(times) > 0]
+
+def plan_jobs(video_id: str, vid_path: str, args: argparse.Namespace, force: bool = None) -> VideoPlan:
+    """ segment jobs for one video, after creating its frames directory and saving its metadata
+        a video whose frames directory already has files, or that already has finished shards in the shard directory, is skipped unless forced (force defaults to args.force)
+        forcing a video replaces its shards, since new shards would otherwise be added next to them; a video that can't be read is skipped too, with the reason in the plan
+    """
+    frames_path = os.path.join(os.path.dirname(vid_path), "frames")
+    # the ripper names a video's shards after its file, which is videos/<id>/<id>.<ext>
+    shard_prefix = os.path.splitext(os.path.basename(vid_path))[0]
+    force = args.force if force is None else force
+    if args.shard_dir is None and os.path.isdir(frames_path) and len(os.listdir(frames_path)) > 0 and not force:
+        print(f"skipping {video_id}: '{frames_path}' already has files (use --force to rip it anyway)")
+        return VideoPlan(video_id, [], SKIP_FRAMES_EXIST)
+    if args.shard_dir is not None and get_video_shard_paths(args.shard_dir, shard_prefix) and not force:
+        print(f"skipping {video_id}: '{args.shard_dir}' already has its shards (use --force to rip it again)")
+        return VideoPlan(video_id, [], SKIP_FRAMES_EXIST)
+    try:
+        ripper = plan_video(vid_path, args)
+    except (ValueError, OSError) as e:
+        print(f"skipping {video_id}: {e}")
+        return VideoPlan(video_id, [], SKIP_INVALID, str(e))
+    if ripper.shard_dir is None:
+        os.makedirs(ripper.frames_path, exist_ok=True)
+    else:
+        for shard_path in get_video_shard_paths(ripper.shard_dir, shard_prefix, indexed_only=False):
+            remove_shard(shard_path)
+    save_metadata(ripper)
+    return VideoPlan(video_id, split_segments(video_id, ripper, args.segment_ms))
+
+def get_job_size(job: SegmentJob) -> int:
+    """ number of frames a job is expected to save (the frame cap for non-uniform sampling) """
+    return len(job.frame_times) if job.frame_times is not None else job.ripper.num_frames
+
+def rip_segment(job: SegmentJob, backend: str, encode_workers: int = 1) -> int:
+    """ process pool job - each worker opens its own decoder and seeks to the start of its segment """
+    if job.frame_times is None:
+        return save_sampled_frames(job.ripper, backend, encode_workers=encode_workers)
+    num_saved = save_frames_at(job.ripper, job.frame_times, backend, encode_workers=encode_workers)
+    if num_saved < len(job.frame_times):
+        raise RuntimeError(f"video stream ended early at {job.frame_times[num_saved]} ms ({num_saved}/{len(job.frame_times)} frames saved)")
+    return num_saved
+
+class SegmentPool:
+    """ process pool that replaces itself when a worker crash (e.g. a decoder segfault) breaks it
+        a broken ProcessPoolExecutor fails every pending future and refuses new work, so without this one bad segment would end the whole batch
+    """
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.num_restarts = 0
+
+    def restart(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.num_restarts += 1
+
+    def submit(self, fn, *args):
+        try:
+            return self.executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.restart()
+            return self.executor.submit(fn, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+def run_jobs(jobs: list, backend: str, workers: int, retries: int, encode_workers: int = 1, pool: SegmentPool = None) -> list:
+    """ run all segment jobs, resubmitting failed ones up to retries times - returns (job, error) for jobs that never succeeded
+        a long-lived pool can be passed in (e.g. by the ingest daemon) instead of starting a new one for these jobs
+        a worker crash fails every job in flight on the pool, so each of them uses up an attempt and is resubmitted to a fresh pool
+    """
+    if pool is None:
+        with SegmentPool(workers) as pool:
+            return run_jobs(jobs, backend, workers, retries, encode_workers, pool)
+    failed = []
+    with tqdm(total=sum(get_job_size(job) for job in jobs), desc="Ripping frames") as pbar:
+        # longest segments first so a big straggler doesn't start last
+        futures = {pool.submit(rip_segment, job, backend, encode_workers): job for job in sorted(jobs, key=lambda job: -get_job_size(job))}
+        while len(futures) > 0:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = futures.pop(future)
+                try:
+                    pbar.update(future.result())
+                except Exception as e:
+                    job.attempts += 1
+                    if job.attempts <= retries:
+                        pbar.write(f"retrying {job.video_id} segment {job.segment_idx} (attempt {job.attempts + 1}): {e}")
+                        futures[pool.submit(rip_segment, job, backend, encode_workers)] = job
+                    else:
+                        failed.append((job, e))
+    return failed
+
+def register_frames(catalog_path: str, jobs: list):
+    """ add the frames directories of the jobs' videos to the frame catalog """
+    with FrameCatalog(catalog_path) as catalog:
+        for frames_path in {job.ripper.frames_path for job in jobs}:
+            catalog.scan(frames_path)
+
+
+if __name__ == "__main__":
+    args = read_cli()
+    if not os.path.isdir(args.videos_dir):
+        raise NotADirectoryError(f"{args.videos_dir} is not a directory.")
+    # fail once up front rather than once per segment (and again for every retry)
+    check_backend_options(args)
+    videos = discover_videos(args.videos_dir)
+    print(f"found {len(videos)} videos in {args.videos_dir}")
+    jobs = []
+    for video_id, vid_path in videos:
+        jobs.extend(plan_jobs(video_id, vid_path, args).jobs)
+    print(f"{len(jobs)} segments to rip across {len({job.video_id for job in jobs})} videos")
+    failed = run_jobs(jobs, args.backend, args.workers, args.retries, args.encode_workers)
+    for job, error in failed:
+        print(f"FAILED: {job.video_id} segment {job.segment_idx}: {error}")
+    print(f"FINISHED: {len(jobs) - len(failed)}/{len(jobs)} segments ripped")
+    if args.catalog is not None and args.shard_dir is None:
+        register_frames(args.catalog, jobs)
+        print(f"catalog updated: {args.catalog}")
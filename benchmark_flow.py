@@ -0,0 +1,76 @@
+import time
+import argparse
+import numpy as np
+import cv2
+from flow_backends import FLOW_BACKENDS, compute_flow
+from undo_motion_blur import estimate_kernel
+
+""" benchmark the optical flow backends on synthetic motion-blurred frame pairs
+    reports pairs per second, endpoint error against the known motion, and how far each backend's blur kernel is from the TV-L1 kernel
+"""
+
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare speed and accuracy of the optical flow backends used for motion blur estimation.")
+    parser.add_argument('--width', type=int, default=1920, help='width of the synthetic frames')
+    parser.add_argument('--height', type=int, default=1080, help='height of the synthetic frames')
+    parser.add_argument('--num_pairs', type=int, default=5, help='number of frame pairs per backend')
+    parser.add_argument('--max_shift', type=int, default=12, help='max camera motion between frames in pixels')
+    parser.add_argument('--backends', type=str, nargs='+', default=FLOW_BACKENDS, choices=FLOW_BACKENDS, help='backends to benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic frames')
+    return parser.parse_args()
+
+def make_texture(height: int, width: int, rng: np.random.Generator) -> np.ndarray:
+    """ smooth random texture with detail at several scales so flow is well defined everywhere """
+    texture = np.zeros((height, width), dtype=np.float32)
+    for scale in [4, 16, 64]:
+        noise = rng.random((height//scale + 1, width//scale + 1), dtype=np.float32)
+        texture += cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.normalize(texture, None, 0, 1, cv2.NORM_MINMAX)
+
+def motion_blur(image: np.ndarray, dy: float, dx: float) -> np.ndarray:
+    """ blur with a line kernel along the motion vector (averaging over the exposure) """
+    length = max(int(np.ceil(np.hypot(dy, dx))), 1)
+    size = 2*length + 1
+    kernel = np.zeros((size, size), dtype=np.float32)
+    for t in np.linspace(-0.5, 0.5, 4*length + 1):
+        kernel[int(round(length + t*dy)), int(round(length + t*dx))] = 1
+    return cv2.filter2D(image, -1, kernel/kernel.sum(), borderType=cv2.BORDER_REFLECT)
+
+def make_pair(height: int, width: int, max_shift: int, rng: np.random.Generator):
+    """ two blurred frames where the second is the first translated by (dy, dx) """
+    pad = max_shift + 1
+    texture = make_texture(height + 2*pad, width + 2*pad, rng)
+    dy, dx = rng.uniform(-max_shift, max_shift, size=2)
+    shift = np.float32([[1, 0, dx], [0, 1, dy]])
+    moved = cv2.warpAffine(texture, shift, texture.shape[::-1], flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+    crop = (slice(pad, pad + height), slice(pad, pad + width))
+    return motion_blur(texture, dy, dx)[crop], motion_blur(moved, dy, dx)[crop], (dy, dx)
+
+def benchmark_backend(backend: str, pairs) -> dict:
+    kernels, endpoint_errors = [], []
+    start = time.perf_counter()
+    for prev_image, image, _ in pairs:
+        kernels.append(estimate_kernel(prev_image, image, backend))
+    elapsed = time.perf_counter() - start
+    # flow is timed as part of the kernel above; recompute it separately for the error against the known motion
+    for prev_image, image, (dy, dx) in pairs:
+        flow = compute_flow(prev_image, image, backend)
+        endpoint_errors.append(float(np.mean(np.hypot(flow[0] - dy, flow[1] - dx))))
+    return {"pairs_per_sec": len(pairs)/elapsed, "endpoint_error": float(np.mean(endpoint_errors)), "kernels": kernels}
+
+
+if __name__ == "__main__":
+    args = read_cli()
+    rng = np.random.default_rng(args.seed)
+    pairs = [make_pair(args.height, args.width, args.max_shift, rng) for _ in range(args.num_pairs)]
+    # TV-L1 is the reference the kernels are compared against, so always run it
+    backends = ["tvl1"] + [b for b in args.backends if b != "tvl1"]
+    results = {backend: benchmark_backend(backend, pairs) for backend in backends}
+    reference = results["tvl1"]["kernels"]
+    print(f"{args.num_pairs} pairs of {args.width}x{args.height} frames, motion up to {args.max_shift} px")
+    print(f"{'backend':<12}{'pairs/s':>10}{'speedup':>10}{'EPE (px)':>12}{'kernel MAE vs tvl1':>22}")
+    for backend, result in results.items():
+        kernel_error = np.mean([np.mean(np.abs(k - ref)) for k, ref in zip(result["kernels"], reference)])
+        speedup = result["pairs_per_sec"]/results["tvl1"]["pairs_per_sec"]
+        print(f"{backend:<12}{result['pairs_per_sec']:>10.2f}{speedup:>9.1f}x{result['endpoint_error']:>12.3f}{kernel_error:>22.4f}")
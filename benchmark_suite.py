@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+""" end-to-end throughput benchmark for the frame tools on synthetic data - runs offline on a CPU-only box
+    generates a panning, motion-blurred test video plus a matching frames directory, then runs the rip, postprocess, and deblur stages
+    each stage runs in its own fresh process so its peak RSS (and import cost) isn't mixed up with the others
+    results are saved as JSON; --compare prints the change between two result files (e.g. from two commits)
+"""
+
+STAGES = ["rip", "postprocess", "deblur"]
+PERCENTILES = [50, 90, 99]
+
+
+def read_cli() -> argparse.Namespace:
+    from frame_decoders import DECODE_BACKENDS
+    from flow_backends import FLOW_BACKENDS
+    parser = argparse.ArgumentParser(description="Benchmark ripping, postprocessing, and deblurring throughput on synthetic videos and frames.")
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=('BASELINE', 'CANDIDATE'), help='compare two result files instead of running the benchmark')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='path for the JSON results')
+    parser.add_argument('--work_dir', type=str, default=None, help='directory for the synthetic data (default: a temporary directory that is removed afterwards)')
+    parser.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES, help='stages to benchmark')
+    parser.add_argument('--width', type=int, default=640, help='width of the synthetic frames')
+    parser.add_argument('--height', type=int, default=360, help='height of the synthetic frames')
+    parser.add_argument('--num_frames', type=int, default=120, help='length of the synthetic video in frames')
+    parser.add_argument('--fps', type=float, default=30, help='frame rate of the synthetic video')
+    parser.add_argument('--max_shift', type=float, default=8, help='max camera motion (and so motion blur length) in pixels per frame; 0 disables blur')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic data')
+    parser.add_argument('--backend', type=str, default='opencv', choices=DECODE_BACKENDS, help='decode backend for the rip stage')
+    parser.add_argument('--workers', type=int, default=1, help='workers for the postprocess and deblur stages')
+    parser.add_argument('--deblur_frames', type=int, default=20, help='number of frames to deblur (optical flow is much slower than the other stages)')
+    parser.add_argument('--flow_backend', type=str, default='tvl1', choices=FLOW_BACKENDS, help='optical flow backend for the deblur stage')
+    parser.add_argument('--latency_frames', type=int, default=30, help='number of frames timed step by step for the latency percentiles')
+    return parser.parse_args()
+
+
+def get_frame_times(num_frames: int, fps: float) -> list:
+    """ timestamp (ms) of the start of every frame of the synthetic video """
+    from frame_decoders import ms_timestamp
+    return [ms_timestamp(idx*1000/fps) for idx in range(num_frames)]
+
+def generate_frames(width: int, height: int, num_frames: int, max_shift: float, seed: int):
+    """ yield RGB frames of a textured scene panned along a smooth path, each blurred along its own motion """
+    import cv2
+    from benchmark_flow import make_texture, motion_blur
+    rng = np.random.default_rng(seed)
+    # sinusoidal path so the speed never exceeds max_shift and the camera stays on the canvas
+    period = 60
+    amplitude = max_shift*period/(2*np.pi)
+    pad = int(np.ceil(amplitude + max_shift)) + 1
+    canvas = np.stack([make_texture(height + 2*pad, width + 2*pad, rng) for _ in range(3)], axis=-1)
+    phase_y, phase_x = rng.uniform(0, 2*np.pi, size=2)
+    def position(idx):
+        return amplitude*np.sin(2*np.pi*idx/period + phase_y), amplitude*np.sin(2*np.pi*idx/period + phase_x)
+    for idx in range(num_frames):
+        (y0, x0), (y1, x1) = position(idx - 1), position(idx)
+        shift = np.float32([[1, 0, -x1], [0, 1, -y1]])
+        frame = cv2.warpAffine(canvas, shift, canvas.shape[1::-1], flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+        if max_shift > 0:
+            frame = motion_blur(frame, y1 - y0, x1 - x0)
+        yield (np.clip(frame[pad:pad + height, pad:pad + width], 0, 1)*255).round().astype(np.uint8)
+
+def generate_data(work_dir: str, args: argparse.Namespace) -> dict:
+    """ write the synthetic video and frames directory - returns their paths """
+    import cv2
+    video_path = os.path.join(work_dir, "synthetic.mp4")
+    frames_dir = os.path.join(work_dir, "frames")
+    os.makedirs(frames_dir, exist_ok=True)
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), args.fps, (args.width, args.height))
+    names = [f"frame_{frame_time}.png" for frame_time in get_frame_times(args.num_frames, args.fps)]
+    for name, frame in zip(names, generate_frames(args.width, args.height, args.num_frames, args.max_shift, args.seed)):
+        bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        writer.write(bgr)
+        cv2.imwrite(os.path.join(frames_dir, name), bgr)
+    writer.release()
+    if not os.path.isfile(video_path) or os.path.getsize(video_path) == 0:
+        raise RuntimeError("OpenCV could not write the synthetic video (no mp4v encoder available?)")
+    return {"video": video_path, "frames": frames_dir}
+
+
+def summarize_latencies(latencies: dict) -> dict:
+    """ {step: [seconds]} -> {step: {mean, p50, p90, p99}} in milliseconds """
+    summary = {}
+    for step, values in latencies.items():
+        values_ms = 1000*np.asarray(values)
+        summary[step] = {"mean": float(values_ms.mean()), **{f"p{p}": float(np.percentile(values_ms, p)) for p in PERCENTILES}}
+    return summary
+
+def timed(fn, latencies: list):
+    """ wrap fn so that every call's duration is appended to latencies """
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        latencies.append(time.perf_counter() - start)
+        return result
+    return wrapper
+
+def timed_iter(iterable, latencies: list):
+    """ yield from iterable, appending the time taken to produce each item to latencies """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        latencies.append(time.perf_counter() - start)
+        yield item
+
+def bench_rip(data: dict, out_dir: str, args: argparse.Namespace) -> dict:
+    from frame_decoders import get_decoder
+    from frame_encoders import EncoderOptions, encode_frame
+    from vlc_frame_ripper import Ripper, save_frames_at
+    from perf_utils import get_peak_rss_mb
+    with get_decoder(args.backend, data["video"]) as decoder:
+        duration = decoder.get_duration()
+    # every frame of the video, like a dense rip
+    frame_times = get_frame_times(args.num_frames, args.fps)
+    ripper = Ripper(data["video"], out_dir, args.num_frames, 0, frame_times[-1], None, duration)
+    start = time.perf_counter()
+    num_frames = save_frames_at(ripper, frame_times, args.backend)
+    elapsed = time.perf_counter() - start
+    # step by step pass for the latency breakdown
+    latencies = {"decode": [], "encode": []}
+    options = EncoderOptions()
+    with get_decoder(args.backend, data["video"]) as decoder:
+        for _, frame in timed_iter(decoder.iter_frames_at(frame_times[:args.latency_frames]), latencies["decode"]):
+            timed(encode_frame, latencies["encode"])(frame, options)
+    return {"frames": num_frames, "seconds": elapsed, "latency_ms": summarize_latencies(latencies), "peak_rss_mb": get_peak_rss_mb()}
+
+def bench_postprocess(data: dict, out_dir: str, args: argparse.Namespace) -> dict:
+    import postprocess_frames as pp
+    from frame_encoders import EncoderOptions
+    from perf_utils import get_peak_rss_mb
+    # a typical crop + brightness job
+    pp_args = argparse.Namespace(top_offset=args.height//10, bottom_offset=args.height//10, brightness_mult=1.2, undo_motion_blur=False)
+    postprocessor = pp.get_postprocessor(pp_args)
+    options = EncoderOptions()
+    file_paths = sorted(os.path.join(data["frames"], f) for f in os.listdir(data["frames"]))
+    start = time.perf_counter()
+    pp.process_frames(file_paths, postprocessor, out_dir, False, args.workers, options=options)
+    elapsed = time.perf_counter() - start
+    latencies = {"read": [], "transform": [], "write": []}
+    for path in file_paths[:args.latency_frames]:
+        path, img = timed(pp.read_frame, latencies["read"])(path)
+        img = timed(postprocessor, latencies["transform"])(img)
+        timed(pp.write_frame, latencies["write"])(path, img, out_dir, False, options)
+    return {"frames": len(file_paths), "seconds": elapsed, "latency_ms": summarize_latencies(latencies), "peak_rss_mb": get_peak_rss_mb()}
+
+def bench_deblur(data: dict, out_dir: str, args: argparse.Namespace) -> dict:
+    from undo_motion_blur import DeblurParams, list_frame_files, process_image_directory, restore_frame_from_paths
+    from perf_utils import get_peak_rss_mb
+    params = DeblurParams(flow_backend=args.flow_backend, tile_workers=1)
+    start = time.perf_counter()
+    process_image_directory(data["frames"], out_dir, args.deblur_frames, params, args.workers)
+    elapsed = time.perf_counter() - start
+    paths = [os.path.join(data["frames"], f) for f in list_frame_files(data["frames"], min(args.deblur_frames, args.latency_frames + 1))]
+    latencies = {"restore_pair": []}
+    for prev_path, path in zip(paths, paths[1:]):
+        timed(restore_frame_from_paths, latencies["restore_pair"])(prev_path, path, params, out_dir)
+    # the first frame only serves as the reference for the second
+    return {"frames": max(len(list_frame_files(data["frames"], args.deblur_frames)) - 1, 0), "seconds": elapsed,
+            "latency_ms": summarize_latencies(latencies), "peak_rss_mb": get_peak_rss_mb()}
+
+STAGE_FUNCTIONS = {"rip": bench_rip, "postprocess": bench_postprocess, "deblur": bench_deblur}
+
+def run_stage(stage: str, data: dict, work_dir: str, args: argparse.Namespace) -> dict:
+    """ run one stage in a fresh (spawned) process and return its results """
+    out_dir = os.path.join(work_dir, f"{stage}_output")
+    os.makedirs(out_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        result = executor.submit(STAGE_FUNCTIONS[stage], data, out_dir, args).result()
+    result["fps"] = result["frames"]/result["seconds"] if result["seconds"] > 0 else None
+    return result
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_system_info() -> dict:
+    return {"commit": get_git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "numpy": np.__version__}
+
+def format_fps(fps: float, width: int) -> str:
+    """ fps right-aligned to width - 'n/a' for a stage too fast to time (fps None) """
+    return f"{'n/a':>{width}}" if fps is None else f"{fps:>{width}.1f}"
+
+def print_results(results: dict):
+    print(f"{'stage':<14}{'frames':>8}{'fps':>10}{'peak RSS (MiB)':>16}  latency p50/p90/p99 (ms)")
+    for stage, result in results["stages"].items():
+        steps = ", ".join(f"{step} {l['p50']:.1f}/{l['p90']:.1f}/{l['p99']:.1f}" for step, l in result["latency_ms"].items())
+        print(f"{stage:<14}{result['frames']:>8}{format_fps(result['fps'], 10)}{result['peak_rss_mb']:>16.1f}  {steps}")
+
+def compare_results(baseline_path: str, candidate_path: str):
+    """ print the fps, latency, and memory change of each stage between two result files """
+    with open(baseline_path, 'r') as fptr:
+        baseline = json.load(fptr)
+    with open(candidate_path, 'r') as fptr:
+        candidate = json.load(fptr)
+    print(f"baseline:  {baseline_path} (commit {baseline['system']['commit']})")
+    print(f"candidate: {candidate_path} (commit {candidate['system']['commit']})")
+    if baseline["config"] != candidate["config"]:
+        print("WARNING: the runs used different settings, so the numbers may not be comparable")
+    print(f"{'stage':<14}{'fps':>22}{'speedup':>10}{'peak RSS (MiB)':>22}  p50 latency change")
+    for stage in [s for s in baseline["stages"] if s in candidate["stages"]]:
+        old, new = baseline["stages"][stage], candidate["stages"][stage]
+        steps = ", ".join(f"{step} {old['latency_ms'][step]['p50']:.1f}->{new['latency_ms'][step]['p50']:.1f}"
+                          for step in old["latency_ms"] if step in new["latency_ms"])
+        speedup = f"{new['fps']/old['fps']:>9.2f}x" if old["fps"] and new["fps"] is not None else f"{'n/a':>10}"
+        print(f"{stage:<14}{format_fps(old['fps'], 10)} -> {format_fps(new['fps'], 8)}{speedup}"
+              f"{old['peak_rss_mb']:>10.1f} -> {new['peak_rss_mb']:>8.1f}  {steps}")
+
+
+if __name__ == "__main__":
+    args = read_cli()
+    if args.compare is not None:
+        compare_results(*args.compare)
+        sys.exit(0)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="frame_benchmark_")
+    try:
+        print(f"generating {args.num_frames} synthetic {args.width}x{args.height} frames in {work_dir}")
+        data = generate_data(work_dir, args)
+        config = {k: v for k, v in vars(args).items() if k not in ("compare", "output", "work_dir")}
+        results = {"config": config, "system": get_system_info(), "stages": {}}
+        for stage in args.stages:
+            print(f"running {stage}...")
+            results["stages"][stage] = run_stage(stage, data, work_dir, args)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print_results(results)
+    with open(args.output, 'w') as fptr:
+        json.dump(results, fptr, indent=4)
+    print(f"results written to {args.output}")
@@ -0,0 +1,121 @@
+import sys
+import shlex
+import argparse
+import importlib
+import traceback
+
+""" single entry point for the frame tools: python cli.py <command> [options]
+    a tool's module (and its numpy/torch/cv2 imports) is only loaded once its command is chosen, so listing the commands imports nothing heavy
+    'batch' runs many commands in one process, so imports and per-process caches (Wiener spectra, brightness tables, ...) are paid once instead of once per directory
+"""
+
+# command -> (module, summary) - summaries live here so that the top-level help doesn't import the tool modules
+# every tool module has add_args(parser) and main(args)
+COMMANDS = {
+    "rip": ("vlc_frame_ripper", "extract frames from a video with VLC or a headless decode backend"),
+    "postprocess": ("postprocess_frames", "crop, brighten, and/or deblur every frame in a directory"),
+    "deblur": ("undo_motion_blur", "deblur frames with a motion blur kernel estimated from optical flow"),
+    "rename": ("rename_all", "prefix the frames of every video under a root directory with the video name"),
+    "catalog": ("frame_catalog", "scan frame directories into the SQLite frame catalog and query it"),
+    "ingest": ("ingest", "download a URL list and rip each video as soon as it's on disk"),
+    "check": ("self_check", "run the self-checks of the tools on generated data"),
+}
+BATCH_DESCRIPTION = """run many commands in one process - each line (from --file or stdin) is a command line such as 'postprocess videos/abc/frames --brightness_mult 1.2'
+with --template, each directory is put in place of {} in the template instead, e.g. --template 'postprocess {} --brightness_mult 1.2' dir1 dir2
+lines are run as they arrive, so a long-running producer can pipe directories in; confirmation prompts are skipped (as with --yes)"""
+
+
+def build_parser() -> argparse.ArgumentParser:
+    commands = "\n".join(f"  {name:<12} {summary}" for name, (_, summary) in COMMANDS.items())
+    parser = argparse.ArgumentParser(prog="cli.py", description="Frame extraction and processing tools.", formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=f"commands:\n{commands}\n  {'batch':<12} run many commands (or one command over many directories) in one process\n\n"
+                                            "run 'cli.py <command> --help' for the options of a command")
+    parser.add_argument('command', choices=[*COMMANDS, "batch"], metavar='command', help='one of: ' + ", ".join([*COMMANDS, "batch"]))
+    parser.add_argument('command_args', nargs=argparse.REMAINDER, help='options of the command')
+    return parser
+
+def build_batch_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli.py batch", description=BATCH_DESCRIPTION, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dirs', type=str, nargs='*', help='directories (or command lines without --template) to run; read from --file or stdin if none are given')
+    parser.add_argument('--template', type=str, default=None, help="command line with {} where each directory goes")
+    parser.add_argument('--file', type=str, default=None, help="file with one directory or command line per line (default: stdin)")
+    parser.add_argument('--stop_on_error', action='store_true', help='stop at the first failed command instead of moving on to the next one')
+    return parser
+
+
+class CommandRunner:
+    """ parses and runs tool commands, importing each tool module the first time it's used and reusing its parser after that """
+    def __init__(self):
+        self.parsers = {}
+
+    def get_parser(self, command: str) -> argparse.ArgumentParser:
+        if command not in self.parsers:
+            module_name, summary = COMMANDS[command]
+            parser = argparse.ArgumentParser(prog=f"cli.py {command}", description=summary)
+            importlib.import_module(module_name).add_args(parser)
+            self.parsers[command] = parser
+        return self.parsers[command]
+
+    def run(self, command: str, command_args: list, assume_yes: bool = False):
+        if command not in COMMANDS:
+            raise ValueError(f"unknown command '{command}' (expected one of {list(COMMANDS)})")
+        args = self.get_parser(command).parse_args(command_args)
+        if assume_yes and hasattr(args, "yes"):
+            args.yes = True
+        importlib.import_module(COMMANDS[command][0]).main(args)
+
+
+def iter_batch_lines(batch_args: argparse.Namespace):
+    """ yield the non-empty, non-comment lines to run - lines are yielded as they're read, so stdin can be a long-running stream """
+    if batch_args.dirs:
+        yield from batch_args.dirs
+        return
+    fptr = sys.stdin if batch_args.file in (None, "-") else open(batch_args.file, 'r')
+    try:
+        for line in fptr:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+    finally:
+        if fptr is not sys.stdin:
+            fptr.close()
+
+def get_batch_command(line: str, template: str = None) -> list:
+    """ split a batch line into [command, *args] - with a template, the line is a single directory substituted for each {} """
+    if template is None:
+        return shlex.split(line)
+    return [token.replace("{}", line) for token in shlex.split(template)]
+
+def run_batch(batch_args: argparse.Namespace, runner: CommandRunner = None) -> int:
+    """ run every batch line in this process, returning the number of failed commands """
+    runner = runner or CommandRunner()
+    num_run, failed = 0, []
+    for line in iter_batch_lines(batch_args):
+        command, *command_args = get_batch_command(line, batch_args.template)
+        num_run += 1
+        print(f"[batch {num_run}] {shlex.join([command, *command_args])}", flush=True)
+        try:
+            runner.run(command, command_args, assume_yes=True)
+        except (Exception, SystemExit) as err:
+            # argparse exits on bad options - that shouldn't end the whole batch either
+            if isinstance(err, SystemExit) and err.code in (0, None):
+                continue
+            failed.append(line)
+            traceback.print_exc()
+            if batch_args.stop_on_error:
+                break
+    print(f"batch finished: {num_run - len(failed)} of {num_run} commands succeeded")
+    for line in failed:
+        print(f"  FAILED: {line}")
+    return len(failed)
+
+
+def main(argv: list = None):
+    args = build_parser().parse_args(argv)
+    if args.command == "batch":
+        sys.exit(1 if run_batch(build_batch_parser().parse_args(args.command_args)) else 0)
+    CommandRunner().run(args.command, args.command_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import os
+import json
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+""" find (and optionally quarantine) near-duplicate frames across the videos/<id>/frames tree using perceptual hashes
+    hashes are computed in bulk with NumPy and indexed in a multi-index hash table, so each lookup only touches a few buckets instead of every frame
+"""
+
+HASH_SIZE = 8 # hashes are HASH_SIZE**2 = 64 bits
+THUMBNAIL_SIZE = 32
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+QUARANTINE_DIRNAME = "duplicates"
+# thumbnails converted to float at once when hashing - the full stack stays uint8
+HASH_CHUNK_SIZE = 4096
+
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Find near-duplicate frames within and across videos using perceptual hashes.")
+    parser.add_argument('root_dir', type=str, help='root directory containing <video_id>/frames subdirectories')
+    parser.add_argument('--hash', type=str, default='dhash', choices=['dhash', 'phash'], help='perceptual hash to compare frames with')
+    parser.add_argument('--radius', type=int, default=4, help='max Hamming distance (out of 64 bits) for two frames to count as duplicates')
+    parser.add_argument('--scope', type=str, default='video', choices=['video', 'all'], help="compare frames only within each video or across all videos")
+    parser.add_argument('--report', type=str, default=None, help='path for the JSON report of duplicates (default: root_dir/duplicate_frames.json)')
+    parser.add_argument('--quarantine', action='store_true', help=f"move duplicates into a '{QUARANTINE_DIRNAME}' subdirectory of their frames directory")
+    parser.add_argument('--workers', type=int, default=8, help='threads used to load thumbnails')
+    args = parser.parse_args()
+    if args.radius < 0:
+        parser.error(f"--radius must be at least 0 (got {args.radius})")
+    return args
+
+
+def get_frame_sort_key(filename: str):
+    """ frames are named like [<video_id>_]frame_<ms>.png - sort by timestamp when there is one """
+    stem = os.path.splitext(filename)[0]
+    suffix = stem.split('_')[-1]
+    return (0, int(suffix), filename) if suffix.isdigit() else (1, 0, filename)
+
+def find_frames(root_dir: str) -> list:
+    """ get (video_id, frame_path) for every frame in root_dir/<video_id>/frames, in video then timestamp order """
+    frames = []
+    with os.scandir(root_dir) as video_entries:
+        video_dirs = sorted(entry.name for entry in video_entries if entry.is_dir())
+    for video_id in video_dirs:
+        frames_dir = os.path.join(root_dir, video_id, 'frames')
+        if not os.path.isdir(frames_dir):
+            continue
+        with os.scandir(frames_dir) as entries:
+            filenames = [entry.name for entry in entries if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTS)]
+        frames.extend((video_id, os.path.join(frames_dir, f)) for f in sorted(filenames, key=get_frame_sort_key))
+    return frames
+
+
+def load_thumbnail(path: str) -> np.ndarray:
+    # decoding at reduced size is much cheaper than decoding the full frame and resizing afterwards
+    image = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if image is None:
+        raise IOError(f"Could not read image at {path}")
+    return cv2.resize(image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+
+def load_thumbnails(paths, workers: int = 8) -> np.ndarray:
+    """ (N, THUMBNAIL_SIZE, THUMBNAIL_SIZE) uint8 stack of grayscale thumbnails (1 KiB per frame) """
+    thumbnails = np.empty((len(paths), THUMBNAIL_SIZE, THUMBNAIL_SIZE), dtype=np.uint8)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for idx, thumbnail in enumerate(tqdm(executor.map(load_thumbnail, paths), total=len(paths), desc="Loading thumbnails")):
+            thumbnails[idx] = thumbnail
+    return thumbnails
+
+
+def _area_resample_matrix(in_size: int, out_size: int) -> np.ndarray:
+    """ (out_size, in_size) matrix that area-averages a length in_size signal down to out_size samples """
+    edges = np.linspace(0, in_size, out_size + 1)
+    weights = np.zeros((out_size, in_size), dtype=np.float32)
+    for i in range(out_size):
+        for j in range(in_size):
+            weights[i, j] = max(0.0, min(edges[i+1], j+1) - max(edges[i], j))
+    return weights/weights.sum(axis=1, keepdims=True)
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """ orthonormal DCT-II matrix """
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    dct = np.cos(np.pi*(2*n + 1)*k/(2*size))*np.sqrt(2/size)
+    dct[0] /= np.sqrt(2)
+    return dct.astype(np.float32)
+
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    """ (N, 64) boolean array -> (N,) uint64 hashes """
+    return np.packbits(bits.reshape(len(bits), -1), axis=1).view('>u8').ravel().astype(np.uint64)
+
+def dhash(thumbnails: np.ndarray) -> np.ndarray:
+    """ difference hash: sign of horizontal gradients on an 8x9 downsampling, for a whole stack at once """
+    rows = _area_resample_matrix(THUMBNAIL_SIZE, HASH_SIZE)
+    cols = _area_resample_matrix(THUMBNAIL_SIZE, HASH_SIZE + 1)
+    small = np.einsum('ij,njk,lk->nil', rows, thumbnails.astype(np.float32), cols)
+    return pack_bits(small[:, :, 1:] > small[:, :, :-1])
+
+def phash(thumbnails: np.ndarray) -> np.ndarray:
+    """ DCT hash: low-frequency DCT coefficients compared to their median, for a whole stack at once """
+    dct = _dct_matrix(THUMBNAIL_SIZE)
+    coeffs = np.einsum('ij,njk,lk->nil', dct, thumbnails.astype(np.float32), dct)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(thumbnails), -1)
+    # leave out the DC term, which only reflects overall brightness
+    medians = np.median(coeffs[:, 1:], axis=1, keepdims=True)
+    return pack_bits(coeffs > medians)
+
+def compute_hashes(thumbnails: np.ndarray, method: str = "dhash", chunk_size: int = HASH_CHUNK_SIZE) -> np.ndarray:
+    """ hash a uint8 thumbnail stack chunk by chunk, so only one chunk at a time is held as float32 """
+    hash_fn = dhash if method == "dhash" else phash
+    hashes = np.empty(len(thumbnails), dtype=np.uint64)
+    for start in range(0, len(thumbnails), chunk_size):
+        hashes[start:start + chunk_size] = hash_fn(thumbnails[start:start + chunk_size])
+    return hashes
+
+# number of set bits for every byte value, for vectorized popcounts
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def hamming_distances(hash_value: int, hashes: np.ndarray) -> np.ndarray:
+    xor = np.bitwise_xor(hashes, np.uint64(hash_value))
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(len(hashes), 8).sum(axis=1)
+
+
+class MultiIndexHashTable:
+    """ multi-index hashing for Hamming radius queries on 64-bit hashes
+        the hash is split into radius + 1 chunks; by the pigeonhole principle, any hash within the radius matches the query exactly on at least one chunk,
+        so only the buckets sharing a chunk with the query need to be checked
+    """
+    def __init__(self, radius: int, num_bits: int = HASH_SIZE**2):
+        self.radius = radius
+        num_chunks = min(radius + 1, num_bits)
+        bounds = np.linspace(0, num_bits, num_chunks + 1).astype(int)
+        self.chunks = [(int(start), (1 << int(end - start)) - 1) for start, end in zip(bounds[:-1], bounds[1:])]
+        self.tables = [{} for _ in self.chunks]
+        # preallocated and grown by doubling so candidates can be gathered with one fancy index
+        self.hashes = np.empty(1024, dtype=np.uint64)
+        self.items = []
+
+    def _chunk_values(self, hash_value: int):
+        return [(hash_value >> shift) & mask for shift, mask in self.chunks]
+
+    def add(self, hash_value: int, item):
+        idx = len(self.items)
+        if idx == len(self.hashes):
+            self.hashes = np.concatenate([self.hashes, np.empty_like(self.hashes)])
+        self.hashes[idx] = hash_value
+        self.items.append(item)
+        for table, chunk in zip(self.tables, self._chunk_values(hash_value)):
+            table.setdefault(chunk, []).append(idx)
+
+    def query(self, hash_value: int) -> list:
+        """ get (item, distance) for every stored hash within the radius of hash_value, closest first """
+        candidates = set()
+        for table, chunk in zip(self.tables, self._chunk_values(hash_value)):
+            candidates.update(table.get(chunk, ()))
+        if len(candidates) == 0:
+            return []
+        candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        distances = hamming_distances(hash_value, self.hashes[candidates])
+        matches = np.argsort(distances, kind="stable")
+        return [(self.items[candidates[i]], int(distances[i])) for i in matches if distances[i] <= self.radius]
+
+
+def find_duplicates(frames: list, hashes: np.ndarray, radius: int, scope: str = "video") -> list:
+    """ greedily keep frames in order, marking each frame within the radius of an already kept frame as its duplicate
+        comparing against kept frames only (rather than chaining duplicates of duplicates) keeps slowly drifting scenes from collapsing into one frame
+    """
+    indices = {}
+    duplicates = []
+    for (video_id, path), hash_value in zip(tqdm(frames, desc="Querying hash index"), hashes.tolist()):
+        key = video_id if scope == "video" else None
+        # not setdefault - that would build (and throw away) a table with preallocated arrays for every frame
+        if key not in indices:
+            indices[key] = MultiIndexHashTable(radius)
+        index = indices[key]
+        matches = index.query(hash_value)
+        if len(matches) > 0:
+            (kept_video, kept_path), distance = matches[0]
+            duplicates.append({"video_id": video_id, "path": path, "duplicate_of": kept_path, "duplicate_of_video": kept_video, "distance": distance})
+        else:
+            index.add(hash_value, (video_id, path))
+    return duplicates
+
+def quarantine_duplicates(duplicates: list):
+    """ move each duplicate into the quarantine subdirectory of its frames directory, recording where it went as its 'quarantined_path' """
+    for duplicate in duplicates:
+        quarantine_dir = os.path.join(os.path.dirname(duplicate["path"]), QUARANTINE_DIRNAME)
+        os.makedirs(quarantine_dir, exist_ok=True)
+        duplicate["quarantined_path"] = shutil.move(duplicate["path"], os.path.join(quarantine_dir, os.path.basename(duplicate["path"])))
+
+
+if __name__ == "__main__":
+    args = read_cli()
+    if not os.path.isdir(args.root_dir):
+        raise NotADirectoryError(f"{args.root_dir} is not a directory.")
+    frames = find_frames(args.root_dir)
+    print(f"found {len(frames)} frames in {len({video_id for video_id, _ in frames})} videos")
+    thumbnails = load_thumbnails([path for _, path in frames], args.workers)
+    hashes = compute_hashes(thumbnails, args.hash)
+    duplicates = find_duplicates(frames, hashes, args.radius, args.scope)
+    num_cross_video = sum(d["video_id"] != d["duplicate_of_video"] for d in duplicates)
+    print(f"{len(duplicates)} near-duplicate frames ({num_cross_video} across videos); {len(frames) - len(duplicates)} unique frames")
+    # quarantined first, so the report says where each duplicate ended up
+    if args.quarantine:
+        quarantine_duplicates(duplicates)
+        print(f"moved {len(duplicates)} duplicates into '{QUARANTINE_DIRNAME}' subdirectories")
+    report_path = args.report or os.path.join(args.root_dir, "duplicate_frames.json")
+    with open(report_path, 'w') as fptr:
+        json.dump({"hash": args.hash, "radius": args.radius, "scope": args.scope, "num_frames": len(frames), "duplicates": duplicates}, fptr, indent=4)
+    print(f"report written to {report_path}")
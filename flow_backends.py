@@ -0,0 +1,52 @@
+import numpy as np
+
+""" optical flow backends for motion blur estimation - all return flow as a (2, H, W) float32 array of (row, col) displacements like skimage """
+
+FLOW_BACKENDS = ["tvl1", "dis", "farneback", "coarse"]
+# number of 2x downsampling levels for the coarse-to-fine backend (flow is computed at 1/2**levels resolution)
+COARSE_LEVELS = 2
+
+
+def _to_uint8(image: np.ndarray) -> np.ndarray:
+    """ OpenCV's flow methods want 8-bit grayscale images """
+    return (np.clip(image, 0, 1) * 255).round().astype(np.uint8)
+
+def _from_opencv_flow(flow: np.ndarray) -> np.ndarray:
+    # OpenCV returns HxWx2 (dx, dy); reorder to (2, H, W) as (dy, dx) to match skimage
+    return np.ascontiguousarray(np.moveaxis(flow[..., ::-1], -1, 0), dtype=np.float32)
+
+def flow_tvl1(prev_image: np.ndarray, image: np.ndarray) -> np.ndarray:
+    from skimage.registration import optical_flow_tvl1
+    return optical_flow_tvl1(prev_image, image, attachment=10, prefilter=True, num_iter=20).astype(np.float32)
+
+def flow_dis(prev_image: np.ndarray, image: np.ndarray) -> np.ndarray:
+    import cv2
+    dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_FAST)
+    return _from_opencv_flow(dis.calc(_to_uint8(prev_image), _to_uint8(image), None))
+
+def flow_farneback(prev_image: np.ndarray, image: np.ndarray) -> np.ndarray:
+    import cv2
+    # positional args: flow, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags
+    flow = cv2.calcOpticalFlowFarneback(_to_uint8(prev_image), _to_uint8(image), None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    return _from_opencv_flow(flow)
+
+def flow_coarse(prev_image: np.ndarray, image: np.ndarray, levels: int = COARSE_LEVELS) -> np.ndarray:
+    """ TV-L1 on a downsampled level of the image pyramid, with the flow upsampled (and its vectors rescaled) to full resolution """
+    import cv2
+    height, width = image.shape[:2]
+    for _ in range(levels):
+        prev_image, image = cv2.pyrDown(prev_image), cv2.pyrDown(image)
+    flow = flow_tvl1(prev_image, image)
+    scale_y, scale_x = height/image.shape[0], width/image.shape[1]
+    upsampled = np.empty((2, height, width), dtype=np.float32)
+    upsampled[0] = cv2.resize(flow[0], (width, height), interpolation=cv2.INTER_LINEAR) * scale_y
+    upsampled[1] = cv2.resize(flow[1], (width, height), interpolation=cv2.INTER_LINEAR) * scale_x
+    return upsampled
+
+
+def compute_flow(prev_image: np.ndarray, image: np.ndarray, backend: str = "tvl1") -> np.ndarray:
+    """ optical flow from prev_image to image (grayscale floats in [0,1]) """
+    backends = {"tvl1": flow_tvl1, "dis": flow_dis, "farneback": flow_farneback, "coarse": flow_coarse}
+    if backend not in backends:
+        raise ValueError(f"Unknown optical flow backend '{backend}'; expected one of {FLOW_BACKENDS}")
+    return backends[backend](prev_image, image)
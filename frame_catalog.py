@@ -0,0 +1,304 @@
+import os
+import time
+import sqlite3
+import argparse
+from frame_shards import IMAGE_EXTS, find_frame_dirs, get_frame_timestamp, guess_video_id
+from output_cache import hash_file, hash_params, scan_file_stats
+
+""" persistent SQLite catalog of frame files - one row per frame (video id, timestamp, path, size, mtime, content hash) plus its processing state per stage
+    tools query sorted frame ranges and unprocessed frames with indexed lookups instead of listing directories and parsing filenames every run
+    filled incrementally: a directory is only listed again if its mtime changed (a file was added, removed, or renamed), and then only files whose size or mtime
+    changed are updated - use rescan to catch files that were rewritten in place, which doesn't touch the directory's mtime
+"""
+
+DEFAULT_CATALOG_NAME = "frame_catalog.sqlite"
+# number of state updates buffered between commits
+FLUSH_INTERVAL = 500
+STATE_DONE = "done"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    dir TEXT PRIMARY KEY,
+    video_id TEXT,
+    mtime_ns INTEGER NOT NULL,
+    scanned_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    video_id TEXT,
+    timestamp INTEGER,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT,
+    UNIQUE (dir, name)
+);
+CREATE INDEX IF NOT EXISTS frames_by_video ON frames (video_id, timestamp);
+CREATE INDEX IF NOT EXISTS frames_by_dir ON frames (dir, timestamp);
+CREATE TABLE IF NOT EXISTS frame_states (
+    frame_id INTEGER NOT NULL REFERENCES frames (id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    state TEXT NOT NULL,
+    params_hash TEXT,
+    updated_at REAL NOT NULL,
+    output_path TEXT,
+    output_size INTEGER,
+    output_mtime_ns INTEGER,
+    PRIMARY KEY (frame_id, stage)
+);
+CREATE INDEX IF NOT EXISTS frame_states_by_stage ON frame_states (stage, state, params_hash);
+"""
+# columns added after the first version of the schema - added to existing catalogs when they're opened
+ADDED_COLUMNS = {"frame_states": [("output_path", "TEXT"), ("output_size", "INTEGER"), ("output_mtime_ns", "INTEGER")]}
+
+
+def add_catalog_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--catalog', type=str, default=None, help=f'SQLite frame catalog (e.g. {DEFAULT_CATALOG_NAME}) used to list frames instead of scanning directories')
+
+
+class FrameCatalog:
+    """ connection to a catalog database - created on first use, safe to share between runs and tools (one writer at a time) """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        # WAL lets readers (e.g. a query from another process) run while a tool is recording states
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+            for name, column_type in columns:
+                if name not in existing:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def scan(self, frames_dir: str, video_id: str = None, rescan: bool = False) -> dict:
+        """ bring the rows for one frames directory up to date - returns the number of added, updated, removed, and unchanged frames """
+        frames_dir = os.path.abspath(frames_dir)
+        video_id = video_id or guess_video_id(frames_dir)
+        # stat the directory before listing it, so a file added mid-scan makes the next scan look again
+        dir_mtime = os.stat(frames_dir).st_mtime_ns
+        row = self.conn.execute("SELECT mtime_ns, video_id FROM dirs WHERE dir = ?", (frames_dir,)).fetchone()
+        if row is not None and row["mtime_ns"] == dir_mtime and row["video_id"] == video_id and not rescan:
+            return {"added": 0, "updated": 0, "removed": 0, "unchanged": self.count(frames_dir), "skipped": True}
+        known = {row["name"]: (row["id"], row["size"], row["mtime_ns"])
+                 for row in self.conn.execute("SELECT id, name, size, mtime_ns FROM frames WHERE dir = ?", (frames_dir,))}
+        with os.scandir(frames_dir) as entries:
+            current = {entry.name: entry.stat() for entry in entries if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTS)}
+        added = [(frames_dir, name, video_id, get_frame_timestamp(name), stat.st_size, stat.st_mtime_ns) for name, stat in current.items() if name not in known]
+        changed = [(stat.st_size, stat.st_mtime_ns, known[name][0]) for name, stat in current.items()
+                   if name in known and (stat.st_size, stat.st_mtime_ns) != known[name][1:]]
+        removed = [(frame_id,) for name, (frame_id, _, _) in known.items() if name not in current]
+        with self.conn:
+            self.conn.executemany("INSERT INTO frames (dir, name, video_id, timestamp, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)", added)
+            # a changed file invalidates its content hash and everything that was produced from it
+            self.conn.executemany("UPDATE frames SET size = ?, mtime_ns = ?, sha1 = NULL WHERE id = ?", changed)
+            self.conn.executemany("DELETE FROM frame_states WHERE frame_id = ?", [(frame_id,) for _, _, frame_id in changed])
+            self.conn.executemany("DELETE FROM frames WHERE id = ?", removed)
+            self.conn.execute("UPDATE frames SET video_id = ? WHERE dir = ? AND video_id IS NOT ?", (video_id, frames_dir, video_id))
+            self.conn.execute("INSERT OR REPLACE INTO dirs (dir, video_id, mtime_ns, scanned_at) VALUES (?, ?, ?, ?)", (frames_dir, video_id, dir_mtime, time.time()))
+        return {"added": len(added), "updated": len(changed), "removed": len(removed), "unchanged": len(current) - len(added) - len(changed), "skipped": False}
+
+    def scan_tree(self, src_dir: str, rescan: bool = False) -> dict:
+        """ scan a single frames directory or every <id>/frames directory under a videos tree - returns the summed counts and the number of directories skipped """
+        totals = {"dirs": 0, "skipped": 0, "added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        for video_id, frames_dir in find_frame_dirs(src_dir):
+            counts = self.scan(frames_dir, video_id, rescan)
+            totals["dirs"] += 1
+            totals["skipped"] += counts.pop("skipped")
+            for key, value in counts.items():
+                totals[key] += value
+        return totals
+
+    def update_hashes(self, frames_dir: str = None) -> int:
+        """ compute the missing content hashes (of one directory, or the whole catalog) - returns the number hashed """
+        query, params = "SELECT id, dir, name FROM frames WHERE sha1 IS NULL", ()
+        if frames_dir is not None:
+            query, params = query + " AND dir = ?", (os.path.abspath(frames_dir),)
+        rows = self.conn.execute(query, params).fetchall()
+        with self.conn:
+            self.conn.executemany("UPDATE frames SET sha1 = ? WHERE id = ?", [(hash_file(os.path.join(row["dir"], row["name"])), row["id"]) for row in rows])
+        return len(rows)
+
+    def count(self, frames_dir: str = None) -> int:
+        if frames_dir is None:
+            return self.conn.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+        return self.conn.execute("SELECT COUNT(*) FROM frames WHERE dir = ?", (os.path.abspath(frames_dir),)).fetchone()[0]
+
+    def get_frames(self, frames_dir: str = None, video_id: str = None, start: int = None, end: int = None, ext: str = None,
+                   pending_stage: str = None, params_hash: str = None, limit: int = None) -> list:
+        """ frame rows in timestamp order (frames without a timestamp first, by name), optionally only a [start, end] millisecond range
+            ext is an extension like '.png' or a tuple of them to match any of
+            with pending_stage, only frames that aren't done for that stage - with the parameters of params_hash, or with any parameters if it's None
+        """
+        query = "SELECT f.* FROM frames f"
+        conditions, params = [], []
+        if pending_stage is not None:
+            query += " LEFT JOIN frame_states s ON s.frame_id = f.id AND s.stage = ?"
+            params.append(pending_stage)
+            if params_hash is None:
+                conditions.append("(s.frame_id IS NULL OR s.state != ?)")
+                params.append(STATE_DONE)
+            else:
+                conditions.append("(s.frame_id IS NULL OR s.state != ? OR s.params_hash IS NOT ?)")
+                params.extend([STATE_DONE, params_hash])
+        for condition, value in [("f.dir = ?", frames_dir and os.path.abspath(frames_dir)), ("f.video_id = ?", video_id),
+                                 ("f.timestamp >= ?", start), ("f.timestamp <= ?", end)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if ext is not None:
+            exts = (ext,) if isinstance(ext, str) else tuple(ext)
+            conditions.append("(" + " OR ".join(["f.name LIKE ?"]*len(exts)) + ")")
+            params.extend(f"%{e}" for e in exts)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY f.timestamp, f.name"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self.conn.execute(query, params).fetchall()
+
+    def get_paths(self, frames_dir: str = None, **kwargs) -> list:
+        """ paths of the frames get_frames would return """
+        return [os.path.join(row["dir"], row["name"]) for row in self.get_frames(frames_dir, **kwargs)]
+
+    def set_states(self, paths: list, stage: str, state: str = STATE_DONE, params_hash: str = None, output_paths: list = None):
+        """ record the state of each frame (given by path) for a stage - paths that aren't in the catalog are ignored
+            with output_paths (one per path), the size and mtime of each output are stored too, so a deleted or replaced output can be noticed
+        """
+        now = time.time()
+        outputs = []
+        for output_path in output_paths or [None]*len(paths):
+            stat = os.stat(output_path) if output_path is not None else None
+            outputs.append((output_path and os.path.abspath(output_path), stat and stat.st_size, stat and stat.st_mtime_ns))
+        rows = [(stage, state, params_hash, now, *output, os.path.dirname(os.path.abspath(path)), os.path.basename(path)) for path, output in zip(paths, outputs)]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO frame_states (frame_id, stage, state, params_hash, updated_at, output_path, output_size, output_mtime_ns) "
+                                  "SELECT id, ?, ?, ?, ?, ?, ?, ? FROM frames WHERE dir = ? AND name = ?", rows)
+
+    def refresh(self, paths: list):
+        """ take the current size and mtime of frames that a tool rewrote itself (e.g. postprocessing in place), keeping their states """
+        rows = []
+        for path in paths:
+            stat = os.stat(path)
+            rows.append((stat.st_size, stat.st_mtime_ns, os.path.dirname(os.path.abspath(path)), os.path.basename(path)))
+        with self.conn:
+            self.conn.executemany("UPDATE frames SET size = ?, mtime_ns = ?, sha1 = NULL WHERE dir = ? AND name = ?", rows)
+
+    def get_stage(self, stage: str, params: dict) -> "CatalogStage":
+        return CatalogStage(self, stage, params)
+
+    def summary(self) -> dict:
+        states = self.conn.execute("SELECT stage, state, COUNT(*) AS frames FROM frame_states GROUP BY stage, state").fetchall()
+        return {"dirs": self.conn.execute("SELECT COUNT(*) FROM dirs").fetchone()[0],
+                "videos": self.conn.execute("SELECT COUNT(DISTINCT video_id) FROM frames").fetchone()[0],
+                "frames": self.count(),
+                "hashed": self.conn.execute("SELECT COUNT(*) FROM frames WHERE sha1 IS NOT NULL").fetchone()[0],
+                "states": {f"{row['stage']}/{row['state']}": row["frames"] for row in states}}
+
+
+class CatalogStage:
+    """ processing state of one stage with one set of parameters - record/save mirror output_cache.OutputCache, so it can stand in for it """
+    def __init__(self, catalog: FrameCatalog, stage: str, params: dict):
+        self.catalog = catalog
+        self.stage = stage
+        self.params_hash = hash_params(params)
+        self.pending = []
+
+    def get_pending_paths(self, frames_dir: str, limit: int = None) -> list:
+        """ paths of the frames that aren't done with these parameters, plus those whose recorded output is missing or no longer matches - at most limit of them """
+        paths = self.catalog.get_paths(frames_dir, pending_stage=self.stage, params_hash=self.params_hash, limit=limit)
+        # the stale ones need their outputs checked, which is only worth it if the limit isn't already filled
+        if limit is None or len(paths) < limit:
+            paths += self.get_stale_paths(frames_dir)
+        return paths[:limit]
+
+    def get_stale_paths(self, frames_dir: str) -> list:
+        """ paths of done frames whose output was deleted or changed since it was recorded (like output_cache.OutputCache.is_fresh) """
+        rows = self.catalog.conn.execute("SELECT f.dir, f.name, s.output_path, s.output_size, s.output_mtime_ns FROM frames f "
+                                         "JOIN frame_states s ON s.frame_id = f.id AND s.stage = ? WHERE f.dir = ? AND s.state = ? AND s.params_hash IS ? "
+                                         "ORDER BY f.timestamp, f.name", (self.stage, os.path.abspath(frames_dir), STATE_DONE, self.params_hash)).fetchall()
+        # one scandir per output directory rather than looking up each output by path
+        output_stats = {output_dir: scan_file_stats(output_dir) for output_dir in {os.path.dirname(row["output_path"]) for row in rows if row["output_path"]}}
+        stale = []
+        for row in rows:
+            # a state recorded without its output can't be verified, so its frame is processed again
+            stat = output_stats[os.path.dirname(row["output_path"])].get(os.path.basename(row["output_path"])) if row["output_path"] else None
+            if stat is None or (stat.st_size, stat.st_mtime_ns) != (row["output_size"], row["output_mtime_ns"]):
+                stale.append(os.path.join(row["dir"], row["name"]))
+        return stale
+
+    def record(self, input_path: str, output_path: str):
+        self.pending.append((input_path, output_path))
+        if len(self.pending) >= FLUSH_INTERVAL:
+            self.save()
+
+    def save(self):
+        if not self.pending:
+            return
+        # a frame processed in place has a new size and mtime, which the next scan mustn't mistake for a changed input
+        self.catalog.refresh([input_path for input_path, output_path in self.pending if os.path.abspath(input_path) == os.path.abspath(output_path)])
+        self.catalog.set_states([input_path for input_path, _ in self.pending], self.stage, STATE_DONE, self.params_hash,
+                                [output_path for _, output_path in self.pending])
+        self.pending = []
+
+
+def add_args(parser: argparse.ArgumentParser):
+    parser.add_argument('catalog', type=str, help='path of the catalog database (created if it does not exist)')
+    actions = parser.add_subparsers(dest='action', required=True)
+    scan = actions.add_parser('scan', help='add or update the frames of a frames directory or of every <id>/frames directory under a videos tree')
+    scan.add_argument('src_dirs', type=str, nargs='+', help='frames directories or videos root directories')
+    scan.add_argument('--rescan', action='store_true', help='list every directory even if its mtime is unchanged (catches files rewritten in place)')
+    scan.add_argument('--hash', action='store_true', help='compute content hashes of frames that do not have one yet')
+    query = actions.add_parser('query', help='print the paths of matching frames in timestamp order')
+    query.add_argument('--dir', type=str, default=None, help='only frames in this directory')
+    query.add_argument('--video_id', type=str, default=None, help='only frames of this video')
+    query.add_argument('--start', type=int, default=None, help='first timestamp in milliseconds')
+    query.add_argument('--end', type=int, default=None, help='last timestamp in milliseconds')
+    query.add_argument('--pending', type=str, default=None, metavar='STAGE', help='only frames that are not done for this stage (e.g. postprocess, deblur), with any parameters')
+    query.add_argument('--limit', type=int, default=None, help='max number of frames')
+    query.add_argument('--count', action='store_true', help='print the number of matching frames instead of their paths')
+    actions.add_parser('summary', help='print the number of directories, videos, frames, and frame states')
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Maintain and query the SQLite catalog of frame files.")
+    add_args(parser)
+    return parser.parse_args()
+
+def main(args: argparse.Namespace):
+    with FrameCatalog(args.catalog) as catalog:
+        if args.action == "scan":
+            for src_dir in args.src_dirs:
+                if not os.path.isdir(src_dir):
+                    raise NotADirectoryError(f"{src_dir} is not a directory.")
+                start = time.perf_counter()
+                totals = catalog.scan_tree(src_dir, args.rescan)
+                print(f"{src_dir}: {totals['dirs']} directories ({totals['skipped']} unchanged), {totals['added']} frames added, {totals['updated']} updated, "
+                      f"{totals['removed']} removed in {time.perf_counter() - start:.2f}s")
+            if args.hash:
+                print(f"hashed {catalog.update_hashes()} frames")
+        elif args.action == "query":
+            rows = catalog.get_frames(args.dir, args.video_id, args.start, args.end, pending_stage=args.pending, limit=args.limit)
+            if args.count:
+                print(len(rows))
+            else:
+                for row in rows:
+                    print(os.path.join(row["dir"], row["name"]))
+        else:
+            for key, value in catalog.summary().items():
+                print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main(read_cli())
@@ -0,0 +1,251 @@
+import math
+import numpy as np
+
+""" headless decode backends for frame extraction - these decode the video directly instead of rendering it in a player and taking snapshots """
+
+DECODE_BACKENDS = ["opencv", "pyav"]
+# if the next requested frame is further away than this (in milliseconds), seek to the preceding keyframe rather than decoding through the gap
+SEEK_THRESHOLD_MS = 5000
+# fallback frame rate if the container doesn't report one
+DEFAULT_FPS = 30.0
+# size of the grayscale thumbnails compared by scene-change sampling
+SCENE_THUMBNAIL_SIZE = (64, 36)
+
+
+class FrameDecoder:
+    """ base class for decode backends - yields RGB frames (HxWx3 uint8 arrays) for a schedule of timestamps in milliseconds
+        the frame returned for a timestamp t is the one on screen at t, i.e. the frame whose presentation interval [pts, pts + frame_dur) contains t
+    """
+    def __init__(self, vid_path: str):
+        self.vid_path = vid_path
+        self.frame_dur_ms = 1000/DEFAULT_FPS
+
+    def get_duration(self) -> int:
+        """ get the duration of the video in milliseconds """
+        raise NotImplementedError
+
+    def get_frame_count(self) -> int:
+        """ get the (possibly estimated) number of frames in the video """
+        return int(round(self.get_duration()/self.frame_dur_ms))
+
+    def iter_frames_at(self, frame_times):
+        """ generator of (frame_time, frame) for sorted timestamps in milliseconds - stops early if the stream ends """
+        raise NotImplementedError
+
+    def iter_sampled(self, sample_int: int):
+        """ generator of (frame_index, frame) for every sample_int-th frame, decoding sequentially
+            skipped frames are dropped as soon as they're decoded so memory use doesn't depend on the video length
+        """
+        raise NotImplementedError
+
+    def iter_keyframes(self, start_time: float, end_time: float, max_frames: int):
+        """ generator of (frame_time, frame) for only the keyframes (I-frames) between start_time and end_time, without decoding any other frames """
+        raise ValueError(f"keyframe-only sampling isn't supported by {type(self).__name__}; use the 'pyav' backend")
+
+    def _iter_decoded(self, start_time: float):
+        """ generator of (pts in ms, backend-specific frame) for every frame from start_time on """
+        raise NotImplementedError
+
+    def _to_rgb(self, frame) -> np.ndarray:
+        raise NotImplementedError
+
+    def _to_thumbnail(self, frame) -> np.ndarray:
+        """ small grayscale uint8 version of the frame for cheap frame differencing """
+        raise NotImplementedError
+
+    def iter_scene_changes(self, start_time: float, end_time: float, threshold: float, max_frames: int):
+        """ generator of (frame_time, frame) emitting a frame whenever it differs from the last emitted frame by more than threshold
+            the difference is the mean absolute difference (in gray levels, 0-255) between downscaled grayscale thumbnails
+        """
+        last_thumbnail = None
+        num_emitted = 0
+        for pts, frame in self._iter_decoded(start_time):
+            if pts > end_time or num_emitted >= max_frames:
+                return
+            if pts < start_time:
+                continue
+            thumbnail = self._to_thumbnail(frame).astype(np.int16)
+            if last_thumbnail is None or np.mean(np.abs(thumbnail - last_thumbnail)) > threshold:
+                last_thumbnail = thumbnail
+                num_emitted += 1
+                yield ms_timestamp(pts), self._to_rgb(frame)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class OpenCVDecoder(FrameDecoder):
+    """ decode backend using OpenCV's VideoCapture - frames are grabbed (decoded) sequentially and only converted to RGB when requested """
+    def __init__(self, vid_path: str):
+        super().__init__(vid_path)
+        import cv2
+        self.cv2 = cv2
+        self.cap = cv2.VideoCapture(vid_path)
+        if not self.cap.isOpened():
+            raise ValueError(f"Could not open the video at {vid_path}")
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.frame_dur_ms = 1000/(fps if fps > 0 else DEFAULT_FPS)
+
+    def get_duration(self) -> int:
+        duration = int(self.cap.get(self.cv2.CAP_PROP_FRAME_COUNT) * self.frame_dur_ms)
+        if duration <= 0:
+            raise ValueError("Could not retrieve video duration.")
+        return duration
+
+    def iter_frames_at(self, frame_times):
+        pts = None # timestamp of the most recently grabbed frame
+        for frame_time in frame_times:
+            if pts is None or frame_time - pts > SEEK_THRESHOLD_MS:
+                # OpenCV's ffmpeg backend seeks to the preceding keyframe then decodes forward; back off a couple frames to land before the target
+                self.cap.set(self.cv2.CAP_PROP_POS_MSEC, max(frame_time - 2*self.frame_dur_ms, 0))
+                pts = None
+            # grab() decodes without the color conversion of retrieve(), so skipped frames stay cheap
+            while pts is None or pts + self.frame_dur_ms <= frame_time:
+                if not self.cap.grab():
+                    return
+                pts = self.cap.get(self.cv2.CAP_PROP_POS_MSEC)
+            ok, frame = self.cap.retrieve()
+            if not ok:
+                return
+            yield frame_time, self.cv2.cvtColor(frame, self.cv2.COLOR_BGR2RGB)
+
+    def get_frame_count(self) -> int:
+        frame_count = int(self.cap.get(self.cv2.CAP_PROP_FRAME_COUNT))
+        return frame_count if frame_count > 0 else super().get_frame_count()
+
+    def iter_sampled(self, sample_int: int):
+        self.cap.set(self.cv2.CAP_PROP_POS_FRAMES, 0)
+        idx = 0
+        while self.cap.grab():
+            if idx % sample_int == 0:
+                ok, frame = self.cap.retrieve()
+                if not ok:
+                    return
+                yield idx, self.cv2.cvtColor(frame, self.cv2.COLOR_BGR2RGB)
+            idx += 1
+
+    def _iter_decoded(self, start_time: float):
+        self.cap.set(self.cv2.CAP_PROP_POS_MSEC, max(start_time - 2*self.frame_dur_ms, 0))
+        # OpenCV can't hand out a frame without converting it, so every frame is retrieved here
+        while self.cap.grab():
+            pts = self.cap.get(self.cv2.CAP_PROP_POS_MSEC)
+            ok, frame = self.cap.retrieve()
+            if not ok:
+                return
+            yield pts, frame
+
+    def _to_rgb(self, frame) -> np.ndarray:
+        return self.cv2.cvtColor(frame, self.cv2.COLOR_BGR2RGB)
+
+    def _to_thumbnail(self, frame) -> np.ndarray:
+        return self.cv2.resize(self.cv2.cvtColor(frame, self.cv2.COLOR_BGR2GRAY), SCENE_THUMBNAIL_SIZE, interpolation=self.cv2.INTER_AREA)
+
+    def close(self):
+        self.cap.release()
+
+
+class PyAVDecoder(FrameDecoder):
+    """ decode backend using PyAV (ffmpeg bindings) - allows threaded decoding and keyframe seeking on the stream's own time base """
+    def __init__(self, vid_path: str):
+        super().__init__(vid_path)
+        import av
+        self.container = av.open(vid_path)
+        self.stream = self.container.streams.video[0]
+        # let ffmpeg decode on multiple threads
+        self.stream.thread_type = "AUTO"
+        if self.stream.average_rate:
+            self.frame_dur_ms = 1000/float(self.stream.average_rate)
+        self.start_pts = self.stream.start_time or 0
+
+    def get_duration(self) -> int:
+        if self.stream.duration is not None:
+            duration = int(float(self.stream.duration * self.stream.time_base) * 1000)
+        elif self.container.duration is not None:
+            # container duration is in microseconds (AV_TIME_BASE)
+            duration = int(self.container.duration/1000)
+        else:
+            duration = 0
+        if duration <= 0:
+            raise ValueError("Could not retrieve video duration.")
+        return duration
+
+    def _pts_to_ms(self, pts: int) -> float:
+        return float((pts - self.start_pts) * self.stream.time_base) * 1000
+
+    def _seek(self, frame_time: float):
+        offset = self.start_pts + int(frame_time/1000/self.stream.time_base)
+        self.container.seek(offset, stream=self.stream, backward=True, any_frame=False)
+        return self.container.decode(self.stream)
+
+    def iter_frames_at(self, frame_times):
+        frames = None
+        current, pts = None, None
+        for frame_time in frame_times:
+            if pts is None or frame_time - pts > SEEK_THRESHOLD_MS:
+                frames = self._seek(frame_time)
+                current, pts = None, None
+            # frames decoded from the keyframe up to the target are skipped without conversion
+            while pts is None or pts + self.frame_dur_ms <= frame_time:
+                current = next(frames, None)
+                if current is None:
+                    return
+                if current.pts is not None:
+                    pts = self._pts_to_ms(current.pts)
+            yield frame_time, current.to_ndarray(format="rgb24")
+
+    def get_frame_count(self) -> int:
+        return self.stream.frames if self.stream.frames > 0 else super().get_frame_count()
+
+    def iter_sampled(self, sample_int: int):
+        self.container.seek(self.start_pts, stream=self.stream, backward=True, any_frame=False)
+        for idx, frame in enumerate(self.container.decode(self.stream)):
+            if idx % sample_int == 0:
+                yield idx, frame.to_ndarray(format="rgb24")
+
+    def iter_keyframes(self, start_time: float, end_time: float, max_frames: int):
+        # have the decoder drop everything but keyframes before decoding them
+        self.stream.codec_context.skip_frame = "NONKEY"
+        try:
+            num_emitted = 0
+            for pts, frame in self._iter_decoded(start_time):
+                if pts > end_time or num_emitted >= max_frames:
+                    return
+                if pts < start_time:
+                    continue
+                num_emitted += 1
+                yield ms_timestamp(pts), frame.to_ndarray(format="rgb24")
+        finally:
+            self.stream.codec_context.skip_frame = "DEFAULT"
+
+    def _iter_decoded(self, start_time: float):
+        for frame in self._seek(start_time):
+            if frame.pts is not None:
+                yield self._pts_to_ms(frame.pts), frame
+
+    def _to_rgb(self, frame) -> np.ndarray:
+        return frame.to_ndarray(format="rgb24")
+
+    def _to_thumbnail(self, frame) -> np.ndarray:
+        # swscale does the downscaling and gray conversion in one pass, so the full frame is never converted
+        return frame.reformat(width=SCENE_THUMBNAIL_SIZE[0], height=SCENE_THUMBNAIL_SIZE[1], format="gray").to_ndarray()
+
+    def close(self):
+        self.container.close()
+
+
+def ms_timestamp(pts_ms: float) -> int:
+    """ integer millisecond timestamp for a frame - rounded up so that the frame is the one on screen at that time """
+    return math.ceil(pts_ms - 1e-6)
+
+def get_decoder(backend: str, vid_path: str) -> FrameDecoder:
+    decoders = {"opencv": OpenCVDecoder, "pyav": PyAVDecoder}
+    if backend not in decoders:
+        raise ValueError(f"Unknown decode backend '{backend}'; expected one of {DECODE_BACKENDS}")
+    return decoders[backend](vid_path)
+
@@ -0,0 +1,221 @@
+import os
+import io
+import time
+import argparse
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from perf_utils import stage_timer
+
+""" output encoders for frames - PNG (configurable level), lossless WebP, JPEG (configurable quality), or raw .npy arrays
+    frames can be CHW uint8 torch tensors (encoded with torchvision where it has an encoder) or HWC RGB uint8 numpy arrays (encoded with OpenCV)
+    both libraries release the GIL while encoding, so an EncodePool of threads encodes several frames at once
+"""
+
+OUTPUT_FORMATS = ["png", "webp", "jpeg", "npy"]
+FORMAT_EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg", "npy": ".npy"}
+
+
+@dataclass
+class EncoderOptions:
+    """ dataclass for storing the output format and its settings """
+    format: str = "png"
+    # zlib level 0-9 - higher is smaller but slower
+    png_level: int = 3
+    jpeg_quality: int = 95
+
+
+def add_encoder_args(parser: argparse.ArgumentParser, encode_workers: int = 4):
+    """ add the output format options shared by the tools that write frames """
+    parser.add_argument('--output_format', type=str, default='png', choices=OUTPUT_FORMATS, help='file format for written frames (webp is lossless)')
+    parser.add_argument('--png_level', type=int, default=3, help='PNG compression level (0-9)')
+    parser.add_argument('--jpeg_quality', type=int, default=95, help='JPEG quality (1-100)')
+    parser.add_argument('--encode_workers', type=int, default=encode_workers, help='threads encoding and writing frames in the background')
+
+def get_encoder_options(args) -> EncoderOptions:
+    """ options from a namespace (or dataclass) with output_format, png_level, and jpeg_quality attributes """
+    return EncoderOptions(args.output_format, args.png_level, args.jpeg_quality)
+
+def get_encoder_params(options: EncoderOptions) -> dict:
+    """ only the settings that affect the bytes written for the chosen format (e.g. for cache keys) """
+    params = {"output_format": options.format}
+    if options.format == "png":
+        params["png_level"] = options.png_level
+    elif options.format == "jpeg":
+        params["jpeg_quality"] = options.jpeg_quality
+    return params
+
+def get_path_format(path: str) -> str:
+    """ output format of a frame file from its extension, or None if no encoder writes that extension """
+    ext = os.path.splitext(path)[1].lower()
+    return next((fmt for fmt, fmt_ext in FORMAT_EXTENSIONS.items() if fmt_ext == ext), None)
+
+def get_output_path(path: str, options: EncoderOptions) -> str:
+    """ path with its extension replaced by the one for the output format """
+    return os.path.splitext(path)[0] + FORMAT_EXTENSIONS[options.format]
+
+
+def _is_tensor(img) -> bool:
+    return type(img).__module__.startswith("torch")
+
+def to_hwc_array(img) -> np.ndarray:
+    """ HWC numpy array from a CHW tensor (arrays are returned as they are) """
+    return img.permute(1, 2, 0).contiguous().numpy() if _is_tensor(img) else img
+
+def _cv2_encode(ext: str, img: np.ndarray, params: list) -> bytes:
+    import cv2
+    # OpenCV expects BGR channel order
+    ok, buffer = cv2.imencode(ext, cv2.cvtColor(img, cv2.COLOR_RGB2BGR), params)
+    if not ok:
+        raise IOError(f"OpenCV could not encode the frame as {ext}")
+    return buffer.tobytes()
+
+def encode_frame(img, options: EncoderOptions) -> bytes:
+    """ encode a CHW uint8 tensor or HWC RGB uint8 array to the bytes of the output file """
+    if options.format == "png":
+        if _is_tensor(img):
+            from torchvision.io import encode_png
+            return encode_png(img, compression_level=options.png_level).numpy().tobytes()
+        import cv2
+        return _cv2_encode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, options.png_level])
+    if options.format == "jpeg":
+        if _is_tensor(img):
+            from torchvision.io import encode_jpeg
+            return encode_jpeg(img, quality=options.jpeg_quality).numpy().tobytes()
+        import cv2
+        return _cv2_encode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, options.jpeg_quality])
+    if options.format == "webp":
+        import cv2
+        # a quality above 100 makes OpenCV's WebP encoder lossless
+        return _cv2_encode(".webp", to_hwc_array(img), [cv2.IMWRITE_WEBP_QUALITY, 101])
+    if options.format == "npy":
+        # raw HWC RGB array, no compression
+        buffer = io.BytesIO()
+        np.save(buffer, to_hwc_array(img))
+        return buffer.getvalue()
+    raise ValueError(f"Unknown output format '{options.format}'; expected one of {OUTPUT_FORMATS}")
+
+def decode_frame(data: bytes, fmt: str, grayscale: bool = False) -> np.ndarray:
+    """ decode the bytes written by encode_frame back to an HWC RGB uint8 array (or an HW grayscale one) """
+    import cv2
+    if fmt == "npy":
+        img = np.load(io.BytesIO(data))
+        return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if grayscale else img
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+    if img is None:
+        raise IOError(f"OpenCV could not decode the {fmt} frame")
+    return img if grayscale else cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+def write_encoded_frame(img, path: str, options: EncoderOptions, stats=None) -> str:
+    """ encode and write a frame, timing the encode and write stages into stats (a perf_utils.StageStats) if given """
+    with stage_timer(stats, "encode"):
+        data = encode_frame(img, options)
+    with stage_timer(stats, "write"), open(path, 'wb') as fptr:
+        fptr.write(data)
+    return path
+
+
+class EncodePool:
+    """ encode and write frames on background threads, so the caller can keep decoding/transforming while earlier frames are encoded
+        at most max_pending frames are queued at once (submit blocks beyond that), which bounds the memory held by pending frames
+    """
+    def __init__(self, options: EncoderOptions, workers: int = 4, max_pending: int = None, stats=None):
+        self.options = options
+        self.stats = stats
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self.slots = threading.BoundedSemaphore(max_pending or 2*max(workers, 1))
+        self.futures = []
+        self.written = []
+
+    def _write(self, img, path: str, tag):
+        try:
+            write_encoded_frame(img, path, self.options, self.stats)
+            return path if tag is None else tag
+        finally:
+            self.slots.release()
+
+    def submit(self, img, path: str, tag=None):
+        """ queue a frame to be written to path (with its extension already matching the format) - re-raises errors from earlier writes
+            tag (default: the path) is what pop_written reports once the frame is on disk
+        """
+        self._collect(block=False)
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._write, img, path, tag))
+
+    def _collect(self, block: bool):
+        """ move the finished writes (all of them if block) from futures to written - a failed write doesn't stop the others from being collected,
+            so pop_written still reports every frame that made it to disk, and the first error is raised once all of them are
+        """
+        pending, error = [], None
+        for future in self.futures:
+            if not block and not future.done():
+                pending.append(future)
+                continue
+            try:
+                self.written.append(future.result())
+            except Exception as e:
+                error = error or e
+        self.futures = pending
+        if error is not None:
+            raise error
+
+    def pop_written(self) -> list:
+        """ tags of the frames written since the last call (in submission order among those collected) """
+        written, self.written = self.written, []
+        return written
+
+    def close(self):
+        """ wait for all queued frames to be written """
+        try:
+            self._collect(block=True)
+        finally:
+            self.futures = []
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark bytes per frame and encode speed of each output format.")
+    parser.add_argument('--image_dir', type=str, default=None, help='directory of sample frames (default: synthetic 1920x1080 frames)')
+    parser.add_argument('--num_frames', type=int, default=20, help='number of frames to encode per format')
+    parser.add_argument('--workers', type=int, default=4, help='encode threads')
+    parser.add_argument('--png_level', type=int, default=3, help='PNG compression level (0-9)')
+    parser.add_argument('--jpeg_quality', type=int, default=95, help='JPEG quality (1-100)')
+    parser.add_argument('--tensors', action='store_true', help='encode CHW torch tensors (torchvision encoders) instead of numpy arrays (OpenCV encoders)')
+    return parser.parse_args()
+
+def load_sample_frames(image_dir: str, num_frames: int) -> list:
+    import cv2
+    if image_dir is None:
+        # smooth gradients plus noise - roughly as compressible as real footage
+        rng = np.random.default_rng(0)
+        frames = []
+        for _ in range(num_frames):
+            base = cv2.resize(rng.integers(0, 256, (27, 48, 3), dtype=np.uint8), (1920, 1080), interpolation=cv2.INTER_CUBIC)
+            frames.append(np.clip(base.astype(np.int16) + rng.integers(-4, 5, base.shape), 0, 255).astype(np.uint8))
+        return frames
+    filenames = sorted(f for f in os.listdir(image_dir) if os.path.isfile(os.path.join(image_dir, f)))[:num_frames]
+    return [cv2.cvtColor(cv2.imread(os.path.join(image_dir, f)), cv2.COLOR_BGR2RGB) for f in filenames]
+
+
+if __name__ == "__main__":
+    args = read_cli()
+    frames = load_sample_frames(args.image_dir, args.num_frames)
+    if args.tensors:
+        import torch
+        frames = [torch.from_numpy(frame).permute(2, 0, 1).contiguous() for frame in frames]
+    print(f"{len(frames)} frames, {args.workers} encode threads, {'torch tensors' if args.tensors else 'numpy arrays'}")
+    print(f"{'format':<10}{'KiB/frame':>12}{'frames/s':>12}")
+    for fmt in OUTPUT_FORMATS:
+        options = EncoderOptions(fmt, args.png_level, args.jpeg_quality)
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            start = time.perf_counter()
+            sizes = [len(encoded) for encoded in executor.map(lambda frame: encode_frame(frame, options), frames)]
+            elapsed = time.perf_counter() - start
+        print(f"{fmt:<10}{np.mean(sizes)/1024:>12.1f}{len(frames)/elapsed:>12.1f}")
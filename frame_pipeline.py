@@ -0,0 +1,116 @@
+import queue
+import threading
+
+""" multi-stage threaded pipeline with bounded queues between stages (e.g. read -> transform -> write)
+    the heavy lifting in each stage (image decode/encode, torch ops, file I/O) releases the GIL, so threads keep all cores busy
+"""
+
+# sentinel passed down the queues to signal that a stage has no more items
+_DONE = object()
+# how often (in seconds) blocked threads wake up to check whether the pipeline was aborted
+_POLL_INTERVAL = 0.1
+
+
+class _Stage:
+    """ worker threads that apply fn to items from in_queue and pass the results to out_queue """
+    def __init__(self, fn, num_workers, in_queue, out_queue, pipeline):
+        self.fn = fn
+        self.num_workers = num_workers
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.pipeline = pipeline
+        self.num_running = num_workers
+        self.lock = threading.Lock()
+        self.next_stage = None
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+
+    def _work(self):
+        try:
+            while not self.pipeline.aborted.is_set():
+                item = self.pipeline._get(self.in_queue)
+                if item is _DONE:
+                    break
+                self.pipeline._put(self.out_queue, self.fn(item))
+        except BaseException as e:
+            self.pipeline._abort(e)
+        finally:
+            with self.lock:
+                self.num_running -= 1
+                is_last = self.num_running == 0
+            # the last worker to finish passes one sentinel per worker of the next stage (or one to the consumer)
+            if is_last:
+                num_sentinels = self.next_stage.num_workers if self.next_stage is not None else 1
+                for _ in range(num_sentinels):
+                    self.pipeline._put(self.out_queue, _DONE)
+
+
+class Pipeline:
+    """ run items through a sequence of (fn, num_workers) stages, with at most queue_size items waiting between any two stages
+        results come out of the last stage in completion order, not input order
+    """
+    def __init__(self, stages, queue_size: int = 8):
+        if len(stages) == 0:
+            raise ValueError("Pipeline needs at least one stage")
+        self.aborted = threading.Event()
+        self.error = None
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self.stages = [_Stage(fn, max(num_workers, 1), self.queues[i], self.queues[i+1], self) for i, (fn, num_workers) in enumerate(stages)]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+
+    def _abort(self, error: BaseException):
+        if not self.aborted.is_set():
+            self.error = error
+            self.aborted.set()
+
+    def _get(self, q: queue.Queue):
+        while not self.aborted.is_set():
+            try:
+                return q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _put(self, q: queue.Queue, item):
+        # blocks while the next stage is behind (backpressure) unless the pipeline is aborted
+        while not self.aborted.is_set():
+            try:
+                return q.put(item, timeout=_POLL_INTERVAL)
+            except queue.Full:
+                continue
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                if self.aborted.is_set():
+                    return
+                self._put(self.queues[0], item)
+        except BaseException as e:
+            self._abort(e)
+        finally:
+            for _ in range(self.stages[0].num_workers):
+                self._put(self.queues[0], _DONE)
+
+    def run(self, items):
+        """ generator of results from the last stage - re-raises the first exception raised by any stage """
+        feeder = threading.Thread(target=self._feed, args=(items,), daemon=True)
+        feeder.start()
+        for stage in self.stages:
+            for thread in stage.threads:
+                thread.start()
+        try:
+            while True:
+                result = self._get(self.queues[-1])
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            # stop the workers if the consumer bailed out early
+            if not self.aborted.is_set():
+                self.aborted.set()
+            feeder.join()
+            for stage in self.stages:
+                for thread in stage.threads:
+                    thread.join()
+        if self.error is not None:
+            raise self.error
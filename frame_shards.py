@@ -0,0 +1,349 @@
+import os
+import io
+import re
+import json
+import glob
+import tarfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from tqdm import tqdm
+from frame_encoders import OUTPUT_FORMATS, EncoderOptions, encode_frame, decode_frame, to_hwc_array
+from perf_utils import stage_timer
+
+""" pack frames into a few large shard files instead of thousands of small images
+    'memmap' shards hold raw fixed-shape uint8 HWC frames back to back, so a loader can slice a frame straight out of an np.memmap without copying or decoding
+    'tar' shards are WebDataset-style tars of encoded frames (with a .json per frame) for frames that don't share a shape
+    every shard has a sidecar <shard>.json index listing each frame's video id, frame_{ms} timestamp, and byte offset into the shard
+"""
+
+SHARD_FORMATS = ["memmap", "tar"]
+DEFAULT_FRAMES_PER_SHARD = 1024
+MEMMAP_EXT = ".u8"
+TAR_EXT = ".tar"
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".npy")
+# frames are named like [<video_id>_]frame_<ms>
+FRAME_NAME_PATTERN = re.compile(r"(?:^|_)frame_(\d+)$")
+
+
+def add_shard_args(parser: argparse.ArgumentParser):
+    """ add the options shared by the tools that can write frames into shards """
+    parser.add_argument('--shard_dir', type=str, default=None, help='write frames into shards in this directory instead of individual image files')
+    parser.add_argument('--shard_format', type=str, default='memmap', choices=SHARD_FORMATS, help="'memmap' for raw fixed-shape frames, 'tar' for encoded variable-size frames")
+    parser.add_argument('--frames_per_shard', type=int, default=DEFAULT_FRAMES_PER_SHARD, help='max number of frames in each shard')
+
+def get_frame_timestamp(name: str):
+    """ millisecond timestamp from a frame name like frame_<ms>[.png], or None if it doesn't have one """
+    match = FRAME_NAME_PATTERN.search(os.path.splitext(os.path.basename(name))[0])
+    return int(match.group(1)) if match else None
+
+def guess_video_id(frames_dir: str) -> str:
+    """ videos/<id>/frames -> <id>, otherwise the name of the directory itself """
+    frames_dir = os.path.abspath(frames_dir)
+    if os.path.basename(frames_dir) in ("frames", "processed"):
+        return guess_video_id(os.path.dirname(frames_dir))
+    return os.path.basename(frames_dir)
+
+
+def get_video_shard_paths(shard_dir: str, prefix: str, indexed_only: bool = True) -> list:
+    """ data files of the <prefix>-<n> shards in a directory (a video's shards, since the ripper uses the video id as the prefix) - by default only finished (indexed) ones """
+    pattern = re.compile(rf"{re.escape(prefix)}-\d+(?:{re.escape(MEMMAP_EXT)}|{re.escape(TAR_EXT)})")
+    if not os.path.isdir(shard_dir):
+        return []
+    with os.scandir(shard_dir) as entries:
+        paths = sorted(entry.path for entry in entries if pattern.fullmatch(entry.name))
+    return [path for path in paths if not indexed_only or os.path.isfile(path + ".json")]
+
+def remove_shard(shard_path: str):
+    # the index goes first, so readers never see an index without its data
+    for path in (shard_path + ".json", shard_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ShardWriter:
+    """ base class for shard writers - frames are appended to the current shard until it's full, then a new shard is started
+        shard files are claimed with exclusive creation, so several processes can write shards with the same prefix into one directory
+        submit/pop_written/close mirror frame_encoders.EncodePool so a writer can stand in for a directory of image files
+    """
+    ext = None
+
+    def __init__(self, shard_dir: str, prefix: str, frames_per_shard: int = DEFAULT_FRAMES_PER_SHARD, video_id: str = None, stats=None):
+        self.shard_dir = shard_dir
+        # optional perf_utils.StageStats for the encode and write stages
+        self.stats = stats
+        self.prefix = prefix
+        self.frames_per_shard = max(frames_per_shard, 1)
+        self.video_id = video_id or prefix
+        self.lock = threading.Lock()
+        self.fptr = None
+        self.shard_path = None
+        self.entries = []
+        self.written = []
+        self.shard_paths = []
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def _claim_shard(self):
+        """ create the next unused <prefix>-<n>.<ext> file """
+        taken = glob.glob(os.path.join(glob.escape(self.shard_dir), f"{glob.escape(self.prefix)}-*{self.ext}"))
+        shard_idx = len(taken)
+        while True:
+            path = os.path.join(self.shard_dir, f"{self.prefix}-{shard_idx:05d}{self.ext}")
+            try:
+                return path, open(path, 'xb')
+            except FileExistsError:
+                shard_idx += 1
+
+    def _open_shard(self):
+        self.shard_path, self.fptr = self._claim_shard()
+        self.entries = []
+
+    def _close_shard(self):
+        if self.fptr is None:
+            return
+        self._finish_shard()
+        self.fptr.close()
+        # the index is written last, so a shard without one was never finished and is ignored by readers
+        with open(self.shard_path + ".json", 'w') as fptr:
+            json.dump({**self._index_header(), "data": os.path.basename(self.shard_path), "frames": self.entries}, fptr)
+        self.shard_paths.append(self.shard_path)
+        self.fptr = None
+
+    def _needs_new_shard(self, frame: np.ndarray) -> bool:
+        return self.fptr is None or len(self.entries) >= self.frames_per_shard
+
+    def add(self, frame, name: str, video_id: str = None):
+        """ append a CHW tensor or HWC uint8 array to the current shard, named like frame_<ms> """
+        frame = np.ascontiguousarray(to_hwc_array(frame))
+        entry = {"video_id": video_id or self.video_id, "timestamp": get_frame_timestamp(name), "name": os.path.splitext(os.path.basename(name))[0]}
+        with stage_timer(self.stats, "encode"):
+            data = self._prepare(frame, entry)
+        with stage_timer(self.stats, "write"), self.lock:
+            if self._needs_new_shard(frame):
+                self._close_shard()
+                self._open_shard()
+            self._append(frame, data, entry)
+            self.entries.append(entry)
+
+    def submit(self, img, path: str, tag=None):
+        self.add(img, path)
+        with self.lock:
+            self.written.append(path if tag is None else tag)
+
+    def pop_written(self) -> list:
+        with self.lock:
+            written, self.written = self.written, []
+        return written
+
+    def close(self):
+        with self.lock:
+            self._close_shard()
+
+    def discard(self):
+        """ delete every shard this writer claimed, finished or not, instead of indexing the current one - for frames that were only partly written """
+        with self.lock:
+            if self.fptr is not None:
+                self.fptr.close()
+                self.shard_paths.append(self.shard_path)
+                self.fptr = None
+            for shard_path in self.shard_paths:
+                remove_shard(shard_path)
+            self.shard_paths = []
+            self.written = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # a failed run (e.g. a segment that batch_rip will retry) must not leave its frames behind, or the retry would add them a second time
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def _index_header(self) -> dict:
+        raise NotImplementedError
+
+    def _prepare(self, frame: np.ndarray, entry: dict):
+        """ per-frame work that can happen outside the lock (e.g. encoding) """
+        return None
+
+    def _append(self, frame: np.ndarray, data, entry: dict):
+        raise NotImplementedError
+
+    def _finish_shard(self):
+        pass
+
+
+class MemmapShardWriter(ShardWriter):
+    """ raw uint8 HWC frames back to back - every frame in a shard has the same shape, and a frame of a new shape starts a new shard """
+    ext = MEMMAP_EXT
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shape = None
+        self.offset = 0
+
+    def _open_shard(self):
+        super()._open_shard()
+        self.offset = 0
+
+    def _needs_new_shard(self, frame: np.ndarray) -> bool:
+        return super()._needs_new_shard(frame) or frame.shape != self.shape
+
+    def _index_header(self) -> dict:
+        return {"format": "memmap", "shape": list(self.shape), "dtype": "uint8"}
+
+    def _append(self, frame: np.ndarray, data, entry: dict):
+        self.shape = frame.shape
+        entry["offset"] = self.offset
+        self.fptr.write(frame.astype(np.uint8, copy=False).data)
+        self.offset += frame.nbytes
+
+
+class TarShardWriter(ShardWriter):
+    """ WebDataset-style tar of <video_id>__<name>.<ext> encoded frames, each with a <video_id>__<name>.json holding its metadata """
+    ext = TAR_EXT
+
+    def __init__(self, *args, options: EncoderOptions = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.options = options or EncoderOptions()
+        self.tar = None
+
+    def _open_shard(self):
+        super()._open_shard()
+        self.tar = tarfile.open(fileobj=self.fptr, mode='w')
+
+    def _finish_shard(self):
+        self.tar.close()
+
+    def _index_header(self) -> dict:
+        return {"format": "tar", "output_format": self.options.format}
+
+    def _prepare(self, frame: np.ndarray, entry: dict):
+        return encode_frame(frame, self.options)
+
+    def _add_member(self, name: str, data: bytes) -> int:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+        # the tar's offset is now past the member's data, which is padded to whole blocks
+        return self.tar.offset - -(-len(data)//tarfile.BLOCKSIZE)*tarfile.BLOCKSIZE
+
+    def _append(self, frame: np.ndarray, data: bytes, entry: dict):
+        key = f"{entry['video_id']}__{entry['name']}"
+        entry["shape"] = list(frame.shape)
+        entry["offset"] = self._add_member(f"{key}.{self.options.format}", data)
+        entry["size"] = len(data)
+        self._add_member(f"{key}.json", json.dumps({k: entry[k] for k in ("video_id", "timestamp", "name", "shape")}).encode("utf-8"))
+
+
+def get_shard_writer(shard_format: str, shard_dir: str, prefix: str, frames_per_shard: int = DEFAULT_FRAMES_PER_SHARD,
+                     video_id: str = None, options: EncoderOptions = None, stats=None) -> ShardWriter:
+    if shard_format == "memmap":
+        return MemmapShardWriter(shard_dir, prefix, frames_per_shard, video_id, stats)
+    if shard_format == "tar":
+        return TarShardWriter(shard_dir, prefix, frames_per_shard, video_id, stats, options=options)
+    raise ValueError(f"Unknown shard format '{shard_format}'; expected one of {SHARD_FORMATS}")
+
+
+class ShardReader:
+    """ random access to the frames in every finished shard of a directory
+        memmap frames come back as read-only views into the shard (no copy, no decode); tar frames are sliced out of a memmapped tar and decoded
+    """
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        self.indexes = []
+        self.frames = []
+        self.memmaps = {}
+        index_paths = [path for ext in (MEMMAP_EXT, TAR_EXT) for path in glob.glob(os.path.join(glob.escape(shard_dir), f"*{ext}.json"))]
+        for index_path in sorted(index_paths):
+            with open(index_path, 'r') as fptr:
+                index = json.load(fptr)
+            if "frames" not in index or "data" not in index:
+                continue
+            shard_idx = len(self.indexes)
+            self.indexes.append(index)
+            self.frames.extend((shard_idx, entry) for entry in index["frames"])
+        self.lookup = {(entry["video_id"], entry["timestamp"]): idx for idx, (_, entry) in enumerate(self.frames) if entry["timestamp"] is not None}
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def _memmap(self, shard_idx: int) -> np.memmap:
+        if shard_idx not in self.memmaps:
+            self.memmaps[shard_idx] = np.memmap(os.path.join(self.shard_dir, self.indexes[shard_idx]["data"]), dtype=np.uint8, mode='r')
+        return self.memmaps[shard_idx]
+
+    def get_entry(self, idx: int) -> dict:
+        return self.frames[idx][1]
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        """ HWC RGB uint8 frame """
+        shard_idx, entry = self.frames[idx]
+        index = self.indexes[shard_idx]
+        if index["format"] == "memmap":
+            shape = tuple(index["shape"])
+            return self._memmap(shard_idx)[entry["offset"]:entry["offset"] + int(np.prod(shape))].reshape(shape)
+        return decode_frame(self._memmap(shard_idx)[entry["offset"]:entry["offset"] + entry["size"]].tobytes(), index["output_format"])
+
+    def find(self, video_id: str, timestamp: int) -> np.ndarray:
+        """ frame of a video at a frame_{ms} timestamp """
+        return self[self.lookup[(video_id, timestamp)]]
+
+
+def find_frame_dirs(src_dir: str) -> list:
+    """ (video_id, frames_dir) for a single frames directory or for every <id>/frames directory under a videos tree """
+    with os.scandir(src_dir) as entries:
+        if any(entry.is_file() and entry.name.lower().endswith(IMAGE_EXTS) for entry in entries):
+            return [(guess_video_id(src_dir), src_dir)]
+    with os.scandir(src_dir) as entries:
+        video_ids = sorted(entry.name for entry in entries if entry.is_dir())
+    return [(video_id, os.path.join(src_dir, video_id, "frames")) for video_id in video_ids if os.path.isdir(os.path.join(src_dir, video_id, "frames"))]
+
+def load_frame(path: str) -> np.ndarray:
+    """ HWC RGB uint8 array from an image or .npy file """
+    if path.lower().endswith(".npy"):
+        return np.load(path)
+    with open(path, 'rb') as fptr:
+        return decode_frame(fptr.read(), os.path.splitext(path)[1][1:])
+
+def export_frames(frame_dirs: list, writer: ShardWriter, workers: int = 8) -> int:
+    """ pack every frame in the (video_id, frames_dir) list into the writer's shards - returns the number of frames packed """
+    num_frames = 0
+    for video_id, frames_dir in frame_dirs:
+        with os.scandir(frames_dir) as entries:
+            names = sorted((entry.name for entry in entries if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTS)),
+                           key=lambda name: (get_frame_timestamp(name) is None, get_frame_timestamp(name) or 0, name))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            frames = executor.map(load_frame, [os.path.join(frames_dir, name) for name in names])
+            for name, frame in zip(tqdm(names, desc=f"Packing {video_id}"), frames):
+                writer.add(frame, name, video_id)
+                num_frames += 1
+    return num_frames
+
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Pack a frames directory, or every <video_id>/frames directory in a videos tree, into frame shards.")
+    parser.add_argument('src_dir', type=str, help='frames directory or videos root directory')
+    parser.add_argument('shard_dir', type=str, help='output directory for the shards and their indexes')
+    parser.add_argument('--shard_format', type=str, default='memmap', choices=SHARD_FORMATS, help="'memmap' for raw fixed-shape frames, 'tar' for encoded variable-size frames")
+    parser.add_argument('--frames_per_shard', type=int, default=DEFAULT_FRAMES_PER_SHARD, help='max number of frames in each shard')
+    parser.add_argument('--prefix', type=str, default=None, help='shard filename prefix (default: the video id for one video, "frames" for a tree)')
+    parser.add_argument('--output_format', type=str, default='png', choices=OUTPUT_FORMATS, help='encoding of frames in tar shards')
+    parser.add_argument('--workers', type=int, default=8, help='threads used to decode the source images')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = read_cli()
+    if not os.path.isdir(args.src_dir):
+        raise NotADirectoryError(f"{args.src_dir} is not a directory.")
+    frame_dirs = find_frame_dirs(args.src_dir)
+    prefix = args.prefix or (frame_dirs[0][0] if len(frame_dirs) == 1 else "frames")
+    with get_shard_writer(args.shard_format, args.shard_dir, prefix, args.frames_per_shard, options=EncoderOptions(args.output_format)) as writer:
+        num_frames = export_frames(frame_dirs, writer, args.workers)
+    print(f"FINISHED: packed {num_frames} frames from {len(frame_dirs)} videos into {len(writer.shard_paths)} shards in {args.shard_dir}")
@@ -0,0 +1,416 @@
+import os
+import re
+import json
+import time
+import queue
+import shlex
+import shutil
+import argparse
+import threading
+import subprocess
+import urllib.parse
+import urllib.request
+from dataclasses import dataclass
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from batch_rip import VIDEO_EXTS, SegmentPool, add_rip_options, plan_jobs, run_jobs, register_frames
+from vlc_frame_ripper import check_backend_options
+
+""" ingest daemon: download every URL in a list on a bounded pool of downloader threads, and rip each video as soon as it and its info JSON are on disk
+    videos land in videos_dir/<id>/<id>.<ext> next to <id>.info.json - the layout download_youtube.sh writes and batch_rip.py reads - so downloads (network-bound)
+    overlap with frame extraction (CPU-bound) instead of being separate manual steps
+    to try it without the remote host, serve a directory of videos locally (python -m http.server 8000) and list http://localhost:8000/<name>.mp4 URLs -
+    check_local_ingest (cli.py check ingest) does exactly that end to end
+"""
+
+DOWNLOADERS = ["auto", "youtube-dl", "http"]
+# the flags of download_youtube.sh and youtube-dl_command.txt - --print-json is added so the id and filename can be read back
+YOUTUBE_DL_FLAGS = ["--hls-prefer-ffmpeg", "--write-info-json", "--write-description", "--restrict-filenames"]
+STATE_FILENAME = ".ingest_state.jsonl"
+CHUNK_SIZE = 2**20
+# video directories of the HTTP downloads in progress, so two URLs that map to the same id can't write the same .part file at once
+active_downloads = set()
+active_downloads_lock = threading.Lock()
+
+
+@dataclass
+class IngestItem:
+    """ dataclass for one URL to ingest - video_id and downloader can be given per URL in a JSONL list """
+    url: str
+    video_id: str = None
+    downloader: str = "auto"
+
+
+@dataclass
+class DownloadedVideo:
+    """ dataclass for a video that's on disk and ready to rip """
+    item: IngestItem
+    video_id: str
+    vid_path: str
+    info_path: str
+
+
+def parse_url_line(line: str):
+    """ an IngestItem from a line of a URL list - a plain URL or a JSON object with a 'url' (and optionally 'id' and 'downloader') - or None to skip it """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if not line.startswith("{"):
+        return IngestItem(line)
+    entry = json.loads(line)
+    url = entry.get("url") or entry.get("webpage_url")
+    if url is None:
+        print(f"WARNING: skipping list entry without a 'url': {line[:80]}")
+        return None
+    return IngestItem(url, entry.get("id"), entry.get("downloader", "auto"))
+
+def iter_url_list(path: str, watch: bool = False, poll_interval: float = 5.0, stop_event: threading.Event = None):
+    """ yield the items of a URL list - with watch, keep following the file for appended lines (like tail -f) until stop_event is set """
+    stop_event = stop_event or threading.Event()
+    with open(path, 'r', encoding='utf-8') as fptr:
+        partial = ""
+        while not stop_event.is_set():
+            line = fptr.readline()
+            if line.endswith("\n") or (line and not watch):
+                item = parse_url_line(partial + line)
+                partial = ""
+                if item is not None:
+                    yield item
+            elif line:
+                # a line that's still being written - wait for the rest of it
+                partial += line
+            elif watch:
+                stop_event.wait(poll_interval)
+            else:
+                return
+
+def sanitize_id(name: str) -> str:
+    """ a filesystem-safe video id in the spirit of youtube-dl's --restrict-filenames """
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", name).strip("_")
+
+def find_video_file(video_dir: str, video_id: str) -> str:
+    for ext in VIDEO_EXTS:
+        vid_path = os.path.join(video_dir, f"{video_id}.{ext}")
+        if os.path.isfile(vid_path):
+            return vid_path
+    raise FileNotFoundError(f"no video file for '{video_id}' in {video_dir}")
+
+def get_downloader(item: IngestItem, default: str = "auto") -> str:
+    """ 'auto' fetches direct links to video files over HTTP and leaves everything else (e.g. YouTube pages) to youtube-dl """
+    downloader = item.downloader if item.downloader != "auto" else default
+    if downloader != "auto":
+        return downloader
+    ext = os.path.splitext(urllib.parse.urlparse(item.url).path)[1].lstrip(".").lower()
+    return "http" if ext in VIDEO_EXTS else "youtube-dl"
+
+def write_json_atomic(path: str, data: dict):
+    with open(path + ".part", 'w') as fptr:
+        json.dump(data, fptr, indent=4)
+    os.replace(path + ".part", path)
+
+@contextmanager
+def reserve_download(video_dir: str, video_id: str, url: str):
+    """ hold the video directory for the duration of a download, which has no info JSON to show for itself until it finishes """
+    key = os.path.abspath(video_dir)
+    with active_downloads_lock:
+        if key in active_downloads:
+            raise ValueError(f"'{video_id}' is already being downloaded from another URL; give {url} its own 'id' in a JSONL list")
+        active_downloads.add(key)
+    try:
+        yield
+    finally:
+        with active_downloads_lock:
+            active_downloads.discard(key)
+
+def http_download(item: IngestItem, videos_dir: str, timeout: float = 60) -> DownloadedVideo:
+    """ stream a direct video link to videos_dir/<id>/<id>.<ext> and write a minimal <id>.info.json after it
+        the video is downloaded to a .part file and renamed when complete, and the info JSON is written last, so both existing means the download finished
+        the id is the URL's file name unless one is given, so two URLs can map to the same id - the second one is refused rather than taking the first one's video
+    """
+    stem, ext = os.path.splitext(os.path.basename(urllib.parse.urlparse(item.url).path))
+    video_id = item.video_id or sanitize_id(urllib.parse.unquote(stem))
+    if not video_id:
+        raise ValueError(f"can't derive a video id from {item.url}; give one with an 'id' in a JSONL list")
+    ext = ext.lstrip(".").lower() or "mp4"
+    video_dir = os.path.join(videos_dir, video_id)
+    vid_path = os.path.join(video_dir, f"{video_id}.{ext}")
+    info_path = os.path.join(video_dir, f"{video_id}.info.json")
+    with reserve_download(video_dir, video_id, item.url):
+        if os.path.isfile(info_path):
+            with open(info_path, 'r') as fptr:
+                info = json.load(fptr)
+            source_url = info.get("webpage_url") or info.get("url")
+            if source_url != item.url:
+                raise ValueError(f"'{video_id}' was already downloaded from {source_url}; give {item.url} its own 'id' in a JSONL list")
+            if os.path.isfile(vid_path):
+                return DownloadedVideo(item, video_id, vid_path, info_path)
+        request = urllib.request.Request(item.url, headers={"User-Agent": "frame-ingest"})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            # only create the video directory once the server has answered, so failed URLs don't leave empty directories behind
+            os.makedirs(video_dir, exist_ok=True)
+            with open(vid_path + ".part", 'wb') as fptr:
+                shutil.copyfileobj(response, fptr, CHUNK_SIZE)
+                num_bytes = fptr.tell()
+            headers = response.headers
+        expected = headers.get("Content-Length")
+        if expected is not None and int(expected) != num_bytes:
+            raise IOError(f"incomplete download of {item.url}: {num_bytes} of {expected} bytes")
+        os.replace(vid_path + ".part", vid_path)
+        write_json_atomic(info_path, {"id": video_id, "title": urllib.parse.unquote(stem), "ext": ext, "url": item.url, "webpage_url": item.url,
+                                      "extractor": "http", "filesize": num_bytes, "content_type": headers.get("Content-Type"),
+                                      "last_modified": headers.get("Last-Modified"), "etag": headers.get("ETag"), "downloaded_at": time.time()})
+    return DownloadedVideo(item, video_id, vid_path, info_path)
+
+def youtube_dl_download(item: IngestItem, videos_dir: str, command: str = "youtube-dl", extra_args: list = None) -> DownloadedVideo:
+    """ download with youtube-dl (or a compatible command like yt-dlp) using the flags of download_youtube.sh """
+    output_template = os.path.join(videos_dir, "%(id)s", "%(id)s.%(ext)s")
+    cmd = [*shlex.split(command), item.url, *YOUTUBE_DL_FLAGS, "--print-json", "-o", output_template, *(extra_args or [])]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{command} exited with code {result.returncode}: {result.stderr.strip()[-500:]}")
+    info_lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+    if not info_lines:
+        raise RuntimeError(f"{command} didn't print the video info for {item.url}")
+    info = json.loads(info_lines[-1])
+    video_id = info["id"]
+    video_dir = os.path.join(videos_dir, video_id)
+    # merged formats can end up with a different extension than the one in the info
+    vid_path = info.get("_filename") if os.path.isfile(info.get("_filename") or "") else find_video_file(video_dir, video_id)
+    return DownloadedVideo(item, video_id, vid_path, os.path.join(video_dir, f"{video_id}.info.json"))
+
+
+class IngestState:
+    """ append-only JSONL record of what happened to each URL, so a restarted daemon skips URLs that were already ripped """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.statuses = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as fptr:
+                for line in fptr:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.statuses[record["url"]] = record["status"]
+
+    def record(self, url: str, status: str, **fields):
+        with self.lock:
+            self.statuses[url] = status
+            with open(self.path, 'a', encoding='utf-8') as fptr:
+                fptr.write(json.dumps({"url": url, "status": status, "time": time.time(), **fields}) + "\n")
+
+    def is_done(self, url: str) -> bool:
+        return self.statuses.get(url) == "ripped"
+
+
+class IngestDaemon:
+    """ download and rip stages connected by a bounded queue
+        at most download_workers downloads run at once, and a download waiting for a full ready queue holds its slot,
+        so downloading pauses when ripping falls behind instead of filling the disk with unripped videos
+        the rip stage takes one video at a time and spreads its segments over a process pool that lives as long as the daemon
+        setting stop_event (done by run when it's interrupted) stops taking new URLs, and the rip stage stops after the video it's on
+    """
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.state = IngestState(os.path.join(args.videos_dir, STATE_FILENAME))
+        self.ready = queue.Queue(maxsize=max(args.max_ready, 1))
+        self.download_slots = threading.Semaphore(max(args.download_workers, 1))
+        self.stop_event = threading.Event()
+        self.counts = {"downloaded": 0, "ripped": 0, "download_failed": 0, "rip_failed": 0, "skipped": 0}
+        self.counts_lock = threading.Lock()
+
+    def count(self, key: str):
+        with self.counts_lock:
+            self.counts[key] += 1
+
+    def download(self, item: IngestItem) -> DownloadedVideo:
+        if get_downloader(item, self.args.downloader) == "http":
+            return http_download(item, self.args.videos_dir, self.args.timeout)
+        return youtube_dl_download(item, self.args.videos_dir, self.args.youtube_dl, shlex.split(self.args.youtube_dl_args))
+
+    def download_task(self, item: IngestItem):
+        try:
+            try:
+                video = self.download(item)
+            except Exception as e:
+                print(f"FAILED to download {item.url}: {e}")
+                self.state.record(item.url, "download_failed", error=str(e))
+                self.count("download_failed")
+                return
+            print(f"downloaded {video.video_id} -> {video.vid_path}")
+            self.state.record(item.url, "downloaded", video_id=video.video_id, vid_path=video.vid_path)
+            self.count("downloaded")
+            # wait while the ready queue is full (the slot is only freed once the video is queued for ripping), but give up once the daemon is stopping -
+            # the video stays on disk as 'downloaded', so the next run rips it without downloading it again
+            while not self.stop_event.is_set():
+                try:
+                    self.ready.put(video, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+        finally:
+            self.download_slots.release()
+
+    def rip(self, video: DownloadedVideo, pool: SegmentPool) -> list:
+        """ rip a downloaded video - returns the errors, which are empty if it was ripped """
+        # frames without a 'ripped' record are from a rip that didn't finish (or from outside the daemon), so the video is ripped again over them
+        # rather than being taken as done - frame names are their timestamps, so the same frames are rewritten, and the video's shards are replaced
+        plan = plan_jobs(video.video_id, video.vid_path, self.args, force=True)
+        if plan.skip_reason is not None:
+            return [plan.error or f"skipped ({plan.skip_reason})"]
+        if not plan.jobs:
+            return ["no frames to rip (check --start_time/--end_time/--num_frames)"]
+        failed = run_jobs(plan.jobs, self.args.backend, self.args.workers, self.args.retries, self.args.encode_workers, pool)
+        if not failed and self.args.catalog is not None and self.args.shard_dir is None:
+            register_frames(self.args.catalog, plan.jobs)
+        return [f"segment {job.segment_idx}: {error}" for job, error in failed]
+
+    def rip_loop(self, pool: SegmentPool):
+        while (video := self.ready.get()) is not None and not self.stop_event.is_set():
+            try:
+                errors = self.rip(video, pool)
+            except KeyboardInterrupt:
+                # Ctrl+C reaches the pool's worker processes too - the daemon is stopping, and the video stays 'downloaded' for the next run
+                return
+            except Exception as e:
+                errors = [str(e)]
+            if errors:
+                print(f"FAILED to rip {video.video_id}: {errors[0]}" + (f" (and {len(errors) - 1} more errors)" if len(errors) > 1 else ""))
+                self.state.record(video.item.url, "rip_failed", video_id=video.video_id, errors=errors)
+                self.count("rip_failed")
+            else:
+                print(f"ripped {video.video_id}")
+                self.state.record(video.item.url, "ripped", video_id=video.video_id, vid_path=video.vid_path)
+                self.count("ripped")
+
+    def run(self, items) -> dict:
+        """ ingest every item (an iterable that may keep yielding in watch mode) - returns the counts """
+        os.makedirs(self.args.videos_dir, exist_ok=True)
+        seen = set()
+        with SegmentPool(self.args.workers) as rip_pool, ThreadPoolExecutor(max_workers=max(self.args.download_workers, 1)) as download_executor:
+            rip_thread = threading.Thread(target=self.rip_loop, args=(rip_pool,), daemon=True)
+            rip_thread.start()
+            try:
+                for item in items:
+                    if item.url in seen or self.state.is_done(item.url):
+                        self.count("skipped")
+                        continue
+                    seen.add(item.url)
+                    # wait for a free download slot, so the URL list is only read as fast as videos can be taken
+                    while not self.download_slots.acquire(timeout=1):
+                        if self.stop_event.is_set():
+                            raise KeyboardInterrupt("stopped while waiting for a download slot")
+                    download_executor.submit(self.download_task, item)
+                download_executor.shutdown(wait=True)
+            except BaseException:
+                # downloads that are queued are dropped and those in flight stop waiting for the ready queue, so they can't block the shutdown
+                self.stop_event.set()
+                download_executor.shutdown(wait=True, cancel_futures=True)
+                raise
+            finally:
+                # the rip stage may already have stopped, in which case nobody would take the sentinel from a full queue
+                while rip_thread.is_alive():
+                    try:
+                        self.ready.put(None, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+                rip_thread.join()
+        return self.counts
+
+
+def check_local_ingest(num_frames: int = 3) -> int:
+    """ end-to-end check against a local HTTP file server standing in for the remote host: serves a small generated video with http.server on an ephemeral port,
+        downloads it with http_download, then ingests a URL list (a JSONL entry, a plain URL, a missing file, and a URL whose id is already taken by another URL) with IngestDaemon.run and checks that a rerun skips it all
+        returns the number of frames ripped
+    """
+    import tempfile
+    import functools
+    import http.server
+    import cv2
+    import numpy as np
+    with tempfile.TemporaryDirectory(prefix="ingest_check_") as work_dir:
+        serve_dir = os.path.join(work_dir, "served")
+        os.makedirs(serve_dir)
+        writer = cv2.VideoWriter(os.path.join(serve_dir, "clip.mp4"), cv2.VideoWriter_fourcc(*'mp4v'), 10, (64, 48))
+        for idx in range(30):
+            writer.write(np.full((48, 64, 3), idx*8, dtype=np.uint8))
+        writer.release()
+        shutil.copyfile(os.path.join(serve_dir, "clip.mp4"), os.path.join(serve_dir, "clip 2.mp4"))
+        # same file name on another path, so the same id as clip.mp4
+        os.makedirs(os.path.join(serve_dir, "other"))
+        shutil.copyfile(os.path.join(serve_dir, "clip.mp4"), os.path.join(serve_dir, "other", "clip.mp4"))
+
+        class QuietHandler(http.server.SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=serve_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            videos_dir = os.path.join(work_dir, "videos")
+            video = http_download(IngestItem(f"{base_url}/clip.mp4"), videos_dir)
+            with open(os.path.join(serve_dir, "clip.mp4"), 'rb') as served, open(video.vid_path, 'rb') as downloaded:
+                assert served.read() == downloaded.read(), "downloaded video differs from the served one"
+            with open(video.info_path, 'r') as fptr:
+                info = json.load(fptr)
+            assert (video.video_id, info["id"], info["extractor"]) == ("clip", "clip", "http"), f"unexpected download info {info}"
+            url_list = os.path.join(work_dir, "urls.txt")
+            with open(url_list, 'w') as fptr:
+                fptr.write(f'# check list\n{{"url": "{base_url}/clip.mp4", "id": "from_jsonl"}}\n{base_url}/clip%202.mp4\n{base_url}/missing.mp4\n{base_url}/other/clip.mp4\n')
+            parser = argparse.ArgumentParser()
+            add_args(parser)
+            args = parser.parse_args([url_list, "--videos_dir", videos_dir, "--num_frames", str(num_frames), "--workers", "1", "--backend", "opencv"])
+            counts = IngestDaemon(args).run(iter_url_list(url_list))
+            assert (counts["ripped"], counts["download_failed"], counts["rip_failed"]) == (2, 2, 0), f"unexpected counts {counts}"
+            num_ripped = 0
+            # the plain URL's id comes from its (unquoted, sanitized) filename
+            for video_id in ["from_jsonl", "clip_2"]:
+                frames = os.listdir(os.path.join(videos_dir, video_id, "frames"))
+                assert len(frames) == num_frames, f"expected {num_frames} frames for {video_id}, found {frames}"
+                num_ripped += len(frames)
+            counts = IngestDaemon(args).run(iter_url_list(url_list))
+            assert (counts["skipped"], counts["downloaded"]) == (2, 0), f"rerun didn't skip the ripped URLs: {counts}"
+        finally:
+            server.shutdown()
+            server.server_close()
+    return num_ripped
+
+
+def add_args(parser: argparse.ArgumentParser):
+    parser.add_argument('url_list', type=str, help="file with one URL per line, or JSONL with a 'url' (and optionally 'id' and 'downloader') per line")
+    parser.add_argument('--videos_dir', type=str, default='videos', help='root directory for videos_dir/<id>/<id>.<ext> downloads')
+    parser.add_argument('--downloader', type=str, default='auto', choices=DOWNLOADERS, help="'auto' uses plain HTTP for direct links to video files and youtube-dl otherwise")
+    parser.add_argument('--download_workers', type=int, default=2, help='number of concurrent downloads')
+    parser.add_argument('--max_ready', type=int, default=2, help='max number of downloaded videos waiting to be ripped before downloads pause')
+    parser.add_argument('--youtube_dl', type=str, default='youtube-dl', help="youtube-dl command (e.g. 'yt-dlp')")
+    parser.add_argument('--youtube_dl_args', type=str, default='', help="extra youtube-dl arguments, e.g. '-f mp4'")
+    parser.add_argument('--timeout', type=float, default=60, help='HTTP connect/read timeout in seconds')
+    parser.add_argument('--watch', action='store_true', help='keep following the URL list for new lines instead of exiting at its end (stop with Ctrl+C)')
+    parser.add_argument('--poll_interval', type=float, default=5.0, help='seconds between checks for new lines with --watch')
+    add_rip_options(parser)
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Download a list of video URLs and rip frames from each video as soon as it's downloaded.")
+    add_args(parser)
+    return parser.parse_args()
+
+def main(args: argparse.Namespace):
+    if not os.path.isfile(args.url_list):
+        raise FileNotFoundError(f"Couldn't find the URL list at {args.url_list}")
+    check_backend_options(args)
+    start = time.perf_counter()
+    daemon = IngestDaemon(args)
+    try:
+        counts = daemon.run(iter_url_list(args.url_list, args.watch, args.poll_interval, daemon.stop_event))
+    except KeyboardInterrupt:
+        counts = daemon.counts
+        print("interrupted - videos that weren't ripped yet are picked up again on the next run (downloaded ones aren't downloaded again)")
+    print(f"FINISHED in {time.perf_counter() - start:.1f}s: {counts['downloaded']} downloaded, {counts['ripped']} ripped, "
+          f"{counts['download_failed'] + counts['rip_failed']} failed, {counts['skipped']} already ingested")
+
+
+if __name__ == "__main__":
+    main(read_cli())
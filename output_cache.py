@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+
+""" persistent cache of processed frames so that re-running a tool over the same directory skips frames whose output is already up to date
+    entries are keyed on the input file's identity (size and mtime, or a content hash) and are only valid for one hash of the transform parameters
+"""
+
+CACHE_FILENAME = ".postprocess_cache.json"
+# bump this whenever a change to the processing code should invalidate old outputs
+CACHE_VERSION = 1
+# number of new records between saves, so an interrupted run keeps most of its progress
+SAVE_INTERVAL = 500
+
+
+def hash_params(params: dict) -> str:
+    """ canonical hash of the transform parameters (key order and float formatting don't matter) """
+    canonical = json.dumps({"version": CACHE_VERSION, **params}, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def hash_file(path: str, chunk_size: int = 2**20) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fptr:
+        while chunk := fptr.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def scan_file_stats(dir_path: str) -> dict:
+    """ get {filename: stat} for all files in a directory with a single scandir pass """
+    if not os.path.isdir(dir_path):
+        return {}
+    with os.scandir(dir_path) as entries:
+        return {entry.name: entry.stat() for entry in entries if entry.is_file()}
+
+
+class OutputCache:
+    """ manifest of {input filename: input identity + output identity} stored as JSON alongside the outputs """
+    def __init__(self, cache_path: str, params: dict, use_content_hash: bool = False):
+        self.cache_path = cache_path
+        self.params_hash = hash_params(params)
+        self.use_content_hash = use_content_hash
+        self.entries = {}
+        self.num_unsaved = 0
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as fptr:
+                manifest = json.load(fptr)
+            # outputs made with different parameters are stale - evict everything rather than trusting any of them
+            if manifest.get("params_hash") == self.params_hash and manifest.get("use_content_hash") == use_content_hash:
+                self.entries = manifest.get("entries", {})
+            else:
+                print(f"transform parameters changed since the last run; evicting {len(manifest.get('entries', {}))} cached entries")
+                self.num_unsaved = 1
+
+    def _input_identity(self, path: str, stat: os.stat_result = None) -> dict:
+        stat = stat or os.stat(path)
+        identity = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if self.use_content_hash:
+            identity = {"size": stat.st_size, "sha1": hash_file(path)}
+        return identity
+
+    def is_fresh(self, input_path: str, output_path: str, input_stat: os.stat_result = None, output_stat: os.stat_result = None) -> bool:
+        """ check whether the output for input_path is present and was produced from this exact input with the current parameters """
+        entry = self.entries.get(os.path.basename(input_path))
+        if entry is None:
+            return False
+        input_stat = input_stat or os.stat(input_path)
+        # cheap size check first so content hashes are only computed for plausible hits
+        if entry["input"]["size"] != input_stat.st_size:
+            return False
+        if entry["input"] != self._input_identity(input_path, input_stat):
+            return False
+        if output_stat is None:
+            if not os.path.exists(output_path):
+                return False
+            output_stat = os.stat(output_path)
+        return entry["output"] == {"size": output_stat.st_size, "mtime_ns": output_stat.st_mtime_ns}
+
+    def record(self, input_path: str, output_path: str):
+        """ record a freshly written output - if the input was overwritten, its new identity is what the next run will see """
+        output_stat = os.stat(output_path)
+        self.entries[os.path.basename(input_path)] = {
+            "input": self._input_identity(input_path, output_stat if input_path == output_path else None),
+            "output": {"size": output_stat.st_size, "mtime_ns": output_stat.st_mtime_ns}
+        }
+        self.num_unsaved += 1
+        if self.num_unsaved >= SAVE_INTERVAL:
+            self.save()
+
+    def prune(self, input_names):
+        """ drop entries for inputs that no longer exist """
+        input_names = set(input_names)
+        stale = [name for name in self.entries if name not in input_names]
+        for name in stale:
+            del self.entries[name]
+        self.num_unsaved += len(stale)
+
+    def save(self):
+        if self.num_unsaved == 0:
+            return
+        manifest = {"params_hash": self.params_hash, "use_content_hash": self.use_content_hash, "entries": self.entries}
+        # write to a temporary file then swap it in so an interruption can't leave a truncated manifest
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, 'w') as fptr:
+            json.dump(manifest, fptr)
+        os.replace(tmp_path, self.cache_path)
+        self.num_unsaved = 0
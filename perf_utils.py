@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import nullcontext
+
+""" small helpers for reporting resource usage of the frame tools
+    Instrumentation bundles the optional run statistics the tools can record: per-stage latency histograms, RSS/tracemalloc sampling, and a cProfile dump
+"""
+
+# number of allocation sites listed from the tracemalloc snapshot
+TRACEMALLOC_TOP = 10
+
+
+def get_peak_rss_mb() -> float:
+    """ get the peak resident set size of the current process in MiB """
+    try:
+        import resource
+    except ImportError:
+        # resource is Unix-only; on Windows psutil exposes the peak working set instead
+        import psutil
+        return psutil.Process().memory_info().peak_wset/2**20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ? NOTE: ru_maxrss is in bytes on macOS but kilobytes on Linux
+    return peak/2**20 if sys.platform == "darwin" else peak/2**10
+
+def get_rss_mb() -> float:
+    """ get the current resident set size of the current process in MiB """
+    try:
+        # cheapest on Linux: the second field of statm is the resident page count
+        with open("/proc/self/statm", 'r') as fptr:
+            return int(fptr.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/2**20
+    except (OSError, ValueError, AttributeError):
+        import psutil
+        return psutil.Process().memory_info().rss/2**20
+
+
+class _StageTimer:
+    """ context manager recording one timing into StageStats - a plain class since it's cheaper to enter than a generator context manager """
+    __slots__ = ("stats", "stage", "start")
+
+    def __init__(self, stats, stage: str):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.record_ns(self.stage, time.perf_counter_ns() - self.start)
+
+
+class StageStats:
+    """ thread-safe latency histograms per stage (read, decode, transform, encode, write, ...)
+        each timing lands in a power-of-two nanosecond bucket, so recording costs one clock read, a bit_length, and a dict update
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # stage -> [count, total_ns, max_ns, {bucket: count}]
+        self.stages = {}
+
+    def record_ns(self, stage: str, elapsed_ns: int):
+        bucket = elapsed_ns.bit_length()
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = [0, 0, 0, {}]
+            entry[0] += 1
+            entry[1] += elapsed_ns
+            entry[2] = max(entry[2], elapsed_ns)
+            entry[3][bucket] = entry[3].get(bucket, 0) + 1
+
+    def time(self, stage: str) -> _StageTimer:
+        return _StageTimer(self, stage)
+
+    def summary(self) -> dict:
+        """ {stage: count, total, mean, max, and bucket-resolution percentiles} - times in milliseconds, buckets labelled by their upper bound """
+        summary = {}
+        with self.lock:
+            stages = {stage: (count, total_ns, max_ns, dict(buckets)) for stage, (count, total_ns, max_ns, buckets) in self.stages.items()}
+        for stage, (count, total_ns, max_ns, buckets) in stages.items():
+            ordered = sorted(buckets.items())
+            def percentile(p):
+                # upper bound of the bucket holding the p-th percentile timing
+                target, seen = p/100*count, 0
+                for bucket, bucket_count in ordered:
+                    seen += bucket_count
+                    if seen >= target:
+                        return min(2**bucket, max_ns)/1e6
+                return max_ns/1e6
+            summary[stage] = {
+                "count": count, "total_s": total_ns/1e9, "mean_ms": total_ns/count/1e6, "max_ms": max_ns/1e6,
+                "p50_ms": percentile(50), "p90_ms": percentile(90), "p99_ms": percentile(99),
+                "histogram_ms": {f"<={2**bucket/1e6:.4g}": bucket_count for bucket, bucket_count in ordered}
+            }
+        return summary
+
+def stage_timer(stats: StageStats, stage: str):
+    """ time a block into stats, or do nothing if instrumentation is off (stats is None) """
+    return nullcontext() if stats is None else stats.time(stage)
+
+def timed_iter(iterable, stats: StageStats, stage: str):
+    """ yield from iterable, recording how long each item took to produce (e.g. decoding) """
+    if stats is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter_ns()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        stats.record_ns(stage, time.perf_counter_ns() - start)
+        yield item
+
+
+class MemorySampler:
+    """ background thread sampling the RSS every interval seconds, optionally with tracemalloc tracking Python allocations """
+    def __init__(self, interval: float = 0.5, use_tracemalloc: bool = False):
+        self.interval = interval
+        self.use_tracemalloc = use_tracemalloc
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.samples.append(get_rss_mb())
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        if self.use_tracemalloc:
+            import tracemalloc
+            tracemalloc.start()
+        self.thread.start()
+
+    def stop(self) -> dict:
+        self.stop_event.set()
+        self.thread.join()
+        summary = {"interval_s": self.interval, "samples": len(self.samples),
+                   "rss_mb_max": max(self.samples, default=None), "rss_mb_mean": sum(self.samples)/len(self.samples) if self.samples else None}
+        if self.use_tracemalloc:
+            import tracemalloc
+            _, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics("lineno")[:TRACEMALLOC_TOP]
+            tracemalloc.stop()
+            summary["tracemalloc_peak_mb"] = peak/2**20
+            summary["tracemalloc_top"] = [{"site": str(stat.traceback), "size_mb": stat.size/2**20, "count": stat.count} for stat in top]
+        return summary
+
+
+def add_instrumentation_args(parser: argparse.ArgumentParser):
+    """ add the options that turn on run statistics (all off by default) """
+    parser.add_argument('--instrument', action='store_true', help='record per-stage latency histograms (read, decode, transform, encode, write) into the metadata JSON')
+    parser.add_argument('--memory_interval', type=float, default=None, help='sample the RSS every this many seconds')
+    parser.add_argument('--tracemalloc', action='store_true', help='track Python allocations with tracemalloc (slow) and record the peak and top allocation sites')
+    parser.add_argument('--profile', type=str, default=None, help='run the main thread under cProfile and dump the stats to this path (view with pstats or snakeviz)')
+
+class Instrumentation:
+    """ run statistics selected on the command line - use as a context manager around the work, then record summary() into the metadata
+        stats is None unless --instrument was given, so it can be passed straight to stage_timer/timed_iter
+    """
+    def __init__(self, instrument: bool = False, memory_interval: float = None, use_tracemalloc: bool = False, profile_path: str = None):
+        self.stats = StageStats() if instrument else None
+        self.sampler = MemorySampler(memory_interval or 0.5, use_tracemalloc) if memory_interval is not None or use_tracemalloc else None
+        self.profile_path = profile_path
+        self.profiler = None
+        self.start_time = None
+        self.wall_s = None
+        self.memory = None
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace):
+        return cls(args.instrument, args.memory_interval, args.tracemalloc, args.profile)
+
+    @property
+    def enabled(self) -> bool:
+        return self.stats is not None or self.sampler is not None or self.profile_path is not None
+
+    def __enter__(self):
+        if self.sampler is not None:
+            self.sampler.start()
+        if self.profile_path is not None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_s = time.perf_counter() - self.start_time
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+        if self.sampler is not None:
+            self.memory = self.sampler.stop()
+
+    def summary(self) -> dict:
+        summary = {"wall_s": self.wall_s, "peak_rss_mb": get_peak_rss_mb()}
+        if self.stats is not None:
+            summary["stages"] = self.stats.summary()
+        if self.memory is not None:
+            summary["memory"] = self.memory
+        if self.profile_path is not None:
+            summary["profile"] = os.path.abspath(self.profile_path)
+        return summary
+
+def add_run_stats(metadata_path: str, run_stats: dict):
+    """ add a run_stats entry to an existing metadata JSON file """
+    with open(metadata_path, 'r') as fptr:
+        metadata = json.load(fptr)
+    metadata["run_stats"] = run_stats
+    with open(metadata_path, 'w') as fptr:
+        json.dump(metadata, fptr, indent=4)
@@ -1,9 +1,26 @@
+from __future__ import annotations
 import os
+import json
 import argparse
+from functools import lru_cache
+from typing import TYPE_CHECKING
 from tqdm import tqdm
-import torch
-import torchvision.io as IO
-import torchvision.transforms.v2 as TT
+import numpy as np
+from frame_pipeline import Pipeline
+from frame_encoders import EncoderOptions, EncodePool, add_encoder_args, get_encoder_options, get_encoder_params, get_output_path, write_encoded_frame
+from frame_shards import ShardWriter, add_shard_args, get_shard_writer, guess_video_id
+from perf_utils import Instrumentation, StageStats, add_instrumentation_args, stage_timer
+from output_cache import CACHE_FILENAME, OutputCache, scan_file_stats
+from frame_catalog import FrameCatalog, add_catalog_args
+if TYPE_CHECKING:
+    import torch
+    import torchvision.transforms.v2 as TT
+
+# ? NOTE: torch, torchvision, and cv2 are imported inside the functions that use them, so that building the CLI (e.g. cli.py postprocess --help) doesn't pay ~2s for torch
+
+METADATA_FILENAME = "postprocess_metadata.json"
+# 5x5 binomial (Gaussian-like) blur kernel assumed by --undo_motion_blur - kept as a tuple so that it's hashable for the spectrum cache
+DEBLUR_KERNEL = tuple(tuple(v/256 for v in row) for row in [[1, 4, 6, 4, 1], [4, 16, 24, 16, 4], [6, 24, 36, 24, 6], [4, 16, 24, 16, 4], [1, 4, 6, 4, 1]])
 
 # borrowed from the main repo just in case there's danger of redownloading a bunch
 def get_user_confirmation(prompt):
@@ -13,66 +30,372 @@ def get_user_confirmation(prompt):
         print("Invalid input. Please enter 'y' or 'n' (not case sensitive).")
     return answers[response]
 
-def read_cli() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description="Crop all images in a directory to a specified size according to offset from the bottom edge.")
+def add_args(parser: argparse.ArgumentParser):
     parser.add_argument('dir_path', type=str, help='path to frame directory')
+    parser.add_argument('--yes', action='store_true', help="don't ask for confirmation before processing")
     parser.add_argument('--overwrite', action='store_true', help='overwrite the original images')
     parser.add_argument('--top_offset', type=int, default=None, help='vertical offset (essentually the amount to trim from the top)')
     parser.add_argument('--bottom_offset', type=int, default=None, help='vertical offset (essentually the amount to trim from the bottom)')
     parser.add_argument('--brightness_mult', type=float, default=None, help='brightness factor to scale brightness by (<1.0 darkens, >1.0 brightens)')
     parser.add_argument('--undo_motion_blur', action='store_true', help='undo motion blur')
+    parser.add_argument('--workers', type=int, default=1, help='number of threads for the read and transform pipeline stages; 1 reads and transforms files sequentially')
+    parser.add_argument('--queue_size', type=int, default=None, help='max number of images waiting between pipeline stages (default: 2x workers)')
+    parser.add_argument('--batch_size', type=int, default=1, help='number of images per batch; images of the same shape in a batch are transformed as one NCHW tensor')
+    parser.add_argument('--limit', type=int, default=None, help='only process the first LIMIT files that still need processing, so repeated runs work through the directory in chunks')
+    parser.add_argument('--no_cache', action='store_true', help='reprocess every frame instead of skipping frames whose output is up to date')
+    parser.add_argument('--cache_content_hash', action='store_true', help='identify unchanged inputs by content hash instead of size and modification time')
+    add_encoder_args(parser)
+    add_shard_args(parser)
+    add_catalog_args(parser)
+    parser.add_argument('--rescan', action='store_true', help='with --catalog, check every input for changes even if the directory looks unchanged (catches frames rewritten in place by other tools)')
+    add_instrumentation_args(parser)
+    parser.add_argument('--verbose', action='store_true', help='print the pixel value range of every processed image')
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Crop all images in a directory to a specified size according to offset from the bottom edge.")
+    add_args(parser)
     return parser.parse_args()
 
-def wiener_filter(blurred_img, kernel, K=0.01):
-    blurred_fft = torch.fft.fft2(blurred_img)
-    kernel_fft = torch.fft.fft2(kernel, s=blurred_img.shape[-2:])
-    kernel_fft_conj = torch.conj(kernel_fft)
-    denominator = torch.abs(kernel_fft) ** 2 + K
-    restored_fft = blurred_fft * kernel_fft_conj / denominator
-    restored_img = torch.fft.ifft2(restored_fft).real
-    return restored_img
+@lru_cache(maxsize=8)
+def get_wiener_response(kernel: tuple, shape: tuple, K: float = 0.01) -> torch.Tensor:
+    """ frequency response conj(H)/(|H|^2 + K) of the Wiener filter for a kernel zero-padded to shape (H, W)
+        cached since every frame of the same resolution shares it - only the W//2 + 1 non-redundant columns of the real FFT are kept
+    """
+    import torch
+    kernel_fft = torch.fft.rfft2(torch.tensor(kernel, dtype=torch.float32), s=shape)
+    return torch.conj(kernel_fft) / (torch.abs(kernel_fft) ** 2 + K)
 
+def wiener_filter(blurred_img: torch.Tensor, kernel: tuple, K=0.01) -> torch.Tensor:
+    """ deconvolve a float image or batch of images (..., H, W) - the whole batch is transformed in one call """
+    import torch
+    shape = tuple(blurred_img.shape[-2:])
+    restored_fft = torch.fft.rfft2(blurred_img) * get_wiener_response(kernel, shape, K)
+    return torch.fft.irfft2(restored_fft, s=shape)
 
-if __name__ == "__main__":
-    args: argparse.Namespace = read_cli()
-    ### handle file existence, path creation, and confirmation of path existences
-    if not os.path.exists(args.dir_path):
-        raise FileNotFoundError(f"Couldn't find the directory at {args.dir_path}")
-    if not os.path.isdir(args.dir_path):
-        raise NotADirectoryError(f"{args.dir_path} is not a directory.")
-    # adding a check because I keep screwing up frames when giving the wrong path and want a warning each time
-    _ = get_user_confirmation(f"Processing {args.dir_path}. Continue?")
-    dest_dir = os.path.join(args.dir_path, 'processed')
-    os.makedirs(dest_dir, exist_ok=True)
-    
+
+@lru_cache(maxsize=8)
+def get_brightness_lut(brightness_mult: float) -> np.ndarray:
+    """ 256-entry uint8 lookup table for a brightness factor
+        built by running the float reference chain (scale to [0,1], adjust_brightness, clip, scale back to uint8) on every possible value, so it's bit-identical to it
+    """
+    import torch
+    import torchvision.transforms.v2 as TT
+    values = torch.arange(256, dtype=torch.uint8).reshape(1, 1, 256)
+    scaled = TT.functional.adjust_brightness(TT.ToDtype(torch.float32, scale=True)(values), brightness_mult).clip(0, 1)
+    return TT.ToDtype(torch.uint8, scale=True)(scaled).reshape(256).numpy()
+
+def apply_lut_(x: torch.Tensor, lut: np.ndarray) -> torch.Tensor:
+    """ map every value of a uint8 (..., H, W) tensor through the lookup table in place
+        the axes are walked in memory order, since torchvision can decode to channels-last (HWC-strided) tensors - rows stay contiguous in a cropped view either way,
+        so cv2.LUT can write straight into it without a copy
+    """
+    import cv2
+    values = x.numpy()
+    values = values.transpose(np.argsort(values.strides, kind="stable")[::-1])
+    if values.strides[-1] != 1:
+        values[...] = lut[values]
+        return x
+    # interleaved channels are mapped as one multi-channel image, otherwise each H x W plane on its own
+    mat_ndim = 3 if values.ndim >= 3 and values.shape[-1] <= 4 and values.strides[-2] == values.shape[-1] else 2
+    for idx in np.ndindex(values.shape[:-mat_ndim]):
+        cv2.LUT(values[idx], lut, dst=values[idx])
+    return x
+
+def check_apply_lut(brightness_mults=(0.5, 1.3, 2.5), seed: int = 0) -> int:
+    """ check that apply_lut_ matches indexing the table (lut[values]) bit for bit on every memory layout the pipeline produces -
+        contiguous, channels-last (as torchvision decodes), cropped views, batches, single-channel, and non-unit column strides
+        pixels outside a cropped view must be left untouched - raises an AssertionError on the first mismatch, otherwise returns the number of cases checked
+    """
+    import torch
+    rng = np.random.default_rng(seed)
+    hwc = torch.from_numpy(rng.integers(0, 256, (4, 37, 53, 3), dtype=np.uint8))
+    layouts = {
+        "contiguous CHW": lambda: hwc[0].permute(2, 0, 1).contiguous(),
+        "channels-last CHW": lambda: hwc[0].permute(2, 0, 1),
+        "single-channel CHW": lambda: hwc[0, :, :, :1].permute(2, 0, 1).contiguous(),
+        "contiguous NCHW": lambda: hwc.permute(0, 3, 1, 2).contiguous(),
+        "channels-last NCHW": lambda: hwc.permute(0, 3, 1, 2),
+    }
+    views = {
+        "full": lambda x: x,
+        "cropped": lambda x: x[..., 5:(x.shape[-2] - 7), :],
+        "every other column": lambda x: x[..., ::2],
+    }
+    num_checked = 0
+    for brightness_mult in brightness_mults:
+        lut = get_brightness_lut(brightness_mult)
+        for layout, make_tensor in layouts.items():
+            for view_name, get_view in views.items():
+                base = make_tensor().clone()
+                original = base.clone()
+                view = get_view(base)
+                expected = torch.from_numpy(lut[get_view(original).numpy()])
+                apply_lut_(view, lut)
+                assert torch.equal(view, expected), f"apply_lut_ output differs for a {view_name} {layout} tensor (brightness {brightness_mult})"
+                untouched = torch.ones_like(base, dtype=torch.bool)
+                get_view(untouched)[...] = False
+                assert torch.equal(base[untouched], original[untouched]), f"apply_lut_ changed pixels outside a {view_name} {layout} view"
+                num_checked += 1
+    return num_checked
+
+def get_postprocessor(args: argparse.Namespace) -> TT.Compose:
+    """ compile the options into a fused plan that stays in uint8 wherever it can
+        cropping is a view, brightness alone is an in-place lookup table, and only the Wiener filter goes through float32
+    """
+    import torch
+    import torchvision.transforms.v2 as TT
     transforms = []
     if args.top_offset is not None or args.bottom_offset is not None:
         if args.top_offset is None:
             args.top_offset = 0
         if args.bottom_offset is None:
             args.bottom_offset = 0
-        transforms.append(TT.Lambda(lambda x: x[:, args.top_offset:(x.shape[1] - args.bottom_offset)]))
+        # indexing from the end so the same transform works on single images (CHW) and batches (NCHW) - slicing makes a view, not a copy
+        transforms.append(TT.Lambda(lambda x: x[..., args.top_offset:(x.shape[-2] - args.bottom_offset), :]))
     if args.undo_motion_blur:
-        transforms.append(TT.Lambda(lambda x: wiener_filter(x, torch.tensor([[1, 4, 6, 4, 1], [4, 16, 24, 16, 4], [6, 24, 36, 24, 6], [4, 16, 24, 16, 4], [1, 4, 6, 4, 1]], dtype=torch.float32) / 256)))
-    if args.brightness_mult is not None:
+        # the filter works on [0,1] floats; clamp since ToDtype doesn't clip when converting back to uint8
         transforms.append(TT.ToDtype(torch.float32, scale=True))
-        transforms.append(TT.Lambda(lambda x: TT.functional.adjust_brightness(x, args.brightness_mult).clip(0,1)))
+        transforms.append(TT.Lambda(lambda x: wiener_filter(x, DEBLUR_KERNEL).clamp(0, 1)))
+        if args.brightness_mult is not None:
+            # already in float, and a lookup table after rounding to uint8 would round twice
+            transforms.append(TT.Lambda(lambda x: TT.functional.adjust_brightness(x, args.brightness_mult).clip(0, 1)))
         transforms.append(TT.ToDtype(torch.uint8, scale=True))
-    transforms.append(TT.ToDtype(torch.uint8, scale=True))
-    postprocessor = TT.Compose(transforms)
-    # get all image filenames in the directory
-    file_paths = [os.path.join(args.dir_path, p) for p in os.listdir(args.dir_path)]
-    file_paths = list(filter(lambda x: not os.path.isdir(x), file_paths))[:20]
+    elif args.brightness_mult is not None:
+        lut = get_brightness_lut(args.brightness_mult)
+        # a factor that rounds back to every original value (e.g. 1.0) is skipped entirely
+        if not np.array_equal(lut, np.arange(256)):
+            transforms.append(TT.Lambda(lambda x: apply_lut_(x, lut)))
+    return TT.Compose(transforms or [TT.Identity()])
+
+def read_frame(path: str, stats: StageStats = None):
+    import torchvision.io as IO
+    # reading the file and decoding it are timed separately, so slow storage and slow decoding can be told apart
+    with stage_timer(stats, "read"):
+        data = IO.read_file(path)
+    with stage_timer(stats, "decode"):
+        return path, IO.decode_image(data, IO.ImageReadMode.RGB)
+
+def read_batch(paths, stats: StageStats = None):
+    return [read_frame(path, stats) for path in paths]
+
+def postprocess_batch(batch, postprocessor: TT.Compose):
+    """ group images in the batch by shape and run each group through the postprocessor as one NCHW tensor """
+    import torch
+    groups = {}
+    for path, img in batch:
+        groups.setdefault(tuple(img.shape), []).append((path, img))
+    processed = []
+    for group in groups.values():
+        paths, imgs = zip(*group)
+        processed.extend(zip(paths, postprocessor(torch.stack(imgs)).unbind(0)))
+    return processed
+
+def write_batch(batch, dest_dir: str, overwrite: bool, options: EncoderOptions, shards: ShardWriter = None, stats: StageStats = None, verbose: bool = False):
+    return [write_frame(path, img, dest_dir, overwrite, options, shards, stats, verbose) for path, img in batch]
+
+def get_transform_params(args: argparse.Namespace) -> dict:
+    """ everything that affects the output bytes - used as the cache key for processed frames """
+    return {
+        "top_offset": args.top_offset or 0,
+        "bottom_offset": args.bottom_offset or 0,
+        "brightness_mult": args.brightness_mult,
+        "undo_motion_blur": args.undo_motion_blur,
+        **get_encoder_params(get_encoder_options(args))
+    }
+
+def get_dest_path(path: str, dest_dir: str, overwrite: bool, options: EncoderOptions) -> str:
+    """ output path for an input image, with the extension of the output format """
+    return get_output_path(path if overwrite else os.path.join(dest_dir, os.path.basename(path)), options)
+
+def print_pixel_range(path: str, img: torch.Tensor):
+    # ! each call reduces over the whole image (and syncs the device), so this is only done with --verbose
+    print(f"pixel value range for {os.path.basename(path)}: {img.min().item()} to {img.max().item()}")
+
+def write_frame(path: str, img: torch.Tensor, dest_dir: str, overwrite: bool, options: EncoderOptions, shards: ShardWriter = None,
+                stats: StageStats = None, verbose: bool = False):
+    if verbose:
+        print_pixel_range(path, img)
+    if shards is not None:
+        shards.add(img, path)
+    else:
+        write_encoded_frame(img, get_dest_path(path, dest_dir, overwrite, options), options, stats)
+    return path
+
+def save_run_metadata(output_dir: str, args: argparse.Namespace, num_frames: int, run_stats: dict) -> str:
+    """ append this run's parameters and statistics to postprocess_metadata.json in the output directory """
+    metadata_path = os.path.join(output_dir, METADATA_FILENAME)
+    metadata = {"runs": []}
+    if os.path.exists(metadata_path):
+        with open(metadata_path, 'r') as fptr:
+            metadata = json.load(fptr)
+    metadata["runs"].append({"dir_path": os.path.abspath(args.dir_path), "params": get_transform_params(args), "num_frames": num_frames,
+                             "workers": args.workers, "batch_size": args.batch_size, "encode_workers": args.encode_workers, "run_stats": run_stats})
+    with open(metadata_path, 'w') as fptr:
+        json.dump(metadata, fptr, indent=4)
+    return metadata_path
+
+def get_unprocessed_paths(dir_path: str, dest_dir: str, overwrite: bool, options: EncoderOptions, cache: OutputCache = None, limit: int = None,
+                          catalog: FrameCatalog = None, rescan: bool = False):
+    """ get all image paths in the directory, leaving out those with an up-to-date output in the cache
+        with a catalog, the paths come from its index in timestamp order and cache should be the catalog's postprocess stage
+        (frames marked done whose output was deleted or replaced are processed again) - rescan catches inputs rewritten in place
+    """
+    if catalog is not None:
+        # the directory is only listed again if it changed since it was last cataloged (or with rescan)
+        catalog.scan(dir_path, rescan=rescan)
+        # the pending frames come straight from the catalog's indexed query rather than filtering the whole directory
+        file_paths = cache.get_pending_paths(dir_path, limit) if cache is not None else catalog.get_paths(dir_path, limit=limit)
+    else:
+        # one scandir pass over each directory - DirEntry.stat() still makes a stat call per file on POSIX, but nothing is looked up by path
+        input_stats = scan_file_stats(dir_path)
+        file_paths = [os.path.join(dir_path, name) for name in input_stats]
+        if cache is not None:
+            cache.prune(input_stats.keys())
+            output_stats = input_stats if overwrite else scan_file_stats(dest_dir)
+            dest_paths = [get_dest_path(path, dest_dir, overwrite, options) for path in file_paths]
+            file_paths = [path for path, dest_path in zip(file_paths, dest_paths)
+                          if not cache.is_fresh(path, dest_path, input_stats[os.path.basename(path)], output_stats.get(os.path.basename(dest_path)))]
+    # the limit is applied to the frames that still need processing, so repeated runs with --limit work through the directory in chunks
+    file_paths = file_paths[:limit]
+    if overwrite and any(get_dest_path(path, dest_dir, overwrite, options) != path for path in file_paths):
+        # writing next to the originals would leave both copies in the directory, and the new files would be picked up as inputs on the next run
+        raise ValueError(f"--overwrite replaces images in place, so every image in {dir_path} must already be in the '{options.format}' output format")
+    return file_paths
+
+def process_frames(file_paths, postprocessor: TT.Compose, dest_dir: str, overwrite: bool, workers: int = 1, queue_size: int = None, batch_size: int = 1,
+                   cache: OutputCache = None, options: EncoderOptions = None, encode_workers: int = 4, shards: ShardWriter = None,
+                   stats: StageStats = None, verbose: bool = False):
+    """ read, postprocess, and write each image - with workers > 1, each stage runs on its own thread pool so decoding, transforms, and encoding overlap
+        with batch_size > 1, images are passed between stages in batches and same-shape images are transformed together
+        encoding always runs on encode_workers threads, so even the sequential path reads the next image while earlier ones are encoded
+        if shards is given, images are packed into it instead of written to dest_dir (and it's closed at the end)
+        if stats is given, the read, decode, transform, encode, and write stages are timed into it (transforms are timed per batch group)
+    """
+    options = options or EncoderOptions()
+    if shards is not None:
+        shards.stats = stats
+    if stats is not None:
+        untimed_postprocessor = postprocessor
+        def postprocessor(img):
+            with stats.time("transform"):
+                return untimed_postprocessor(img)
+    def record_written(paths):
+        if cache is not None:
+            for path in paths:
+                cache.record(path, get_dest_path(path, dest_dir, overwrite, options))
+    try:
+        if batch_size > 1:
+            process_frame_batches(file_paths, postprocessor, dest_dir, overwrite, workers, queue_size, batch_size, record_written, options, encode_workers, shards, stats, verbose)
+        else:
+            process_single_frames(file_paths, postprocessor, dest_dir, overwrite, workers, queue_size, record_written, options, encode_workers, shards, stats, verbose)
+    finally:
+        if shards is not None:
+            shards.close()
+        # save even if interrupted so the frames that did finish are skipped next time
+        if cache is not None:
+            cache.save()
+
+def process_single_frames(file_paths, postprocessor: TT.Compose, dest_dir: str, overwrite: bool, workers: int, queue_size: int, record_written,
+                          options: EncoderOptions, encode_workers: int, shards: ShardWriter = None, stats: StageStats = None, verbose: bool = False):
     with tqdm(total=len(file_paths), desc="Processing images") as pbar:
-        for path in file_paths:
-            pbar.set_description(f"processing {os.path.basename(path)}", refresh=False)
-            img = IO.read_image(path, IO.ImageReadMode.RGB)
-            img = postprocessor(img)
-            print(f"pixel value range for {os.path.basename(path)}: {img.min().item()} to {img.max().item()}")
-            if args.overwrite:
-                IO.write_png(img, path, compression_level=3)
-            else:
-                dest_path = os.path.join(dest_dir, os.path.basename(path))
-                IO.write_png(img, dest_path, compression_level=2)
-            #print(img.unique())
-            pbar.update()
\ No newline at end of file
+        if workers <= 1:
+            pool = shards if shards is not None else EncodePool(options, encode_workers, stats=stats)
+            try:
+                for path in file_paths:
+                    pbar.set_description(f"processing {os.path.basename(path)}", refresh=False)
+                    path, img = read_frame(path, stats)
+                    img = postprocessor(img)
+                    if verbose:
+                        print_pixel_range(path, img)
+                    pool.submit(img, get_dest_path(path, dest_dir, overwrite, options), tag=path)
+                    # only frames that are actually on disk go into the cache
+                    record_written(pool.pop_written())
+                    pbar.update()
+            finally:
+                # frames written before a failed one are still recorded
+                try:
+                    pool.close()
+                finally:
+                    record_written(pool.pop_written())
+            return
+        pipeline = Pipeline([
+            (lambda path: read_frame(path, stats), workers),
+            (lambda item: (item[0], postprocessor(item[1])), workers),
+            (lambda item: write_frame(*item, dest_dir, overwrite, options, shards, stats, verbose), encode_workers),
+        ], queue_size=queue_size or 2*workers)
+        for path in pipeline.run(file_paths):
+            record_written([path])
+            pbar.set_description(f"processed {os.path.basename(path)}", refresh=False)
+            pbar.update()
+
+def process_frame_batches(file_paths, postprocessor: TT.Compose, dest_dir: str, overwrite: bool, workers: int, queue_size: int, batch_size: int, record_written,
+                          options: EncoderOptions, encode_workers: int, shards: ShardWriter = None, stats: StageStats = None, verbose: bool = False):
+    path_batches = [file_paths[i:i + batch_size] for i in range(0, len(file_paths), batch_size)]
+    with tqdm(total=len(file_paths), desc="Processing image batches") as pbar:
+        if workers <= 1:
+            pool = shards if shards is not None else EncodePool(options, encode_workers, max_pending=2*batch_size, stats=stats)
+            try:
+                for paths in path_batches:
+                    for path, img in postprocess_batch(read_batch(paths, stats), postprocessor):
+                        if verbose:
+                            print_pixel_range(path, img)
+                        pool.submit(img, get_dest_path(path, dest_dir, overwrite, options), tag=path)
+                    record_written(pool.pop_written())
+                    pbar.update(len(paths))
+            finally:
+                # frames written before a failed one are still recorded
+                try:
+                    pool.close()
+                finally:
+                    record_written(pool.pop_written())
+            return
+        pipeline = Pipeline([
+            (lambda paths: read_batch(paths, stats), workers),
+            (lambda batch: postprocess_batch(batch, postprocessor), workers),
+            (lambda batch: write_batch(batch, dest_dir, overwrite, options, shards, stats, verbose), encode_workers),
+        ], queue_size=queue_size or 2*workers)
+        for paths in pipeline.run(path_batches):
+            record_written(paths)
+            pbar.update(len(paths))
+
+
+def main(args: argparse.Namespace):
+    ### handle file existence, path creation, and confirmation of path existences
+    if not os.path.exists(args.dir_path):
+        raise FileNotFoundError(f"Couldn't find the directory at {args.dir_path}")
+    if not os.path.isdir(args.dir_path):
+        raise NotADirectoryError(f"{args.dir_path} is not a directory.")
+    # adding a check because I keep screwing up frames when giving the wrong path and want a warning each time
+    if not args.yes:
+        _ = get_user_confirmation(f"Processing {args.dir_path}. Continue?")
+    dest_dir = os.path.join(args.dir_path, 'processed')
+    os.makedirs(dest_dir, exist_ok=True)
+    postprocessor = get_postprocessor(args)
+    options = get_encoder_options(args)
+    cache = None
+    shards = None
+    catalog = FrameCatalog(args.catalog) if args.catalog is not None else None
+    if args.shard_dir is not None:
+        # the cache tracks output files, so it doesn't apply to shards - every frame is packed
+        shards = get_shard_writer(args.shard_format, args.shard_dir, guess_video_id(args.dir_path), args.frames_per_shard, options=options)
+    elif catalog is not None and not args.no_cache:
+        # the catalog records which frames are done instead of the JSON cache - the destination is part of the parameters since the state is per input frame
+        cache = catalog.get_stage("postprocess", {**get_transform_params(args), "dest": "overwrite" if args.overwrite else os.path.abspath(dest_dir)})
+    elif not args.no_cache:
+        cache = OutputCache(os.path.join(dest_dir, CACHE_FILENAME), get_transform_params(args), args.cache_content_hash)
+    # get all image filenames in the directory that still need processing
+    file_paths = get_unprocessed_paths(args.dir_path, dest_dir, args.overwrite and shards is None, options, cache, args.limit, catalog, args.rescan)
+    print(f"{len(file_paths)} images to process")
+    instrumentation = Instrumentation.from_args(args)
+    with instrumentation:
+        process_frames(file_paths, postprocessor, dest_dir, args.overwrite, args.workers, args.queue_size, args.batch_size, cache, options, args.encode_workers, shards,
+                       instrumentation.stats, args.verbose)
+    if instrumentation.enabled:
+        metadata_path = save_run_metadata(args.shard_dir or dest_dir, args, len(file_paths), instrumentation.summary())
+        print(f"run statistics added to {metadata_path}")
+    if catalog is not None:
+        catalog.close()
+
+
+if __name__ == "__main__":
+    main(read_cli())
@@ -1,41 +1,310 @@
 import os
+import json
+import time
+import uuid
+import argparse
+import threading
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
 
-""" used this script to rename all the frames in the subdirectories of the root directory that already existed - made it easier to keep track of which frames belonged to which video """
-
-def rename_frames_in_subdirs(root_dir):
-    # Iterate over all subdirectories within the root directory
-    for subdir in os.listdir(root_dir):
-        subdir_path = os.path.join(root_dir, subdir)
-        
-        # Ensure we're dealing with a directory
-        if os.path.isdir(subdir_path):
-            frames_dir = os.path.join(subdir_path, 'frames')
-            
-            # Check if the 'frames' subdirectory exists
-            if os.path.exists(frames_dir) and os.path.isdir(frames_dir):
-                print(f"Processing frames in: {frames_dir}")
-                
-                # Iterate over all files in the frames directory
-                for filename in os.listdir(frames_dir):
-                    file_path = os.path.join(frames_dir, filename)
-                    
-                    # Check if it's a file (could add more checks for image types if needed)
-                    if os.path.isfile(file_path):
-                        # Construct the new file name with the prefix
-                        prefix = f"{subdir}_"
-                        # Skip renaming if the file already has the correct prefix
-                        if filename.startswith(prefix):
-                            print(f"Skipping {filename}, already renamed.")
-                            continue
-                        
-                        new_filename = f"{prefix}{filename}"
-                        new_file_path = os.path.join(frames_dir, new_filename)
-                        
-                        # Rename the file
-                        os.rename(file_path, new_file_path)
-                        print(f"Renamed {filename} to {new_filename}")
+""" used this script to rename all the frames in the subdirectories of the root directory that already existed - made it easier to keep track of which frames belonged to which video
+    every root_dir/<video>/frames directory is planned with a single scandir pass, and directories are renamed concurrently on a thread pool (renames on a network share are latency-bound)
+    each run appends its plans to a JSONL journal before renaming anything, so an interrupted run can be resumed and a run can be rolled back
+"""
+
+JOURNAL_FILENAME = ".rename_journal.jsonl"
+# number of failed renames listed after the summary
+MAX_LISTED_FAILURES = 10
+# root directory the frames were originally renamed in
+default_root_dir = r"C:\Users\Jacob\Documents\MSU Thesis Work\dirtydashcams"
+
+
+@dataclass
+class RenamePlan:
+    """ dataclass for the renames of one frames directory, as [old name, new name] pairs """
+    frames_dir: str
+    renames: list = field(default_factory=list)
+    already_prefixed: int = 0
+    # frames whose prefixed name is already taken - renaming them would overwrite another frame
+    conflicts: list = field(default_factory=list)
+
+
+@dataclass
+class RenameSummary:
+    """ dataclass for the totals of a run """
+    dirs: int = 0
+    renamed: int = 0
+    already_prefixed: int = 0
+    conflicts: int = 0
+    failed: list = field(default_factory=list)
+
+    def add(self, plan: RenamePlan, renamed: int, failed: list):
+        self.dirs += 1
+        self.renamed += renamed
+        self.already_prefixed += plan.already_prefixed
+        self.conflicts += len(plan.conflicts)
+        self.failed.extend(os.path.join(plan.frames_dir, name) + f" ({error})" for name, error in failed)
+
+
+@dataclass
+class JournalRun:
+    """ dataclass for what the journal says about one run: its plans by directory and the directories it finished """
+    run_id: str
+    begin: dict
+    plans: dict = field(default_factory=dict)
+    done: set = field(default_factory=set)
+    ended: bool = False
+
+
+class RenameJournal:
+    """ append-only JSONL log of runs - a run is a begin record, a plan record per directory (synced to disk before its renames start),
+        a done record per finished directory, and an end record with the summary
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fptr = None
+
+    def append(self, record: dict, sync: bool = False):
+        with self.lock:
+            if self.fptr is None:
+                self.fptr = open(self.path, 'a', encoding='utf-8')
+            self.fptr.write(json.dumps(record) + "\n")
+            self.fptr.flush()
+            if sync:
+                os.fsync(self.fptr.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.fptr is not None:
+                self.fptr.close()
+                self.fptr = None
+
+    def read_runs(self) -> list:
+        """ runs in the order they were started - a second begin record for a known run id is an error, since replacing the run would lose its plans """
+        runs = {}
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r', encoding='utf-8') as fptr:
+            for line_num, line in enumerate(fptr, start=1):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line can be cut off if the process was killed mid-write
+                    continue
+                if record["type"] == "begin":
+                    if record["run_id"] in runs:
+                        raise ValueError(f"run '{record['run_id']}' begins a second time at line {line_num} of the journal {self.path}, "
+                                         "so the records of the two runs can't be told apart")
+                    runs[record["run_id"]] = JournalRun(record["run_id"], record)
+                elif record["run_id"] in runs:
+                    run = runs[record["run_id"]]
+                    if record["type"] == "plan":
+                        run.plans[record["dir"]] = record["renames"]
+                    elif record["type"] == "done":
+                        run.done.add(record["dir"])
+                    elif record["type"] == "end":
+                        run.ended = True
+        return list(runs.values())
+
+    def get_run(self, run_id: str = None, with_renames: bool = False) -> JournalRun:
+        """ a run by id, or the latest one (that renamed anything, with with_renames) """
+        runs = self.read_runs()
+        if run_id is None:
+            runs = [run for run in runs if run.plans or not with_renames]
+            if not runs:
+                raise ValueError(f"no runs{' with renames' if with_renames else ''} in the journal {self.path}")
+            return runs[-1]
+        for run in runs:
+            if run.run_id == run_id:
+                return run
+        raise ValueError(f"no run '{run_id}' in the journal {self.path}")
+
+    def get_resumable_run(self) -> JournalRun:
+        """ the latest run, which must have been interrupted - a run with an end record finished and has nothing left to resume """
+        run = self.get_run()
+        if run.ended:
+            kind = f"rollback of {run.begin['rollback_of']}" if "rollback_of" in run.begin else "run"
+            raise ValueError(f"the latest {kind} in the journal ({run.run_id}) already finished, so there's nothing to resume")
+        return run
+
+
+def new_run_id() -> str:
+    """ unique id for a run - the time only makes ids readable, since several runs can start in the same second of one process (e.g. cli.py batch) """
+    return f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex}"
+
+def list_frames_dirs(root_dir: str) -> list:
+    """ (video_id, frames_dir) for every subdirectory of the root directory - frames_dir may not exist """
+    with os.scandir(root_dir) as entries:
+        return sorted((entry.name, os.path.join(root_dir, entry.name, 'frames')) for entry in entries if entry.is_dir())
+
+def plan_renames(video_id: str, frames_dir: str) -> RenamePlan:
+    """ plan '<video_id>_' prefixes for the files of a frames directory from one scandir pass - None if there's no frames directory """
+    prefix = f"{video_id}_"
+    try:
+        with os.scandir(frames_dir) as entries:
+            # is_file comes from the directory listing itself on Windows and on most Linux filesystems, so there's no stat per file
+            names = {entry.name for entry in entries if entry.is_file()}
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    plan = RenamePlan(frames_dir)
+    for name in sorted(names):
+        if name.startswith(prefix):
+            plan.already_prefixed += 1
+        elif prefix + name in names:
+            plan.conflicts.append(name)
+        else:
+            plan.renames.append([name, prefix + name])
+    return plan
+
+def apply_renames(frames_dir: str, renames: list, check_existing: bool = False, verbose: bool = False):
+    """ rename [old, new] pairs within a directory - returns the number renamed and the [name, error] of each failure
+        with check_existing, a pair is checked first, since a resumed or rolled back plan may already be partly done and os.rename overwrites on POSIX
+    """
+    renamed, failed = 0, []
+    for old, new in renames:
+        src, dst = os.path.join(frames_dir, old), os.path.join(frames_dir, new)
+        if check_existing and os.path.lexists(dst):
+            if os.path.lexists(src):
+                failed.append([old, f"{new} already exists"])
+            else:
+                renamed += 1
+            continue
+        try:
+            os.rename(src, dst)
+        except OSError as err:
+            failed.append([old, str(err)])
+            continue
+        renamed += 1
+        if verbose:
+            print(f"Renamed {old} to {new}")
+    return renamed, failed
+
+def run_plan(plan: RenamePlan, journal: RenameJournal, run_id: str, journaled: bool = False, check_existing: bool = False, verbose: bool = False):
+    """ journal a directory's plan, apply it, and journal that it's done - journaled plans (from a resumed run) aren't written again """
+    if plan.renames and not journaled:
+        journal.append({"type": "plan", "run_id": run_id, "dir": plan.frames_dir, "renames": plan.renames}, sync=True)
+    renamed, failed = apply_renames(plan.frames_dir, plan.renames, check_existing, verbose)
+    journal.append({"type": "done", "run_id": run_id, "dir": plan.frames_dir, "renamed": renamed, "failed": failed})
+    return renamed, failed
+
+def run_tasks(tasks: list, workers: int, desc: str) -> RenameSummary:
+    """ run the per-directory tasks on a thread pool - each returns (plan, renamed, failed), or None if there was nothing to do """
+    summary = RenameSummary()
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=len(tasks), desc=desc) as pbar:
+        for future in as_completed([executor.submit(task) for task in tasks]):
+            result = future.result()
+            if result is not None:
+                summary.add(*result)
+            pbar.update()
+    return summary
+
+def rename_frames_in_subdirs(root_dir: str, workers: int = 16, journal_path: str = None, dry_run: bool = False, resume: bool = False, verbose: bool = False):
+    """ prefix the frames of every root_dir/<video>/frames directory with '<video>_' - returns the run id and its summary
+        with resume, the latest run continues: finished directories are skipped, journaled plans are finished, and the rest are planned as usual
+    """
+    journal = RenameJournal(journal_path or os.path.join(root_dir, JOURNAL_FILENAME))
+    journaled_plans, done_dirs = {}, set()
+    if resume:
+        run = journal.get_resumable_run()
+        run_id, journaled_plans, done_dirs = run.run_id, run.plans, run.done
+    else:
+        run_id = new_run_id()
+        if not dry_run:
+            journal.append({"type": "begin", "run_id": run_id, "root_dir": os.path.abspath(root_dir), "time": time.time()}, sync=True)
+
+    def task(video_id, frames_dir):
+        frames_dir = os.path.abspath(frames_dir)
+        if frames_dir in done_dirs:
+            return None
+        if frames_dir in journaled_plans:
+            plan = RenamePlan(frames_dir, journaled_plans[frames_dir])
+            return plan, *run_plan(plan, journal, run_id, journaled=True, check_existing=True, verbose=verbose)
+        plan = plan_renames(video_id, frames_dir)
+        if plan is None:
+            return None
+        if dry_run:
+            if verbose:
+                for old, new in plan.renames:
+                    print(f"would rename {os.path.join(frames_dir, old)} to {new}")
+            return plan, len(plan.renames), []
+        return plan, *run_plan(plan, journal, run_id, verbose=verbose)
+
+    try:
+        summary = run_tasks([lambda args=args: task(*args) for args in list_frames_dirs(root_dir)], workers, "Renaming frames")
+        if not dry_run:
+            journal.append({"type": "end", "run_id": run_id, "summary": asdict(summary)})
+    finally:
+        journal.close()
+    return run_id, summary
+
+def rollback_run(journal_path: str, run_id: str = None, workers: int = 16, dry_run: bool = False, verbose: bool = False, resume: bool = False):
+    """ undo the renames of a run (the latest one that renamed anything by default) - the rollback is journaled as a run of its own, so it can be resumed or rolled back too
+        with resume, the latest run must be an interrupted rollback, which continues where it stopped
+    """
+    journal = RenameJournal(journal_path)
+    done_dirs = set()
+    if resume:
+        rollback = journal.get_resumable_run()
+        run, rollback_id, done_dirs = journal.get_run(rollback.begin["rollback_of"]), rollback.run_id, rollback.done
+    else:
+        run = journal.get_run(run_id, with_renames=True)
+        rollback_id = new_run_id()
+        if not dry_run:
+            journal.append({"type": "begin", "run_id": rollback_id, "rollback_of": run.run_id, "root_dir": run.begin.get("root_dir"), "time": time.time()}, sync=True)
+
+    def task(frames_dir, renames):
+        if frames_dir in done_dirs:
+            return None
+        plan = RenamePlan(frames_dir, [[new, old] for old, new in reversed(renames)])
+        if dry_run:
+            return plan, sum(os.path.lexists(os.path.join(frames_dir, new)) for new, _ in plan.renames), []
+        return plan, *run_plan(plan, journal, rollback_id, check_existing=True, verbose=verbose)
+
+    try:
+        summary = run_tasks([lambda item=item: task(*item) for item in run.plans.items()], workers, f"Rolling back {run.run_id}")
+        if not dry_run:
+            journal.append({"type": "end", "run_id": rollback_id, "summary": asdict(summary)})
+    finally:
+        journal.close()
+    return rollback_id, summary
+
+def print_summary(run_id: str, summary: RenameSummary, elapsed: float, dry_run: bool = False):
+    renamed = f"{summary.renamed} frames would be renamed" if dry_run else f"{summary.renamed} frames renamed"
+    print(f"{'DRY RUN - ' if dry_run else ''}{summary.dirs} directories: {renamed}, {summary.already_prefixed} already prefixed, "
+          f"{summary.conflicts} conflicts, {len(summary.failed)} failed in {elapsed:.1f}s" + ("" if dry_run else f" (run {run_id})"))
+    for failure in summary.failed[:MAX_LISTED_FAILURES]:
+        print(f"  FAILED: {failure}")
+    if len(summary.failed) > MAX_LISTED_FAILURES:
+        print(f"  ... and {len(summary.failed) - MAX_LISTED_FAILURES} more")
+
+
+def add_args(parser: argparse.ArgumentParser):
+    parser.add_argument('root_dir', type=str, nargs='?', default=default_root_dir, help='directory with one subdirectory per video, each holding a frames directory')
+    parser.add_argument('--workers', type=int, default=16, help='number of directories renamed concurrently')
+    parser.add_argument('--dry_run', action='store_true', help='only plan the renames and print the summary')
+    parser.add_argument('--journal', type=str, default=None, help=f'path of the rename journal (default: root_dir/{JOURNAL_FILENAME})')
+    parser.add_argument('--resume', action='store_true', help='continue the latest run in the journal instead of starting a new one')
+    parser.add_argument('--rollback', type=str, nargs='?', const='latest', default=None, metavar='RUN_ID', help='undo the renames of a run (default: the latest run that renamed anything)')
+    parser.add_argument('--verbose', action='store_true', help='print every rename')
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Prefix the frames in every root_dir/<video>/frames directory with the video name.")
+    add_args(parser)
+    return parser.parse_args()
+
+def main(args: argparse.Namespace):
+    if not os.path.isdir(args.root_dir):
+        raise NotADirectoryError(f"{args.root_dir} is not a directory.")
+    start = time.perf_counter()
+    journal_path = args.journal or os.path.join(args.root_dir, JOURNAL_FILENAME)
+    # resuming an interrupted rollback finishes the rollback rather than renaming again
+    if args.rollback is not None or (args.resume and "rollback_of" in RenameJournal(journal_path).get_resumable_run().begin):
+        run_id, summary = rollback_run(journal_path, None if args.rollback in (None, 'latest') else args.rollback, args.workers, args.dry_run, args.verbose, args.resume)
+    else:
+        run_id, summary = rename_frames_in_subdirs(args.root_dir, args.workers, journal_path, args.dry_run, args.resume, args.verbose)
+    print_summary(run_id, summary, time.perf_counter() - start, args.dry_run)
 
 if __name__ == "__main__":
-    # Replace 'your_directory_path' with the path to your root directory
-    root_directory = r"C:\Users\Jacob\Documents\MSU Thesis Work\dirtydashcams"
-    rename_frames_in_subdirs(root_directory)
+    main(read_cli())
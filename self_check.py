@@ -0,0 +1,53 @@
+import sys
+import time
+import argparse
+import importlib
+import traceback
+
+""" self-checks that exercise the tools end to end on generated data - quicker to run after a change than a full benchmark, and they need no sample videos
+    each check is a function in the module it covers that raises AssertionError on a mismatch; modules are only imported once their check runs
+"""
+
+# check -> (module, function, summary)
+CHECKS = {
+    "lut": ("postprocess_frames", "check_apply_lut", "brightness lookup table is bit-identical on contiguous, channels-last, cropped and batched tensors"),
+    "ingest": ("ingest", "check_local_ingest", "download from a local HTTP server and rip end to end, then rerun and skip"),
+}
+
+
+def add_args(parser: argparse.ArgumentParser):
+    parser.add_argument('checks', type=str, nargs='*', metavar='check', help=f"checks to run (default: all of {', '.join(CHECKS)})")
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the self-checks of the frame tools.")
+    add_args(parser)
+    return parser.parse_args()
+
+
+def run_check(name: str) -> bool:
+    module_name, function_name, summary = CHECKS[name]
+    print(f"{name}: {summary}")
+    start = time.perf_counter()
+    try:
+        result = getattr(importlib.import_module(module_name), function_name)()
+    except Exception:
+        traceback.print_exc()
+        print(f"  FAILED after {time.perf_counter() - start:.2f}s")
+        return False
+    print(f"  ok ({result} checked) in {time.perf_counter() - start:.2f}s" if isinstance(result, int) else f"  ok in {time.perf_counter() - start:.2f}s")
+    return True
+
+
+def main(args: argparse.Namespace):
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        raise ValueError(f"unknown checks {unknown} (expected some of {list(CHECKS)})")
+    failed = [name for name in (args.checks or CHECKS) if not run_check(name)]
+    if failed:
+        print(f"FAILED: {', '.join(failed)}")
+        sys.exit(1)
+    print("all checks passed")
+
+
+if __name__ == "__main__":
+    main(read_cli())
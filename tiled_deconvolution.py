@@ -0,0 +1,87 @@
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+""" tile-based restoration for spatially varying motion blur
+    each tile gets a compact linear motion PSF from the mean optical flow inside it, is deconvolved with a Wiener filter,
+    and the tiles are blended back together with overlapping windows - nothing larger than a tile is ever transformed
+"""
+
+DEFAULT_TILE_SIZE = 256
+# PSF lengths are rounded to this many pixels and angles to this many degrees so that tiles with similar motion share a cached filter
+LENGTH_QUANTUM = 0.5
+ANGLE_QUANTUM = 5
+# blur shorter than this (in pixels) is left alone
+MIN_BLUR_LENGTH = 1.0
+MAX_BLUR_LENGTH = 64
+
+
+def motion_psf(length: float, angle: float, shape: tuple) -> np.ndarray:
+    """ normalized linear motion PSF of the given length (pixels) and angle (degrees), centered at (0, 0) with wraparound so it doesn't shift the image """
+    psf = np.zeros(shape, dtype=np.float32)
+    num_samples = max(int(np.ceil(4*length)), 2)
+    offsets = np.linspace(-length/2, length/2, num_samples)
+    rows = np.round(offsets*np.sin(np.deg2rad(angle))).astype(int) % shape[0]
+    cols = np.round(offsets*np.cos(np.deg2rad(angle))).astype(int) % shape[1]
+    np.add.at(psf, (rows, cols), 1)
+    return psf/psf.sum()
+
+@lru_cache(maxsize=256)
+def get_wiener_response(length: float, angle: float, shape: tuple, balance: float) -> np.ndarray:
+    """ cached frequency response conj(H)/(|H|^2 + balance) of a motion PSF for one tile shape (real FFT layout) """
+    psf_fft = np.fft.rfft2(motion_psf(length, angle, shape))
+    return (np.conj(psf_fft)/(np.abs(psf_fft)**2 + balance)).astype(np.complex64)
+
+@lru_cache(maxsize=16)
+def get_blend_window(shape: tuple) -> np.ndarray:
+    """ separable Hann window for overlap-add blending - trimmed so that it's strictly positive and border pixels still get weight """
+    window_y = np.hanning(shape[0] + 2)[1:-1]
+    window_x = np.hanning(shape[1] + 2)[1:-1]
+    return np.outer(window_y, window_x).astype(np.float32)
+
+def get_tile_starts(length: int, tile_size: int) -> list:
+    """ tile start positions with 50% overlap, with the last tile flush against the end """
+    if length <= tile_size:
+        return [0]
+    step = tile_size//2
+    starts = list(range(0, length - tile_size, step))
+    return starts + [length - tile_size]
+
+def get_tile_psf_params(tile_flow: np.ndarray) -> tuple:
+    """ quantized (length, angle) of the mean motion in a tile, or None if the tile barely moved """
+    dy, dx = float(np.mean(tile_flow[0])), float(np.mean(tile_flow[1]))
+    length = min(np.hypot(dy, dx), MAX_BLUR_LENGTH)
+    if length < MIN_BLUR_LENGTH:
+        return None
+    angle = np.rad2deg(np.arctan2(dy, dx)) % 180
+    return round(length/LENGTH_QUANTUM)*LENGTH_QUANTUM, (round(angle/ANGLE_QUANTUM)*ANGLE_QUANTUM) % 180
+
+def deconvolve_tile(tile: np.ndarray, psf_params: tuple, balance: float) -> np.ndarray:
+    if psf_params is None:
+        return tile
+    response = get_wiener_response(*psf_params, tile.shape, balance)
+    return np.fft.irfft2(np.fft.rfft2(tile)*response, s=tile.shape).astype(np.float32)
+
+def deconvolve_tiled(image: np.ndarray, flow: np.ndarray, tile_size: int = DEFAULT_TILE_SIZE, balance: float = 1e-2, workers: int = 1) -> np.ndarray:
+    """ restore a grayscale float image given the (2, H, W) optical flow describing its motion blur
+        tiles are deconvolved on a thread pool (numpy's FFT releases the GIL) and accumulated with overlap-add windows
+    """
+    height, width = image.shape
+    tile_shape = (min(tile_size, height), min(tile_size, width))
+    window = get_blend_window(tile_shape)
+    tiles = [(y, x) for y in get_tile_starts(height, tile_shape[0]) for x in get_tile_starts(width, tile_shape[1])]
+
+    def process_tile(start):
+        y, x = start
+        region = (slice(y, y + tile_shape[0]), slice(x, x + tile_shape[1]))
+        psf_params = get_tile_psf_params(flow[(slice(None), *region)])
+        return region, deconvolve_tile(image[region], psf_params, balance)
+
+    restored = np.zeros_like(image, dtype=np.float32)
+    weights = np.zeros_like(image, dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        # accumulation stays on this thread so tiles never write to the same pixels concurrently
+        for region, tile in executor.map(process_tile, tiles):
+            restored[region] += tile*window
+            weights[region] += window
+    return restored/weights
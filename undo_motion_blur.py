@@ -1,21 +1,79 @@
 import os
-import cv2
+import argparse
+from dataclasses import dataclass, asdict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import numpy as np
 import numpy.fft as fft
-from skimage.registration import optical_flow_tvl1
-from skimage.filters import wiener
+from flow_backends import FLOW_BACKENDS, compute_flow
+from tqdm import tqdm
+from tiled_deconvolution import DEFAULT_TILE_SIZE, deconvolve_tiled
+from frame_catalog import FrameCatalog, add_catalog_args
+from output_cache import hash_params
+from frame_encoders import OUTPUT_FORMATS, FORMAT_EXTENSIONS, decode_frame, get_path_format
+
+# frames restored per process pool job - each job decodes one extra frame (its first frame's predecessor)
+PARALLEL_CHUNK_SIZE = 8
+
+
+@dataclass
+class DeblurParams:
+    """ dataclass for storing the parameters of the deblurring process """
+    time_step: int = 2001
+    flow_backend: str = "tvl1"
+    # 'global' deconvolves the whole frame with the flow-magnitude kernel; 'tiled' uses a local motion PSF per tile
+    restoration: str = "global"
+    tile_size: int = DEFAULT_TILE_SIZE
+    tile_workers: int = 1
+
+
+def add_args(parser: argparse.ArgumentParser):
+    parser.add_argument('input_dir', type=str, help='path to frame directory (frames named like frame_{timestamp}.png)')
+    parser.add_argument('--output_dir', type=str, default=None, help='destination for restored frames (default: input_dir/processed)')
+    parser.add_argument('--num_frames', type=int, default=None, help='only use the first num_frames frames (default: all of them)')
+    parser.add_argument('--time_step', type=int, default=2001, help='max time between two frames (in milliseconds) for their optical flow to be used')
+    parser.add_argument('--flow_backend', type=str, default='tvl1', choices=FLOW_BACKENDS, help='optical flow method used to estimate the blur (see benchmark_flow.py for the speed/accuracy tradeoff)')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes estimating flow and restoring frame pairs in parallel')
+    parser.add_argument('--restoration', type=str, default='global', choices=['global', 'tiled'], help="'tiled' handles blur that varies across the frame and avoids full-frame FFTs")
+    parser.add_argument('--tile_size', type=int, default=DEFAULT_TILE_SIZE, help='tile size in pixels for tiled restoration (tiles overlap by half)')
+    parser.add_argument('--tile_workers', type=int, default=None, help='threads deconvolving tiles of each frame (default: all cores if workers is 1, else 1)')
+    add_catalog_args(parser)
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Estimate motion blur between consecutive frames with optical flow and deblur each frame with a Wiener filter.")
+    add_args(parser)
+    return parser.parse_args()
+
+
+def get_frame_index(filename: str) -> int:
+    return int(filename.split('_')[-1].split('.')[0])
+
+
+def list_frame_files(directory, num_frames=None, catalog: FrameCatalog = None):
+    """ get the frame filenames (in any of the ripper's output formats) in the directory sorted by their frame index (timestamp) - from the catalog's index if one is given """
+    frame_exts = tuple(FORMAT_EXTENSIONS[fmt] for fmt in OUTPUT_FORMATS)
+    if catalog is not None:
+        catalog.scan(directory)
+        # start=0 leaves out frames whose name has no timestamp
+        return [row["name"] for row in catalog.get_frames(directory, start=0, ext=frame_exts, limit=num_frames)]
+    return sorted([f for f in os.listdir(directory) if f.endswith(frame_exts)], key=get_frame_index)[:num_frames]
+
+
+def load_image(img_path) -> np.ndarray:
+    """ load an image as grayscale float32 in [0,1] """
+    with open(img_path, 'rb') as fptr:
+        image = decode_frame(fptr.read(), get_path_format(img_path), grayscale=True)
+    return image.astype(np.float32) * np.float32(1/255)
 
 
 def load_images_from_directory(directory, num_frames=20):
-    image_files = sorted([f for f in os.listdir(directory) if f.endswith('.png')],
-                         key=lambda x: int(x.split('_')[-1].split('.')[0]))[:num_frames]  # Extract frame index
+    image_files = list_frame_files(directory, num_frames)  # Extract frame index
     print("number of files to use: ", len(image_files))
     images = []
     timestamps = []
     for idx, img_file in enumerate(image_files):
         img_path = os.path.join(directory, img_file)
-        frame_index = int(img_file.split('_')[-1].split('.')[0])
-        image = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)/255.0  # Load as grayscale
+        frame_index = get_frame_index(img_file)
+        image = load_image(img_path)  # Load as grayscale
         print(f"image {idx} value range: {np.min(image), np.max(image)}")
         images.append(image)
         timestamps.append(frame_index)
@@ -24,36 +82,31 @@ def load_images_from_directory(directory, num_frames=20):
     return images, timestamps
 
 
-def estimate_motion_blur(images, timestamps, time_step=500):
+def estimate_kernel(prev_image, image, flow_backend="tvl1"):
+    """ estimate the blur "kernel" of image as the normalized optical flow magnitude relative to the previous frame """
+    flow = compute_flow(prev_image, image, flow_backend)
+    # Normalize optical flow to [-1, 1] range
+    flow_min, flow_max = np.min(flow), np.max(flow)
+    flow = 2 * (flow - flow_min) / (flow_max - flow_min) - 1
+    #kernel_x = np.mean(flow[0], axis=0)
+    #kernel_y = np.mean(flow[1], axis=0)
+    #kernel = np.sqrt(kernel_x**2 + kernel_y**2)
+    return np.sqrt(flow[0]**2 + flow[1]**2)  # Combine flow in x and y
+
+
+def get_identity_kernel(image):
+    # Use an identity kernel if no blur is detected
+    return np.ones((image.shape[0], image.shape[1]), dtype=np.float32)
+
+
+def estimate_motion_blur(images, timestamps, time_step=500, flow_backend="tvl1"):
     kernels = []
     for i in range(1, len(images)):
         # Only estimate flow between frames if within the 500ms window
         if timestamps[i] - timestamps[i-1] <= time_step:
-            flow = optical_flow_tvl1(images[i-1], images[i], attachment=10, prefilter=True, num_iter=20)
-            print("optical_flow_shape: ", flow.shape)
-            print("optical flow values: ", np.min(flow), np.max(flow))
-            # Normalize optical flow to [-1, 1] range
-            flow_min, flow_max = np.min(flow), np.max(flow)
-            flow = 2 * (flow - flow_min) / (flow_max - flow_min) - 1
-            print("optical_flow_shape: ", flow.shape)
-            print("optical flow values: ", np.min(flow), np.max(flow))
-            #kernel_x = np.mean(flow[0], axis=0)
-            #kernel_y = np.mean(flow[1], axis=0)
-            #kernel = np.sqrt(kernel_x**2 + kernel_y**2)
-            kernel = np.sqrt(flow[0]**2 + flow[1]**2)  # Combine flow in x and y
-            print("kernel_shape: ", kernel.shape)
-            print("kernel values: ", np.min(kernel), np.max(kernel))
-            # Scale the kernel by the mean pixel intensity of the image
-            # scale_factor = np.mean(images[i])
-            # kernel *= scale_factor / np.mean(kernel)
-            # Normalize the kernel so that it has similar intensity to the image
-            #kernel_min, kernel_max = np.min(kernel), np.max(kernel)
-            #kernel = (kernel - kernel_min) / (kernel_max - kernel_min) * 255  # Normalize to [0, 255]
-            print(f"Kernel min/max values after scaling: {kernel.min()}, {kernel.max()}")
-            kernels.append(kernel)
+            kernels.append(estimate_kernel(images[i-1], images[i], flow_backend))
         else:
-            # Use an identity kernel if no blur is detected
-            kernels.append(np.ones((images[i].shape[0], images[i].shape[1])))
+            kernels.append(get_identity_kernel(images[i]))
     return kernels
 
 
@@ -76,6 +129,7 @@ def wiener_filter(input_image, kernel, snr=1e-2):
     # # Inverse Fourier transform to get the result
     # restored_image = np.real(fft.ifft2(result_fft))
     # Apply Wiener filtering directly using skimage
+    from skimage.restoration import wiener
     restored_image = wiener(input_image, kernel, balance=1e-2)  # Adjust balance as needed
     return restored_image
 
@@ -89,31 +143,102 @@ def apply_kernels_to_images(images, kernels):
     return restored_images
 
 
+def save_restored_image(img, timestamp, output_dir) -> str:
+    """ save a restored image in [0,1] as an 8-bit PNG named by its timestamp """
+    import cv2
+    output_path = os.path.join(output_dir, f"frame_{timestamp}.png")
+    cv2.imwrite(output_path, (np.clip(img, 0, 1) * 255).round().astype(np.uint8))
+    return output_path
+
+
 def save_restored_images(images, timestamps, output_dir):
+    """ save restored images - timestamps should be those of the restored frames (i.e. excluding the first frame) """
     os.makedirs(output_dir, exist_ok=True)
     for img, timestamp in zip(images, timestamps):
-        output_path = os.path.join(output_dir, f"frame_{timestamp}.png")
-        #print("img value range right before saving: ", np.min(img), np.max(img))
-        #img = img.clip(0,1)
-        print("img value range right before saving (after clipping): ", np.min(img), np.max(img))
-        cv2.imwrite(output_path, np.clip(img, 0, 255).astype(np.uint8))
-
-
-def process_image_directory(input_dir, output_dir, num_frames=20):
-    # Step 1: Load images and their timestamps
-    images, timestamps = load_images_from_directory(input_dir, num_frames)
-    # Step 2: Estimate motion blur kernels based on timestamps
-    kernels = estimate_motion_blur(images, timestamps, 2001)
-    print("number of kernels: ", len(kernels))
-    print("kernel value range: ", np.min(kernels), np.max(kernels))
-    # Step 3: Apply the kernels to each image
-    restored_images = apply_kernels_to_images(images, kernels)
-    print("value range of restored images: ", np.min(restored_images), np.max(restored_images))
-    # Step 4: Save the restored images
-    save_restored_images(restored_images, timestamps, output_dir)
+        save_restored_image(img, timestamp, output_dir)
+
+
+def restore_frame(prev_image, image, prev_timestamp, timestamp, params: DeblurParams, output_dir) -> str:
+    """ deblur image using the flow from the previous frame (if it's within time_step) and write it out """
+    if params.restoration == "tiled":
+        restored = image
+        if timestamp - prev_timestamp <= params.time_step:
+            flow = compute_flow(prev_image, image, params.flow_backend)
+            restored = deconvolve_tiled(image, flow, params.tile_size, workers=params.tile_workers)
+        return save_restored_image(restored, timestamp, output_dir)
+    if timestamp - prev_timestamp <= params.time_step:
+        kernel = estimate_kernel(prev_image, image, params.flow_backend)
+    else:
+        kernel = get_identity_kernel(image)
+    return save_restored_image(wiener_filter(image, kernel), timestamp, output_dir)
+
+
+def restore_frames_from_paths(paths, params: DeblurParams, output_dir) -> list:
+    """ process pool job restoring every frame of a run of consecutive frames but the first (which is only the predecessor of the second)
+        takes paths so that only filenames are pickled between processes, and slides a two-frame window so each frame in the run is decoded once
+    """
+    prev_image = load_image(paths[0])
+    output_paths = []
+    for prev_path, path in zip(paths, paths[1:]):
+        image = load_image(path)
+        output_paths.append(restore_frame(prev_image, image, get_frame_index(os.path.basename(prev_path)), get_frame_index(os.path.basename(path)), params, output_dir))
+        prev_image = image
+    return output_paths
+
+
+def process_image_directory(input_dir, output_dir, num_frames=None, params: DeblurParams = None, workers=1, catalog: FrameCatalog = None):
+    """ restore every frame after the first using the optical flow from its predecessor, writing each frame as soon as it's done
+        only a two-frame window (or two frames per worker process) is held in memory, so memory use doesn't grow with the number of frames
+        with a catalog, frames are listed from it and the restored ones are marked done for the 'deblur' stage
+    """
+    params = params or DeblurParams()
+    os.makedirs(output_dir, exist_ok=True)
+    image_paths = [os.path.join(input_dir, f) for f in list_frame_files(input_dir, num_frames, catalog)]
+    print("number of files to use: ", len(image_paths))
+    if workers <= 1:
+        prev_image = load_image(image_paths[0]) if image_paths else None
+        for prev_path, path in tqdm(list(zip(image_paths, image_paths[1:])), desc="Restoring frames"):
+            image = load_image(path)
+            restore_frame(prev_image, image, get_frame_index(os.path.basename(prev_path)), get_frame_index(os.path.basename(path)), params, output_dir)
+            prev_image = image
+    else:
+        restore_chunks_parallel(image_paths, params, output_dir, workers)
+    if catalog is not None:
+        catalog.set_states(image_paths[1:], "deblur", params_hash=hash_params({**asdict(params), "output_dir": os.path.abspath(output_dir)}))
+
+
+def restore_chunks_parallel(image_paths, params: DeblurParams, output_dir, workers, chunk_size=PARALLEL_CHUNK_SIZE):
+    """ split the frames into runs of chunk_size frames to restore that overlap by one frame (the predecessor of each run's first restored frame)
+        so only the overlap frame is decoded twice, rather than every frame being decoded both as a pair's frame and as the next pair's predecessor
+    """
+    chunks = [image_paths[start:start + chunk_size + 1] for start in range(0, len(image_paths) - 1, chunk_size)]
+    # keep a bounded number of chunks in flight so pending results can't pile up in memory
+    max_in_flight = 2*workers
+    with ProcessPoolExecutor(max_workers=workers) as executor, tqdm(total=max(len(image_paths) - 1, 0), desc="Restoring frames") as pbar:
+        pending = set()
+        for chunk in chunks:
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pbar.update(len(future.result()))
+            pending.add(executor.submit(restore_frames_from_paths, chunk, params, output_dir))
+        for future in pending:
+            pbar.update(len(future.result()))
+
+
+def main(args: argparse.Namespace):
+    if not os.path.isdir(args.input_dir):
+        raise NotADirectoryError(f"{args.input_dir} is not a directory.")
+    output_dir = args.output_dir or os.path.join(args.input_dir, "processed")
+    if args.tile_workers is None:
+        # avoid oversubscribing the cores when frame pairs are already spread over processes
+        args.tile_workers = os.cpu_count() if args.workers <= 1 else 1
+    params = DeblurParams(args.time_step, args.flow_backend, args.restoration, args.tile_size, args.tile_workers)
+    catalog = FrameCatalog(args.catalog) if args.catalog is not None else None
+    process_image_directory(args.input_dir, output_dir, args.num_frames, params, args.workers, catalog)
+    if catalog is not None:
+        catalog.close()
 
 
 if __name__ == "__main__":
-    input_dir = r"C:\Users\Jacob\Documents\DatasetAnnotationTools\videos\7GpUBRvRgdk\frames"
-    output_dir = r"C:\Users\Jacob\Documents\DatasetAnnotationTools\videos\7GpUBRvRgdk\frames\processed"
-    process_image_directory(input_dir, output_dir, 3)
\ No newline at end of file
+    main(read_cli())
@@ -1,15 +1,23 @@
 import os
 import json
 import argparse
-import vlc
 # vlc docs: https://www.olivieraubert.net/vlc/python-ctypes/doc/vlc.Instance-class.html
+# ? NOTE: vlc is only imported by the 'vlc' backend so that the headless decode backends don't need libvlc installed
 import time
 import numpy as np
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, fields
 from tqdm import tqdm
+from frame_decoders import DECODE_BACKENDS, get_decoder
+from frame_encoders import EncodePool, add_encoder_args, get_encoder_options, get_output_path
+from frame_shards import DEFAULT_FRAMES_PER_SHARD, add_shard_args, get_shard_writer
+from frame_catalog import FrameCatalog, add_catalog_args
+from perf_utils import Instrumentation, StageStats, add_instrumentation_args, add_run_stats, timed_iter
 
 
 MAX_NUM_FRAMES = 1000
+SAMPLING_MODES = ["uniform", "keyframes", "scene"]
+# default mean absolute difference (in gray levels) between downscaled frames that counts as a scene change
+DEFAULT_SCENE_THRESHOLD = 12.0
 
 @dataclass
 class Ripper:
@@ -21,6 +29,17 @@ class Ripper:
     end_time: int
     time_step: int
     duration: int
+    # 'uniform' uses num_frames/time_step; 'keyframes' and 'scene' emit up to num_frames frames wherever the video has keyframes or scene changes
+    sampling: str = "uniform"
+    scene_threshold: float = DEFAULT_SCENE_THRESHOLD
+    # output file format and its settings (see frame_encoders.py)
+    output_format: str = "png"
+    png_level: int = 3
+    jpeg_quality: int = 95
+    # if set, frames are packed into shards here instead of written to frames_path (see frame_shards.py)
+    shard_dir: str = None
+    shard_format: str = "memmap"
+    frames_per_shard: int = DEFAULT_FRAMES_PER_SHARD
 
 
 # borrowed from the main repo just in case there's danger of redownloading a bunch
@@ -31,14 +50,27 @@ def get_user_confirmation(prompt):
         print("Invalid input. Please enter 'y' or 'n' (not case sensitive).")
     return answers[response]
 
-def read_cli():
-    parser = argparse.ArgumentParser(description="Extract frames from a video using VLC.")
+def add_args(parser: argparse.ArgumentParser):
     parser.add_argument('vid_path', type=str, help='path to the video file')
     parser.add_argument('--frames_path', type=str, default=None, help='destination path for frames')
     parser.add_argument('--num_frames', type=int, default=None, help='total number of frames to extract')
     parser.add_argument('--start_time', type=float, default=0, help='start time in milliseconds')
     parser.add_argument('--end_time', type=float, default=None, help='end time in milliseconds')
     parser.add_argument('--time_step', type=float, default=1000, help='time step between extracted frames in milliseconds')
+    parser.add_argument('--backend', type=str, default='opencv', choices=['vlc', *DECODE_BACKENDS],
+                        help="'vlc' takes real-time snapshots from a player; the others decode frames directly without rendering")
+    parser.add_argument('--sampling', type=str, default='uniform', choices=SAMPLING_MODES,
+                        help="'keyframes' decodes only I-frames (pyav backend); 'scene' emits a frame when the scene changes past --scene_threshold")
+    parser.add_argument('--scene_threshold', type=float, default=DEFAULT_SCENE_THRESHOLD, help='mean absolute gray level difference between downscaled frames that counts as a scene change')
+    add_encoder_args(parser)
+    add_shard_args(parser)
+    add_catalog_args(parser)
+    add_instrumentation_args(parser)
+    parser.add_argument('--yes', action='store_true', help="don't ask for confirmation when the frames directory isn't empty")
+
+def read_cli():
+    parser = argparse.ArgumentParser(description="Extract frames from a video using VLC or a headless decode backend.")
+    add_args(parser)
     return parser.parse_args()
 
 def sanitize_inputs(args: argparse.Namespace, vid_duration: int) -> Ripper:
@@ -50,7 +82,9 @@ def sanitize_inputs(args: argparse.Namespace, vid_duration: int) -> Ripper:
 
     # ? NOTE: all times are in milliseconds
     # initialize the dataclass with the parser (converted to dict then unpacked) then sanitize its values
-    params = Ripper(**vars(args), duration=vid_duration)
+    # only pass along the arguments that are Ripper fields (e.g. not the backend)
+    ripper_fields = [f.name for f in fields(Ripper)]
+    params = Ripper(**{k: v for k, v in vars(args).items() if k in ripper_fields}, duration=vid_duration)
     # adjusting vid_duration slightly so that extract_frames can read the last frame index - had to experiment w/ this
     vid_duration -= 1 # time in milliseconds formatted as an int
     # if the start time is somehow negative or greater than the actual video duration, clip to correct interval
@@ -62,6 +96,12 @@ def sanitize_inputs(args: argparse.Namespace, vid_duration: int) -> Ripper:
         params.end_time = bound_times(params.end_time, 0, vid_duration)
     if params.end_time <= params.start_time:
         raise ValueError(f"end_time cannot be less than the start time; got {params.end_time} and {params.start_time}, respectively")
+    if params.sampling != "uniform":
+        # frames are emitted wherever the video calls for them, so num_frames is only a cap and time_step doesn't apply
+        params.num_frames = bound_times(params.num_frames or MAX_NUM_FRAMES, 1, MAX_NUM_FRAMES)
+        params.time_step = None
+        print(f"Extracting up to {params.num_frames} frames with '{params.sampling}' sampling")
+        return params
     # duration of interval meant to be read may be different than vid_duration
     read_duration = params.end_time - params.start_time
     if params.num_frames is None:
@@ -80,8 +120,12 @@ def sanitize_inputs(args: argparse.Namespace, vid_duration: int) -> Ripper:
     return params
 
 
-def get_video_duration(vid_path: str) -> int:
+def get_video_duration(vid_path: str, backend: str = "vlc") -> int:
     """ get the duration of the video in milliseconds """
+    if backend != "vlc":
+        with get_decoder(backend, vid_path) as decoder:
+            return decoder.get_duration()
+    import vlc
     # initialize VLC instance without console output
     #print(vid_path)
     instance = vlc.Instance('--quiet', '--no-video-title-show', '--intf', 'dummy')
@@ -96,8 +140,14 @@ def get_video_duration(vid_path: str) -> int:
     return duration
 
 
+def get_frame_times(ripper: Ripper) -> np.ndarray:
+    """ get the timestamps (in milliseconds) of all frames to extract """
+    # FIXME: need to change the logic for dealing with either a time step or a constant number of frames to use
+    return np.arange(ripper.start_time, ripper.end_time + 1, step=ripper.time_step)
+
 def extract_frames(ripper: Ripper):
     """ extract frames from the video and save them to the specified directory """
+    import vlc
     # initialize VLC instance without console output
     # add '--no-xlib' to suppress window appearing
     instance = vlc.Instance('--quiet', '--no-video-title-show', '--intf', 'dummy')
@@ -108,8 +158,7 @@ def extract_frames(ripper: Ripper):
     player.play()
     time.sleep(1)
     # get frame indices to extract
-    # FIXME: need to change the logic for dealing with either a time step or a constant number of frames to use
-    frame_times = np.arange(ripper.start_time, ripper.end_time + 1, step=ripper.time_step)
+    frame_times = get_frame_times(ripper)
     #time_step_s = ripper.time_step/1000 # was going to use this for the new sleep time, but I'm not sure if that's actually causing the stuttering problem or not
     print(f"start: {ripper.start_time/1000}s, end: {ripper.end_time/1000}s, step size: {ripper.time_step/1000}s")
     with tqdm(total=ripper.num_frames, desc="Iterating over frames") as pbar:
@@ -126,13 +175,86 @@ def extract_frames(ripper: Ripper):
     player.stop()
     print(f"FINISHED: Frames extracted and saved to {ripper.frames_path}")
 
+def save_decoded_frames(frames, ripper: Ripper, pbar: tqdm = None, encode_workers: int = 1, stats: StageStats = None) -> int:
+    """ save (frame_time, frame) pairs from a decoder to the ripper's frames_path - returns the number of frames saved
+        frames are encoded on background threads while the decoder moves on to the next one
+    """
+    num_saved = 0
+    options = get_encoder_options(ripper)
+    if ripper.shard_dir is not None:
+        # shards are named after the video so several videos (or segments of one) can share a shard directory
+        video_id = os.path.splitext(os.path.basename(ripper.vid_path))[0]
+        writer = get_shard_writer(ripper.shard_format, ripper.shard_dir, video_id, ripper.frames_per_shard, options=options, stats=stats)
+    else:
+        writer = EncodePool(options, encode_workers, stats=stats)
+    with writer:
+        for frame_time, frame in timed_iter(frames, stats, "decode"):
+            writer.submit(frame, get_output_path(os.path.join(ripper.frames_path, f"frame_{frame_time}.png"), options))
+            num_saved += 1
+            if pbar is not None:
+                pbar.update()
+    return num_saved
+
+def save_frames_at(ripper: Ripper, frame_times, backend: str, pbar: tqdm = None, encode_workers: int = 1, stats: StageStats = None) -> int:
+    """ decode the frames at the given times and save them to the ripper's frames_path - returns the number of frames saved """
+    with get_decoder(backend, ripper.vid_path) as decoder:
+        return save_decoded_frames(decoder.iter_frames_at(frame_times), ripper, pbar, encode_workers, stats)
+
+def save_sampled_frames(ripper: Ripper, backend: str, pbar: tqdm = None, encode_workers: int = 1, stats: StageStats = None) -> int:
+    """ decode and save frames picked by the keyframe-only or scene-change sampling modes """
+    with get_decoder(backend, ripper.vid_path) as decoder:
+        if ripper.sampling == "keyframes":
+            frames = decoder.iter_keyframes(ripper.start_time, ripper.end_time, ripper.num_frames)
+        else:
+            frames = decoder.iter_scene_changes(ripper.start_time, ripper.end_time, ripper.scene_threshold, ripper.num_frames)
+        return save_decoded_frames(frames, ripper, pbar, encode_workers, stats)
+
+def extract_frames_decoded(ripper: Ripper, backend: str, encode_workers: int = 1, stats: StageStats = None):
+    """ extract frames by decoding the video directly (no real-time playback) and save them to the specified directory """
+    if ripper.sampling != "uniform":
+        print(f"start: {ripper.start_time/1000}s, end: {ripper.end_time/1000}s, sampling: {ripper.sampling}")
+        with tqdm(total=ripper.num_frames, desc="Decoding frames") as pbar:
+            num_saved = save_sampled_frames(ripper, backend, pbar, encode_workers, stats)
+        print(f"FINISHED: {num_saved} frames extracted and saved to {ripper.shard_dir or ripper.frames_path}")
+        return
+    frame_times = get_frame_times(ripper)
+    print(f"start: {ripper.start_time/1000}s, end: {ripper.end_time/1000}s, step size: {ripper.time_step/1000}s")
+    with tqdm(total=ripper.num_frames, desc="Decoding frames") as pbar:
+        num_saved = save_frames_at(ripper, frame_times, backend, pbar, encode_workers, stats)
+    if num_saved < len(frame_times):
+        print(f"Error: Could not extract frames after {frame_times[num_saved]} milliseconds (video stream ended early)")
+    print(f"FINISHED: Frames extracted and saved to {ripper.shard_dir or ripper.frames_path}")
+
 # borrowed from main project's utils
 def get_matching_filenames(input_dir, substr):
     """ get all filenames in a directory that contain a substring """
     return list(filter(lambda x: (substr in x) and (not os.path.isdir(os.path.join(input_dir, x))), os.listdir(input_dir)))
 
-if __name__ == "__main__":
-    args: argparse.Namespace = read_cli()
+def save_metadata(ripper: Ripper) -> str:
+    """ save parameters to JSON for documentation, next to the video - numbered so that re-runs don't overwrite earlier metadata """
+    metadata_path: str = os.path.join(os.path.dirname(os.path.abspath(ripper.vid_path)), "frame_rip_metadata.json")
+    if os.path.exists(metadata_path):
+        filename_base = os.path.splitext(os.path.basename(metadata_path))[0]
+        parent_dir = os.path.dirname(metadata_path)
+        new_filename = f"{filename_base}_{len(get_matching_filenames(parent_dir, filename_base)) + 1}.json"
+        metadata_path = os.path.join(parent_dir, new_filename)
+    with open(metadata_path, 'w') as fptr:
+        json.dump(asdict(ripper), fptr, indent=4)
+    return metadata_path
+
+def check_backend_options(args: argparse.Namespace):
+    """ reject sampling modes and outputs the chosen backend can't produce, before any video is opened """
+    if args.backend == "vlc" and args.sampling != "uniform":
+        raise ValueError(f"'{args.sampling}' sampling needs a decode backend ({DECODE_BACKENDS}), not 'vlc'")
+    if args.sampling == "keyframes" and args.backend != "pyav":
+        raise ValueError("keyframe-only sampling needs the 'pyav' backend")
+    if args.backend == "vlc" and args.output_format != "png":
+        raise ValueError(f"VLC snapshots are always PNG; use a decode backend ({DECODE_BACKENDS}) for '{args.output_format}' output")
+    if args.backend == "vlc" and args.shard_dir is not None:
+        raise ValueError(f"VLC snapshots are written straight to files; use a decode backend ({DECODE_BACKENDS}) to write shards")
+
+def main(args: argparse.Namespace):
+    check_backend_options(args)
     ### handle file existence, path creation, and confirmation of path existences
     if not os.path.exists(args.vid_path) or not os.path.isfile(args.vid_path):
         raise FileNotFoundError(f"Couldn't find the file at {args.vid_path}")
@@ -140,24 +262,36 @@ if __name__ == "__main__":
     if args.frames_path is None:
         args.frames_path = os.path.join(os.path.dirname(args.vid_path), "frames")
     # create inner frames directory in the video directory - shouldn't exist by default unless you're re-running it
-    if not os.path.exists(args.frames_path):
+    if args.shard_dir is not None:
+        # frames go into shards, which never overwrite existing ones
+        pass
+    elif not os.path.exists(args.frames_path):
         os.makedirs(args.frames_path)
     elif len(os.listdir(args.frames_path)) > 0:
         print(f"WARNING: directory '{args.frames_path}' already exists with {len(os.listdir(args.frames_path))} files.")
-        if not get_user_confirmation("Continue anyway?"):
+        if not args.yes and not get_user_confirmation("Continue anyway?"):
             raise KeyboardInterrupt("program terminated by user")
     ### handle the actual frame extraction process
-    duration: int = get_video_duration(args.vid_path)
+    duration: int = get_video_duration(args.vid_path, args.backend)
     ripper: Ripper = sanitize_inputs(args, duration)
-    # save parameters to JSON for documentation
-    metadata_path: str = os.path.join(os.path.dirname(args.vid_path), "frame_rip_metadata.json")
-    if os.path.exists(metadata_path):
-        filename_base = os.path.splitext(os.path.basename(metadata_path))[0]
-        parent_dir = os.path.dirname(metadata_path)
-        new_filename = f"{filename_base}_{len(get_matching_filenames(parent_dir, filename_base)) + 1}.json"
-        metadata_path = os.path.join(parent_dir, new_filename)
-    with open(metadata_path, 'w') as fptr:
-        json.dump(asdict(ripper), fptr, indent=4)
-    extract_frames(ripper)
+    metadata_path = save_metadata(ripper)
+    instrumentation = Instrumentation.from_args(args)
+    with instrumentation:
+        if args.backend == "vlc":
+            extract_frames(ripper)
+        else:
+            extract_frames_decoded(ripper, args.backend, args.encode_workers, instrumentation.stats)
+    if instrumentation.enabled:
+        add_run_stats(metadata_path, instrumentation.summary())
+        print(f"run statistics added to {metadata_path}")
+    if args.catalog is not None and args.shard_dir is None:
+        # register the new frames so later tools can find them without listing the directory
+        with FrameCatalog(args.catalog) as catalog:
+            counts = catalog.scan(args.frames_path)
+        print(f"catalog updated: {counts['added']} frames added, {counts['updated']} updated")
+
+
+if __name__ == "__main__":
+    main(read_cli())
 
 # ? NOTE: still don't have access to FFMPEG since IT is kinda incompetent
\ No newline at end of file
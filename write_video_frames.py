@@ -1,50 +1,68 @@
-import torchvision,io as IO
 import os
-import sys
+import argparse
+from tqdm import tqdm
+from frame_decoders import DECODE_BACKENDS, get_decoder
+from frame_encoders import EncoderOptions, EncodePool, add_encoder_args, get_encoder_options, get_output_path
+from perf_utils import get_peak_rss_mb
 
 
-# !! DONT RUN THIS SCRIPT YET - NOT SAFE FOR LARGE VIDEOS
-# in case nobody reads this:
-print("NOT SAFE TO RUN - READ COMMENTS")
-sys.exit(1)
-
+# ? NOTE: frames are streamed from the decoder one at a time and non-sampled frames are dropped immediately,
+# so memory use stays flat regardless of the video length (the old version read the whole video into one TCHW tensor)
 
 allowed_ext = ["mp4", "avi", "mkv", "wmv", "mov"]
 # video root directory - hardcoded to work at CAVS with Windows-style separators
-video_dir = r"I:\projects\ARC\Project1.38\new_val_dataset\vids"
-# get video ID as a command line argument that follows this file's name (need to double check the default indexing to make sure python isn't counted)
-video_id = sys.argv[1]
-# path to search for the video file
-video_path = os.path.join(video_dir, video_id)
-# if directory I:\projects\ARC\Project1.38\new_val_dataset\vids\{video_id} not found, throw error
-if not os.path.isdir(video_path):
-    raise NotADirectoryError(f"DIRECTORY '{video_path}' NOT FOUND")
-
-# destination directory for the video frames - intended to be I:\projects\ARC\Project1.38\new_val_dataset\frames\{video_id}
-new_frames_dir = os.path.abspath(os.path.join(video_dir, "..", "frames", video_id))
-if not os.path.isdir(new_frames_dir):
-    os.makedirs(new_frames_dir)
-
-# read video into a 4D video tensor of shape (T,C,H,W) - returns only the frames, not audio or metadata also returned by read_video
-
-def get_video_tensor():
+default_video_dir = r"I:\projects\ARC\Project1.38\new_val_dataset\vids"
+
+
+def read_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Write every n-th frame of a video to image files, streaming frames from the decoder.")
+    parser.add_argument('video_id', type=str, help='ID of the video (name of its directory and file stem within video_dir)')
+    parser.add_argument('num_frames', type=int, nargs='?', default=None, help='number of frames you want to keep total; default is all of them')
+    parser.add_argument('--video_dir', type=str, default=default_video_dir, help='video root directory')
+    parser.add_argument('--backend', type=str, default='opencv', choices=DECODE_BACKENDS, help='decode backend to stream frames with')
+    add_encoder_args(parser)
+    args = parser.parse_args()
+    if args.num_frames is not None and args.num_frames < 1:
+        parser.error(f"num_frames must be at least 1 (got {args.num_frames})")
+    return args
+
+def get_video_file(video_path: str, video_id: str) -> str:
     for dir_contents in os.listdir(video_path):
         if any([dir_contents == f"{video_id}.{ext}" for ext in allowed_ext]):
-            # https://pytorch.org/vision/stable/generated/torchvision.io.read_video.html#torchvision.io.read_video
-            frames, _, _ = IO.read_video(os.path.join(video_path, dir_contents), output_format="TCHW")
-            return frames
+            return os.path.join(video_path, dir_contents)
     # if loop finished without returning a value, throw error
     raise FileNotFoundError(f"NO SUITABLE VIDEO FILE FOUND WITH PREFIX '{video_id}'")
 
-frames = get_video_tensor()
-# optional second command line argument following the video ID = number of frames you want to keep total; default is all of them
-num_frames = sys.argv[2] if len(sys.argv) > 2 else frames.shape[0]
-# sample interval - the total frames read divided by the number you want to keep
-sample_int = frames.shape[0]//num_frames
-
-# iterate over frames with specified sample interval, saving files as PNG named with left 0 padding for proper ordering
-for idx in range(0, frames.shape[0], step=sample_int):
-    filename = f"{str(idx).rjust(8, 0)}.png"
-    IO.write_png(frames[idx], os.path.join(new_frames_dir, filename), compression_level=3)
+def write_sampled_frames(video_file: str, new_frames_dir: str, num_frames: int = None, backend: str = "opencv", options: EncoderOptions = None, encode_workers: int = 4) -> int:
+    """ stream frames from the video, writing every sample_int-th frame (PNG by default) named with left 0 padding for proper ordering """
+    options = options or EncoderOptions()
+    with get_decoder(backend, video_file) as decoder:
+        total_frames = decoder.get_frame_count()
+        if num_frames is None:
+            num_frames = total_frames
+        # sample interval - the total frames read divided by the number you want to keep
+        sample_int = max(total_frames//num_frames, 1)
+        num_written = 0
+        with tqdm(total=-(-total_frames//sample_int), desc="Writing frames") as pbar, EncodePool(options, encode_workers) as pool:
+            for idx, frame in decoder.iter_sampled(sample_int):
+                filename = f"{str(idx).rjust(8, '0')}.png"
+                pool.submit(frame, get_output_path(os.path.join(new_frames_dir, filename), options))
+                num_written += 1
+                pbar.update()
+    return num_written
 
 
+if __name__ == "__main__":
+    args = read_cli()
+    # path to search for the video file
+    video_path = os.path.join(args.video_dir, args.video_id)
+    # if directory I:\projects\ARC\Project1.38\new_val_dataset\vids\{video_id} not found, throw error
+    if not os.path.isdir(video_path):
+        raise NotADirectoryError(f"DIRECTORY '{video_path}' NOT FOUND")
+    # destination directory for the video frames - intended to be I:\projects\ARC\Project1.38\new_val_dataset\frames\{video_id}
+    new_frames_dir = os.path.abspath(os.path.join(args.video_dir, "..", "frames", args.video_id))
+    if not os.path.isdir(new_frames_dir):
+        os.makedirs(new_frames_dir)
+    num_written = write_sampled_frames(get_video_file(video_path, args.video_id), new_frames_dir, args.num_frames, args.backend,
+                                       get_encoder_options(args), args.encode_workers)
+    print(f"FINISHED: wrote {num_written} frames to {new_frames_dir} (peak RSS: {get_peak_rss_mb():.1f} MiB)")